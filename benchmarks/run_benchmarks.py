@@ -0,0 +1,632 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from argparse import Namespace
+
+import h5py
+import numpy as np
+import pandas as pd
+
+# the benchmarked stages are imported from the data, embed and experiment
+# directories, so every case runs the same code as the scripts
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ["tools", "embed", "experiments"]:
+    sys.path.append(os.path.join(ROOT, directory))
+
+from profiling import add_profile_argument, enable_profiling, stage
+from synthetic_data import (
+    StubLLM,
+    make_case_ids,
+    stub_bulkrnabert,
+    write_clinical_csv,
+    write_embedding_h5,
+    write_reports_csv,
+    write_star_counts,
+    write_tile_h5s,
+)
+
+# Results and baselines are JSON files:
+#   version   BENCHMARK_VERSION
+#   created   local time of the run
+#   machine   platform, python, numpy and cpu count
+#   params    data scale and settings, runs are only compared at equal params
+#   cases     name -> seconds (best of --repeats), items, unit, items_per_sec
+#             and status ("ok" or "skipped" with the missing dependency)
+BENCHMARK_VERSION = 1
+EMBEDDING_DIMS = {"expr": 256, "hist": 1536, "text": 4096}
+# parameters that change the generated data, a data directory is reused
+# only when they match
+DATA_PARAMS = [
+    "seed",
+    "n_cases",
+    "n_expr_cases",
+    "n_genes",
+    "n_hist_cases",
+    "tiles_per_slide",
+    "n_reports",
+]
+# slowdowns shorter than this are timer noise, not regressions
+MIN_SLOWDOWN = 0.05
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--cases",
+        nargs="+",
+        default=None,
+        help="Cases to run, all by default.",
+    )
+    parser.add_argument(
+        "--n-cases",
+        type=int,
+        default=1000,
+        help="Cases in the clinical data and embedding H5s.",
+    )
+    parser.add_argument(
+        "--n-expr-cases",
+        type=int,
+        default=200,
+        help="Cases with STAR-count files.",
+    )
+    parser.add_argument("--n-genes", type=int, default=5000)
+    parser.add_argument(
+        "--n-hist-cases",
+        type=int,
+        default=100,
+        help="Cases with UNI2 tile feature files.",
+    )
+    parser.add_argument("--tiles-per-slide", type=int, default=1000)
+    parser.add_argument("--n-reports", type=int, default=1000)
+    parser.add_argument("--pca-components", nargs="+", type=int, default=[4, 16, 64])
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=1,
+        help="Runs of each case, the fastest is reported.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--data-dir",
+        default=None,
+        help=(
+            "Directory for the synthetic inputs, reused by later runs with the "
+            "same data parameters. A temporary directory by default."
+        ),
+    )
+    parser.add_argument("--output", default=None, help="Save results to this JSON.")
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="Compare against the results JSON of an earlier run.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Slowdown relative to the baseline reported as a regression.",
+    )
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    if args.cases is not None:
+        unknown = [c for c in args.cases if c not in CASES]
+        if len(unknown) > 0:
+            parser.error(f"Unknown cases: {', '.join(unknown)}")
+    return args
+
+
+def load_data_tool():
+    # data-tool.py is not an importable module name
+    path = os.path.join(ROOT, "data", "data-tool.py")
+    spec = importlib.util.spec_from_file_location("data_tool", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_data(data_dir: str, params: dict):
+    meta_path = os.path.join(data_dir, "meta.json")
+    data_params = {k: params[k] for k in DATA_PARAMS}
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            if json.load(f) == data_params:
+                print(f"Using synthetic data in {data_dir}")
+                return
+        shutil.rmtree(data_dir)
+
+    print(f"Generating synthetic data in {data_dir}")
+    os.makedirs(data_dir, exist_ok=True)
+    rng = np.random.default_rng(params["seed"])
+    case_ids = make_case_ids(params["n_cases"])
+    write_clinical_csv(os.path.join(data_dir, "clinical.csv"), case_ids, rng)
+    write_reports_csv(
+        os.path.join(data_dir, "reports.csv"), case_ids[: params["n_reports"]], rng
+    )
+
+    # downloads as fetched by the GDC client, plus the organized copy
+    # <case_id>/<file_name> read by the expression embed scripts
+    download_dir = os.path.join(data_dir, "downloads")
+    expr_files = write_star_counts(
+        download_dir, case_ids[: params["n_expr_cases"]], params["n_genes"], rng
+    )
+    expr_files.to_csv(os.path.join(data_dir, "expr-files.csv"), index=False)
+    expr_files.rename(columns={"file_name": "filename", "md5sum": "md5"}).to_csv(
+        os.path.join(data_dir, "expr-manifest.txt"),
+        sep="\t",
+        index=False,
+        columns=["id", "filename", "md5", "file_size", "state"],
+        header=["id", "filename", "md5", "size", "state"],
+    )
+    for row in expr_files.itertuples():
+        os.makedirs(os.path.join(data_dir, "expr", row.case_id), exist_ok=True)
+        os.link(
+            os.path.join(download_dir, row.id, row.file_name),
+            os.path.join(data_dir, "expr", row.case_id, row.file_name),
+        )
+
+    n_tiles = write_tile_h5s(
+        os.path.join(data_dir, "tiles"),
+        case_ids[: params["n_hist_cases"]],
+        params["tiles_per_slide"],
+        EMBEDDING_DIMS["hist"],
+        rng,
+    )
+    n_files = {
+        modality: write_embedding_h5(
+            os.path.join(data_dir, f"{modality}.h5"), case_ids, dim, rng
+        )
+        for modality, dim in EMBEDDING_DIMS.items()
+    }
+    with open(os.path.join(data_dir, "counts.json"), "w") as f:
+        json.dump({"n_tiles": n_tiles, "n_files": n_files}, f, indent=2)
+    # meta is written last so an interrupted generation is redone
+    with open(meta_path, "w") as f:
+        json.dump(data_params, f, indent=2)
+
+
+class Timer:
+    # accumulates the time spent inside its with blocks
+    def __init__(self):
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds += time.perf_counter() - self.start
+        return None
+
+
+# Each case prepares its inputs in the fresh work directory ctx.work_dir,
+# times only the benchmarked call and returns the items processed and their
+# unit. Dependencies of the real models are imported inside the cases, a
+# missing one skips the case
+
+
+def case_organize(ctx, timer):
+    data_tool = load_data_tool()
+    # organize moves the downloads, so it runs on hard links to them
+    src_dir = os.path.join(ctx.work_dir, "downloads")
+    download_dir = os.path.join(ctx.data_dir, "downloads")
+    for root, _, files in os.walk(download_dir):
+        dst_root = os.path.join(src_dir, os.path.relpath(root, download_dir))
+        os.makedirs(dst_root, exist_ok=True)
+        for f in files:
+            os.link(os.path.join(root, f), os.path.join(dst_root, f))
+    df = pd.read_csv(os.path.join(ctx.data_dir, "expr-files.csv"))
+    cwd = os.getcwd()
+    # lists of missing and corrupted files are written to the working directory
+    os.chdir(ctx.work_dir)
+    try:
+        with timer:
+            data_tool.organize_files(
+                name="Expr",
+                df=df,
+                src_dir=src_dir,
+                dst_dir=os.path.join(ctx.work_dir, "expr"),
+                journal=dict(),
+                journal_path=os.path.join(ctx.work_dir, "journal.jsonl"),
+                num_workers=ctx.num_workers,
+            )
+    finally:
+        os.chdir(cwd)
+    return len(df), "files"
+
+
+def load_expr_cache(ctx):
+    from expr_ingest import ExprCache
+
+    return ExprCache.load(
+        dataset_folder=os.path.join(ctx.data_dir, "expr"),
+        cache_root=os.path.join(ctx.work_dir, "expr-cache"),
+        gene_type="protein_coding",
+        manifest=os.path.join(ctx.data_dir, "expr-manifest.txt"),
+        num_workers=ctx.num_workers,
+    )
+
+
+def case_expr_cache(ctx, timer):
+    with timer:
+        expr_cache = load_expr_cache(ctx)
+    return len(expr_cache.files), "files"
+
+
+def case_prepare_adata_for_uce(ctx, timer):
+    # anndata is imported on first use by prepare_adata_for_uce, so the
+    # import is kept out of the timing
+    import anndata
+
+    from embed_expr_uce import prepare_adata_for_uce
+
+    expr_cache = load_expr_cache(ctx)
+    with timer:
+        prepare_adata_for_uce(expr_cache, os.path.join(ctx.work_dir, "for_uce.h5ad"))
+    return len(expr_cache.files), "files"
+
+
+def case_embed_expr_batched(ctx, timer):
+    # the jitted batched forward of BulkRNABert with a lookup table in place
+    # of the transformer
+    from embed_expr_bulkrnabert import collect, embed_batched
+
+    expr_cache = load_expr_cache(ctx)
+    rna_seq_array = np.asarray(expr_cache.matrices["tpm_unstranded"])
+    parameters, forward_fn, tokenizer = stub_bulkrnabert(dim=EMBEDDING_DIMS["expr"])
+    # compiles the forward before timing, the jitted function is cached per
+    # forward and aggregation so the timed run reuses it
+    collect(
+        embed_batched(
+            parameters,
+            forward_fn,
+            tokenizer,
+            rna_seq_array[:1],
+            "mean",
+            ctx.batch_size,
+        )
+    )
+    with timer:
+        collect(
+            embed_batched(
+                parameters,
+                forward_fn,
+                tokenizer,
+                rna_seq_array,
+                "mean",
+                ctx.batch_size,
+            )
+        )
+    return len(rna_seq_array), "files"
+
+
+def case_embed_hist(ctx, timer):
+    import embed_hist_uni2
+
+    args = Namespace(
+        dataset_folder=os.path.join(ctx.data_dir, "tiles"),
+        output_h5=os.path.join(ctx.work_dir, "hist.h5"),
+        aggregation=["mean", "q50"],
+        chunk_size=2048,
+        reservoir_size=65536,
+        num_workers=ctx.num_workers,
+        quantization=None,
+        plan=False,
+        profile=None,
+    )
+    with timer:
+        embed_hist_uni2.main(args)
+    return ctx.counts["n_tiles"], "tiles"
+
+
+def case_embed_hist_prototypes(ctx, timer):
+    import embed_hist_prototypes
+
+    args = Namespace(
+        dataset_folder=os.path.join(ctx.data_dir, "tiles"),
+        output_h5=os.path.join(ctx.work_dir, "hist.h5"),
+        n_components=64,
+        n_prototypes=32,
+        no_whiten=False,
+        chunk_size=4096,
+        batch_size=32768,
+        max_fit_tiles=None,
+        kmeans_epochs=1,
+        seed=0,
+        num_workers=ctx.num_workers,
+        prefetch=None,
+        quantization=None,
+        plan=False,
+        profile=None,
+    )
+    with timer:
+        embed_hist_prototypes.main(args)
+    return ctx.counts["n_tiles"], "tiles"
+
+
+def case_embed_text(ctx, timer):
+    # the steps of the text embed scripts' main with a stub model
+    from embed_utils import (
+        count_tokens,
+        embed_texts_batched,
+        get_missing_idxs,
+        write_embeddings,
+    )
+
+    df = pd.read_csv(os.path.join(ctx.data_dir, "reports.csv"))
+    model = StubLLM(dim=EMBEDDING_DIMS["text"])
+    file_ids = df["patient_filename"].to_list()
+    case_ids = [file_id.split(".")[0] for file_id in file_ids]
+    with timer, h5py.File(os.path.join(ctx.work_dir, "text.h5"), "a") as h5:
+        missing = get_missing_idxs(h5, case_ids, file_ids)
+        reports = df["text"].iloc[missing].to_list()
+        lengths = count_tokens(model, reports)
+        for bucket, embs in embed_texts_batched(
+            model, reports, lengths, ctx.batch_size
+        ):
+            write_embeddings(
+                h5,
+                [case_ids[missing[i]] for i in bucket],
+                [file_ids[missing[i]] for i in bucket],
+                embs,
+            )
+            h5.flush()
+    return len(df), "reports"
+
+
+def case_summarize_reports(ctx, timer):
+    from generate_summaries import summarize_reports
+
+    df = pd.read_csv(os.path.join(ctx.data_dir, "reports.csv"))
+    with timer:
+        summarize_reports(
+            StubLLM(),
+            None,
+            df,
+            os.path.join(ctx.work_dir, "summaries.jsonl"),
+            ctx.batch_size,
+        )
+    return len(df), "reports"
+
+
+def case_h5_case_mean(ctx, timer):
+    from embedding_store import extract_case_emb_from_h5
+
+    case_ids = pd.read_csv(os.path.join(ctx.data_dir, "clinical.csv"))["case_id"]
+    case_ids = sorted(case_ids)
+    with timer:
+        for modality in EMBEDDING_DIMS:
+            with h5py.File(os.path.join(ctx.data_dir, f"{modality}.h5"), "r") as h5:
+                extract_case_emb_from_h5(case_ids, h5)
+    return len(case_ids) * len(EMBEDDING_DIMS), "cases"
+
+
+def case_store_convert(ctx, timer):
+    from embedding_store import convert_h5_to_store
+
+    with timer:
+        for modality in EMBEDDING_DIMS:
+            convert_h5_to_store(
+                os.path.join(ctx.data_dir, f"{modality}.h5"),
+                os.path.join(ctx.work_dir, f"{modality}.store"),
+            )
+    return sum(ctx.counts["n_files"].values()), "files"
+
+
+def case_store_case_mean(ctx, timer):
+    from embedding_store import EmbeddingStore, convert_h5_to_store
+
+    store_paths = [
+        convert_h5_to_store(
+            os.path.join(ctx.data_dir, f"{modality}.h5"),
+            os.path.join(ctx.work_dir, f"{modality}.store"),
+        )
+        for modality in EMBEDDING_DIMS
+    ]
+    n_cases = 0
+    with timer:
+        for store_path in store_paths:
+            store = EmbeddingStore(store_path)
+            n_cases += len(store.case_mean(store.case_ids))
+    return n_cases, "cases"
+
+
+def get_inputs(ctx) -> dict[str, str]:
+    return {
+        "clinical_data": os.path.join(ctx.data_dir, "clinical.csv"),
+        **{
+            f"{modality}_file": os.path.join(ctx.data_dir, f"{modality}.h5")
+            for modality in EMBEDDING_DIMS
+        },
+    }
+
+
+def case_assemble_features(ctx, timer):
+    from embedding_store import EmbeddingStore
+    from survival_experiments import assemble_features
+
+    # the columnar copies are kept next to the H5s in the data directory and
+    # timed by store_convert
+    for modality in EMBEDDING_DIMS:
+        EmbeddingStore.from_h5(os.path.join(ctx.data_dir, f"{modality}.h5"))
+    with timer:
+        features = assemble_features(**get_inputs(ctx))
+    return len(features["case_ids"]), "cases"
+
+
+def case_load_bundle(ctx, timer):
+    from survival_experiments import load_features
+
+    bundle_dir = os.path.join(ctx.work_dir, "feature-bundles")
+    load_features(**get_inputs(ctx), bundle_dir=bundle_dir)
+    with timer:
+        features = load_features(**get_inputs(ctx), bundle_dir=bundle_dir)
+    return len(features["case_ids"]), "cases"
+
+
+def case_survival_grid(ctx, timer):
+    from survival_experiments import load_features, run_experiments
+
+    features = load_features(
+        **get_inputs(ctx), bundle_dir=os.path.join(ctx.work_dir, "feature-bundles")
+    )
+    with timer:
+        results = run_experiments(
+            {"synthetic": features},
+            pca_components=ctx.pca_components,
+            num_workers=ctx.num_workers,
+            cache_dir=None,
+        )
+    # scored models of every pca_components value, split, modality and combo
+    n_models = sum(
+        len(split_results)
+        for split_results_list in results["synthetic"].values()
+        for split_results in split_results_list
+    )
+    return n_models, "models"
+
+
+CASES = {
+    "organize": case_organize,
+    "expr_cache": case_expr_cache,
+    "prepare_adata_for_uce": case_prepare_adata_for_uce,
+    "embed_expr_batched": case_embed_expr_batched,
+    "embed_hist": case_embed_hist,
+    "embed_hist_prototypes": case_embed_hist_prototypes,
+    "embed_text": case_embed_text,
+    "summarize_reports": case_summarize_reports,
+    "h5_case_mean": case_h5_case_mean,
+    "store_convert": case_store_convert,
+    "store_case_mean": case_store_case_mean,
+    "assemble_features": case_assemble_features,
+    "load_bundle": case_load_bundle,
+    "survival_grid": case_survival_grid,
+}
+
+
+def run_case(name: str, ctx, work_root: str, repeats: int) -> dict:
+    seconds = []
+    for i in range(repeats):
+        ctx.work_dir = os.path.join(work_root, f"{name}-{i}")
+        os.makedirs(ctx.work_dir)
+        timer = Timer()
+        try:
+            with stage(name):
+                items, unit = CASES[name](ctx, timer)
+        except ModuleNotFoundError as e:
+            return {"status": "skipped", "reason": f"missing module {e.name}"}
+        finally:
+            shutil.rmtree(ctx.work_dir)
+        seconds.append(timer.seconds)
+    best = min(seconds)
+    return {
+        "status": "ok",
+        "seconds": best,
+        "items": items,
+        "unit": unit,
+        "items_per_sec": items / best if best > 0 else None,
+    }
+
+
+def get_machine() -> dict:
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    # cases slower than the baseline by more than the tolerance
+    if baseline["params"] != results["params"]:
+        changed = [
+            k
+            for k in set(results["params"]) | set(baseline["params"])
+            if results["params"].get(k) != baseline["params"].get(k)
+        ]
+        raise ValueError(f"Baseline was run with different params: {sorted(changed)}")
+    regressions = []
+    print(f"{'baseline s':>11} {'current s':>10} {'ratio':>6}  case")
+    for name, result in results["cases"].items():
+        base = baseline["cases"].get(name)
+        if base is None or base["status"] != "ok" or result["status"] != "ok":
+            continue
+        ratio = result["seconds"] / max(base["seconds"], 1e-9)
+        slowdown = result["seconds"] - base["seconds"]
+        regressed = ratio > 1 + tolerance and slowdown > MIN_SLOWDOWN
+        if regressed:
+            regressions.append(name)
+        flag = "  REGRESSION" if regressed else ""
+        print(
+            f"{base['seconds']:11.3f} {result['seconds']:10.3f} {ratio:6.2f}  "
+            f"{name}{flag}"
+        )
+    return regressions
+
+
+def main(args):
+    enable_profiling(args.profile)
+    params = {
+        k: v
+        for k, v in vars(args).items()
+        if k not in ["cases", "data_dir", "output", "baseline", "tolerance", "profile"]
+    }
+    tmp_root = tempfile.mkdtemp(prefix="benchmarks-")
+    try:
+        data_dir = args.data_dir or os.path.join(tmp_root, "data")
+        with stage("generate_data"):
+            generate_data(data_dir, params)
+        with open(os.path.join(data_dir, "counts.json"), "r") as f:
+            counts = json.load(f)
+        ctx = Namespace(data_dir=os.path.abspath(data_dir), counts=counts, **params)
+
+        cases = dict()
+        for name in args.cases or CASES:
+            print(f"Running {name}")
+            cases[name] = run_case(name, ctx, tmp_root, args.repeats)
+    finally:
+        shutil.rmtree(tmp_root)
+
+    print(f"{'seconds':>10} {'items/s':>12}  case")
+    for name, result in cases.items():
+        if result["status"] == "ok":
+            print(
+                f"{result['seconds']:10.3f} {result['items_per_sec']:12.1f}  "
+                f"{name} ({result['items']} {result['unit']})"
+            )
+        else:
+            print(f"{'-':>10} {'-':>12}  {name} skipped, {result['reason']}")
+
+    results = {
+        "version": BENCHMARK_VERSION,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "machine": get_machine(),
+        "params": params,
+        "cases": cases,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print(f"{len(regressions)} cases regressed: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
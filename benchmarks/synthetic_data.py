@@ -0,0 +1,364 @@
+import hashlib
+import os
+import uuid
+
+import h5py
+import numpy as np
+import pandas as pd
+
+# Generators of offline stand-ins for every pipeline input, shaped like the
+# real files so the data, embed and experiment code runs on them unchanged:
+# clinical CSVs as written by data-tool.py prepare, GDC STAR-count TSVs and
+# their manifest, UNI2 tile feature H5s, pathology report CSVs, and case/file
+# embedding H5s as written by the embed scripts. Marginal distributions follow
+# the TCGA cohort (projects, demographics, 27% deaths, lognormal report
+# lengths with a median of ~320 words). Stub models stand in for vLLM and the
+# BulkRNABert forward pass, returning deterministic vectors
+TCGA_PROJECTS = {
+    "TCGA-BRCA": 989,
+    "TCGA-KIRC": 497,
+    "TCGA-UCEC": 494,
+    "TCGA-THCA": 484,
+    "TCGA-LGG": 442,
+    "TCGA-HNSC": 433,
+    "TCGA-LUSC": 418,
+    "TCGA-LUAD": 417,
+    "TCGA-COAD": 408,
+    "TCGA-BLCA": 343,
+    "TCGA-PRAD": 326,
+    "TCGA-LIHC": 320,
+    "TCGA-STAD": 302,
+    "TCGA-CESC": 248,
+    "TCGA-SARC": 240,
+    "TCGA-KIRP": 239,
+    "TCGA-PCPG": 171,
+    "TCGA-PAAD": 168,
+    "TCGA-READ": 151,
+    "TCGA-GBM": 143,
+    "TCGA-ESCA": 116,
+    "TCGA-THYM": 109,
+    "TCGA-SKCM": 94,
+    "TCGA-TGCT": 87,
+    "TCGA-MESO": 66,
+    "TCGA-KICH": 65,
+    "TCGA-UVM": 64,
+    "TCGA-UCS": 56,
+    "TCGA-ACC": 53,
+    "TCGA-DLBC": 43,
+    "TCGA-OV": 42,
+    "TCGA-CHOL": 33,
+}
+RACES = {
+    "white": 6047,
+    "black or african american": 801,
+    "not reported": 681,
+    "asian": 378,
+    "Unknown": 124,
+    "american indian or alaska native": 20,
+    "native hawaiian or other pacific islander": 10,
+}
+ETHNICITIES = {
+    "not hispanic or latino": 6010,
+    "not reported": 1561,
+    "hispanic or latino": 309,
+    "Unknown": 181,
+}
+STAR_COLUMNS = [
+    "gene_id",
+    "gene_name",
+    "gene_type",
+    "unstranded",
+    "stranded_first",
+    "stranded_second",
+    "tpm_unstranded",
+    "fpkm_unstranded",
+    "fpkm_uq_unstranded",
+]
+STAR_SUMMARY_ROWS = ["N_unmapped", "N_multimapping", "N_noFeature", "N_ambiguous"]
+VOCABULARY = (
+    "the of and in with a is no to carcinoma tumor margin lymph nodes specimen "
+    "received formalin labeled consists measures cm tissue grade invasive "
+    "ductal negative positive for malignancy identified sections submitted "
+    "gross description diagnosis microscopic resection biopsy metastatic "
+    "squamous cell adenocarcinoma stage pT2 pN0 focal necrosis present"
+).split()
+
+
+def sample(rng: np.random.Generator, counts: dict, n: int) -> np.ndarray:
+    p = np.array(list(counts.values()), dtype=np.float64)
+    return rng.choice(list(counts), size=n, p=p / p.sum())
+
+
+def make_uuids(rng: np.random.Generator, n: int) -> list[str]:
+    return [str(uuid.UUID(bytes=rng.bytes(16), version=4)) for _ in range(n)]
+
+
+def make_case_ids(n_cases: int) -> list[str]:
+    # TCGA-XX-XXXX barcodes, unique for up to 36^6 cases
+    digits = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    case_ids = []
+    for i in range(n_cases):
+        code = ""
+        for _ in range(6):
+            i, r = divmod(i, 36)
+            code = digits[r] + code
+        case_ids.append(f"TCGA-{code[:2]}-{code[2:]}")
+    return case_ids
+
+
+def make_files_per_case(rng: np.random.Generator, n_cases: int, extra: float):
+    # at least one file per case, with a fraction of cases holding more
+    return 1 + rng.binomial(2, extra / 2, size=n_cases)
+
+
+def write_clinical_csv(path: str, case_ids: list[str], rng: np.random.Generator):
+    n = len(case_ids)
+    dead = rng.random(n) < 0.27
+    follow_up = np.round(rng.lognormal(6.6, 1.0, size=n)).clip(0, 9634)
+    days_to_death = np.where(dead, follow_up, np.nan)
+    df = pd.DataFrame(
+        {
+            "case_id": case_ids,
+            "project": sample(rng, TCGA_PROJECTS, n),
+            "sex": np.where(rng.random(n) < 0.52, "female", "male"),
+            "age": rng.normal(60, 14, size=n).clip(14.5, 90),
+            "race": sample(rng, RACES, n),
+            "ethnicity": sample(rng, ETHNICITIES, n),
+            "vital_status": np.where(dead, "Dead", "Alive"),
+            "days_to_death": days_to_death,
+            "days_to_last_follow_up": follow_up,
+        }
+    )
+    df = df.sort_values(["project", "case_id"]).reset_index(drop=True)
+    df.to_csv(path, index=False)
+    return df
+
+
+def write_reports_csv(
+    path: str,
+    case_ids: list[str],
+    rng: np.random.Generator,
+    median_words: float = 320,
+    sigma: float = 1.1,
+) -> pd.DataFrame:
+    # one report per case, TCGA_Reports.csv columns
+    n_words = np.round(rng.lognormal(np.log(median_words), sigma, size=len(case_ids)))
+    n_words = n_words.clip(20, 5000).astype(int)
+    words = np.array(VOCABULARY)[rng.integers(0, len(VOCABULARY), n_words.sum())]
+    offsets = np.r_[0, np.cumsum(n_words)]
+    texts = [" ".join(words[offsets[i] : offsets[i + 1]]) for i in range(len(n_words))]
+    file_ids = make_uuids(rng, len(case_ids))
+    df = pd.DataFrame(
+        {
+            "patient_filename": [
+                f"{case_id}.{file_id.upper()}"
+                for case_id, file_id in zip(case_ids, file_ids)
+            ],
+            "text": texts,
+        }
+    )
+    df.to_csv(path, index=False)
+    return df
+
+
+def make_gene_table(n_genes: int, rng: np.random.Generator) -> pd.DataFrame:
+    # GENCODE-like rows: a third protein coding, some duplicated gene names,
+    # and the last few ids repeated as chrY PAR copies
+    n_par = max(1, n_genes // 1000)
+    n_unique = n_genes - n_par
+    gene_ids = [f"ENSG{i:011d}.{rng.integers(1, 20)}" for i in range(n_unique)]
+    gene_ids += [f"{g}_PAR_Y" for g in gene_ids[-n_par:]]
+    names = [f"GENE{i}" for i in range(n_unique)]
+    duplicated = rng.random(n_unique) < 0.01
+    names = [
+        f"GENE{i - 1}" if d and i > 0 else g
+        for i, (g, d) in enumerate(zip(names, duplicated))
+    ]
+    names += names[-n_par:]
+    gene_type = np.where(rng.random(n_genes) < 0.33, "protein_coding", "lncRNA")
+    gene_type[-n_par:] = gene_type[n_unique - n_par : n_unique]
+    lengths = rng.lognormal(7.5, 0.8, size=n_genes)
+    return pd.DataFrame(
+        {
+            "gene_id": gene_ids,
+            "gene_name": names,
+            "gene_type": gene_type,
+            "length": lengths,
+        }
+    )
+
+
+def star_counts_tsv(genes: pd.DataFrame, rng: np.random.Generator) -> bytes:
+    n = len(genes)
+    unstranded = rng.poisson(rng.lognormal(3, 2, size=n)).astype(np.int64)
+    first = rng.binomial(unstranded, 0.5)
+    rate = unstranded / genes["length"].to_numpy()
+    tpm = rate / max(rate.sum(), 1e-12) * 1e6
+    fpkm = unstranded / genes["length"].to_numpy() / max(unstranded.sum(), 1) * 1e9
+    body = pd.DataFrame(
+        {
+            "gene_id": genes["gene_id"],
+            "gene_name": genes["gene_name"],
+            "gene_type": genes["gene_type"],
+            "unstranded": unstranded,
+            "stranded_first": first,
+            "stranded_second": unstranded - first,
+            "tpm_unstranded": tpm.round(4),
+            "fpkm_unstranded": fpkm.round(4),
+            "fpkm_uq_unstranded": (fpkm * 3).round(4),
+        }
+    )
+    summary = pd.DataFrame(
+        {
+            "gene_id": STAR_SUMMARY_ROWS,
+            **{c: "" for c in ["gene_name", "gene_type"]},
+            **{c: rng.integers(1e5, 1e7, 4) for c in STAR_COLUMNS[3:6]},
+            **{c: "" for c in STAR_COLUMNS[6:]},
+        }
+    )
+    text = "# gene-model: GENCODE v36\n"
+    text += pd.concat([summary, body]).to_csv(sep="\t", index=False)
+    return text.encode()
+
+
+def write_star_counts(
+    download_dir: str,
+    case_ids: list[str],
+    n_genes: int,
+    rng: np.random.Generator,
+    extra_files: float = 0.1,
+) -> pd.DataFrame:
+    # files in the GDC Data Transfer Tool layout, <file uuid>/<file name>,
+    # returning the expression metadata of data-tool.py with md5 and size
+    genes = make_gene_table(n_genes, rng)
+    counts = make_files_per_case(rng, len(case_ids), extra_files)
+    rows = []
+    for case_id, count in zip(case_ids, counts):
+        for file_uuid, name_uuid in zip(make_uuids(rng, count), make_uuids(rng, count)):
+            file_name = f"{name_uuid}.rna_seq.augmented_star_gene_counts.tsv"
+            content = star_counts_tsv(genes, rng)
+            os.makedirs(os.path.join(download_dir, file_uuid), exist_ok=True)
+            with open(os.path.join(download_dir, file_uuid, file_name), "wb") as f:
+                f.write(content)
+            rows.append(
+                {
+                    "id": file_uuid,
+                    "file_name": file_name,
+                    "case_id": case_id,
+                    "file_size": len(content),
+                    "md5sum": hashlib.md5(content).hexdigest(),
+                    "state": "released",
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def write_tile_h5s(
+    dataset_folder: str,
+    case_ids: list[str],
+    tiles_per_slide: int,
+    dim: int,
+    rng: np.random.Generator,
+    extra_slides: float = 0.2,
+) -> int:
+    # organized UNI2 feature files, <case_id>/<slide>.h5 holding features of
+    # shape (1, n_tiles, dim), tile counts lognormal around tiles_per_slide
+    counts = make_files_per_case(rng, len(case_ids), extra_slides)
+    n_tiles = 0
+    for case_id, count in zip(case_ids, counts):
+        os.makedirs(os.path.join(dataset_folder, case_id), exist_ok=True)
+        for i, slide_uuid in enumerate(make_uuids(rng, count)):
+            n = int(np.clip(rng.lognormal(np.log(tiles_per_slide), 0.5), 16, None))
+            features = rng.standard_normal((1, n, dim), dtype=np.float32)
+            file_name = f"{case_id}-01Z-00-DX{i + 1}.{slide_uuid.upper()}.h5"
+            with h5py.File(os.path.join(dataset_folder, case_id, file_name), "w") as h5:
+                h5.create_dataset("features", data=features)
+            n_tiles += n
+    return n_tiles
+
+
+def write_embedding_h5(
+    path: str,
+    case_ids: list[str],
+    dim: int,
+    rng: np.random.Generator,
+    extra_files: float = 0.1,
+    dtype: str = "float32",
+) -> int:
+    # case_id/file_id -> (dim,) datasets, as written by embed_utils.write_embeddings
+    counts = make_files_per_case(rng, len(case_ids), extra_files)
+    with h5py.File(path, "w") as h5:
+        for case_id, count in zip(case_ids, counts):
+            group = h5.create_group(case_id)
+            embs = rng.standard_normal((count, dim), dtype=np.float32).astype(dtype)
+            for file_id, emb in zip(make_uuids(rng, count), embs):
+                group.create_dataset(file_id, data=emb)
+    return int(counts.sum())
+
+
+class StubTokenizer:
+    # whitespace tokens, callable like a Hugging Face tokenizer
+    def __call__(self, texts: list[str]) -> dict:
+        return {"input_ids": [text.split() for text in texts]}
+
+
+class StubOutput:
+    def __init__(self, embedding=None, text=None):
+        self.embedding = embedding
+        self.text = text
+
+
+class StubRequestOutput:
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+
+class StubLLM:
+    # the parts of vllm.LLM used by the embed and summary scripts. embeddings
+    # are seeded by the text, summaries are the first words of the report
+    def __init__(self, dim: int = 4096, summary_words: int = 100):
+        self.dim = dim
+        self.summary_words = summary_words
+
+    def get_tokenizer(self):
+        return StubTokenizer()
+
+    def embed(self, texts: list[str], use_tqdm: bool = False):
+        outputs = []
+        for text in texts:
+            seed = int.from_bytes(hashlib.md5(text.encode()).digest()[:8], "little")
+            emb = np.random.default_rng(seed).standard_normal(self.dim)
+            outputs.append(StubRequestOutput(StubOutput(embedding=emb.tolist())))
+        return outputs
+
+    def chat(self, prompts: list[list[dict]], sampling_params, use_tqdm=False):
+        outputs = []
+        for messages in prompts:
+            words = messages[-1]["content"].split()[: self.summary_words]
+            outputs.append(StubRequestOutput([StubOutput(text=" ".join(words))]))
+        return outputs
+
+
+class StubRNATokenizer:
+    # BulkRNABert tokenizer stand-in, binning log expression into token ids
+    def __init__(self, n_bins: int = 64):
+        self.n_bins = n_bins
+
+    def batch_tokenize(self, rna_seq_array: np.ndarray) -> np.ndarray:
+        scaled = np.log1p(np.asarray(rna_seq_array, dtype=np.float64)) / np.log(1e6)
+        return np.clip(scaled * self.n_bins, 0, self.n_bins - 1).astype(np.int32)
+
+
+class StubForward:
+    # haiku transformed forward stand-in whose fourth layer embeds each gene
+    # token by a lookup in parameters["table"], so it jits on any JAX backend
+    def apply(self, parameters, random_key, tokens):
+        return {"embeddings_4": parameters["table"][tokens]}
+
+
+def stub_bulkrnabert(n_bins: int = 64, dim: int = 256):
+    # parameters, forward_fn and tokenizer as returned by get_pretrained_model
+    # and hk.transform
+    table = np.random.default_rng(0).standard_normal((n_bins, dim))
+    parameters = {"table": table.astype(np.float32)}
+    return parameters, StubForward(), StubRNATokenizer(n_bins)
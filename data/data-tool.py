@@ -1,22 +1,29 @@
 import argparse
+import hashlib
 import io
 import json
 import os
 import shutil
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from urllib3.util.retry import Retry
 
-MAX_QUERY_SIZE = 1000000
+# stage profiling is shared with the embed and experiment scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
 
+from profiling import add_profile_argument, enable_profiling, profiled, stage
 
-def df_len_check(df):
-    if len(df) == MAX_QUERY_SIZE:
-        print(
-            f"Retrieved entries equal to MAX_QUERY_SIZE ({MAX_QUERY_SIZE}), "
-            "may be missing rows, consider increasing limit"
-        )
+GDC_URL = "https://api.gdc.cancer.gov"
+PAGE_SIZE = 10000
+READ_CHUNK_SIZE = 8 * 1024 * 1024
 
 
 def parse_args():
@@ -30,6 +37,14 @@ def parse_args():
 
     shared_parser = argparse.ArgumentParser(add_help=False)
     shared_parser.add_argument("--reports-path", required=True)
+    shared_parser.add_argument("--gdc-url", default=GDC_URL)
+    shared_parser.add_argument(
+        "--gdc-cache",
+        default="gdc-cache",
+        help="Directory of cached GDC API responses, delete to refetch metadata.",
+    )
+    shared_parser.add_argument("--gdc-workers", type=int, default=8)
+    add_profile_argument(shared_parser)
 
     prepare_parser = subparsers.add_parser("prepare", parents=[shared_parser])
     prepare_parser.add_argument("--clinical-data", required=True)
@@ -41,13 +56,43 @@ def parse_args():
     organize_parser.add_argument("--downloaded-hist", required=True)
     organize_parser.add_argument("--organized-expr", required=True)
     organize_parser.add_argument("--organized-hist", required=True)
+    organize_parser.add_argument("--num-workers", type=int, default=8)
+    organize_parser.add_argument(
+        "--journal",
+        default="organize-journal.jsonl",
+        help="Progress journal used to resume an interrupted organize run.",
+    )
+
+    benchmark_parser = subparsers.add_parser(
+        "benchmark-clinical",
+        help="Check and time clinical parsing on a synthetic GDC payload",
+    )
+    benchmark_parser.add_argument(
+        "--clinical-data",
+        required=True,
+        help="Reference clinical CSV from the prepare mode to build the payload from.",
+    )
+    benchmark_parser.add_argument("--n-cases", type=int, default=1000000)
+    benchmark_parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    add_profile_argument(benchmark_parser)
 
     args = parser.parse_args()
     return args
 
 
 def main(args):
-    clins, exprs, hists, texts = get_merged_metadata(args.reports_path)
+    enable_profiling(args.profile)
+    if args.mode == "benchmark-clinical":
+        benchmark_clinical(args.clinical_data, args.n_cases, args.page_size)
+        return
+
+    client = GDCClient(
+        base_url=args.gdc_url,
+        cache_dir=args.gdc_cache,
+        num_workers=args.gdc_workers,
+    )
+    with stage("metadata"):
+        clins, exprs, hists, texts = get_merged_metadata(args.reports_path, client)
 
     if args.mode == "prepare":
         clins.to_csv(args.clinical_data, index=False)
@@ -77,44 +122,254 @@ def main(args):
         )
         print()
     elif args.mode == "organize":
+        journal = read_journal(args.journal)
         for name, df, src_dir, dst_dir in [
             ("Expr", exprs, args.downloaded_expr, args.organized_expr),
             ("Hist", hists, args.downloaded_hist, args.organized_hist),
         ]:
             print(f"Organizing {name} data from {src_dir} to {dst_dir}")
-            # construct list of expected files and their planned locations
-            file_map = dict()
-            for _, row in df.iterrows():
-                file_name = row["file_name"]
-                if name == "Hist":
-                    # using precomputed embeddings
-                    file_name = file_name.replace(".svs", ".h5")
-                case_id = row["case_id"]
-                case_path = os.path.join(dst_dir, case_id)
-                os.makedirs(case_path, exist_ok=True)
-                file_map[file_name] = os.path.join(case_path, file_name)
-
-            # find and organize downloaded files
-            for root, _, files in os.walk(src_dir):
-                for file_name in files:
-                    if file_name in file_map:
-                        src_file = os.path.join(root, file_name)
-                        dst_file = file_map.pop(file_name)
-                        shutil.move(src=src_file, dst=dst_file)
-            if len(file_map) > 0:
-                not_found_csv = f"{name}-not-found.csv"
-                print(f"Some files were not found, saving list to {not_found_csv}")
-                not_found = pd.DataFrame(
-                    [{"file_name": k, "dst_path": v} for k, v in file_map.items()]
-                ).sort_values("file_name")
-                not_found.to_csv(not_found_csv, index=False)
+            with stage(f"organize_{name.lower()}"):
+                organize_files(
+                    name=name,
+                    df=df,
+                    src_dir=src_dir,
+                    dst_dir=dst_dir,
+                    journal=journal,
+                    journal_path=args.journal,
+                    num_workers=args.num_workers,
+                )
     else:
         raise ValueError(f"Unknown mode: {args.mode}")
 
 
-def get_merged_metadata(reports_path):
-    exprs, hists = get_expr_hist_metadata()
-    clins = get_clin_metadata()
+def read_journal(journal_path):
+    journal = dict()
+    if os.path.exists(journal_path):
+        with open(journal_path, "r") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    journal[entry["file_name"]] = entry
+    return journal
+
+
+@profiled("md5")
+def get_md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(READ_CHUNK_SIZE):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+@profiled()
+def verify_and_move(src_file, dst_file, size=None, md5=None):
+    if size is not None and os.path.getsize(src_file) != size:
+        return "corrupted", f"expected size {size}, got {os.path.getsize(src_file)}"
+    if md5 is not None:
+        actual = get_md5(src_file)
+        if actual != md5:
+            return "corrupted", f"expected md5 {md5}, got {actual}"
+    shutil.move(src=src_file, dst=dst_file)
+    return "moved", None
+
+
+def organize_files(*, name, df, src_dir, dst_dir, journal, journal_path, num_workers):
+    # construct list of expected files and their planned locations
+    file_names = df["file_name"]
+    if name == "Hist":
+        # using precomputed embeddings, size and md5 from GDC are for the SVS
+        file_names = file_names.str.replace(".svs", ".h5", regex=False)
+        sizes = [None] * len(df)
+        md5s = [None] * len(df)
+    else:
+        sizes = df["file_size"].astype(int).to_list()
+        md5s = df["md5sum"].to_list()
+    for case_id in df["case_id"].unique():
+        os.makedirs(os.path.join(dst_dir, case_id), exist_ok=True)
+    dst_files = [
+        os.path.join(dst_dir, case_id, file_name)
+        for case_id, file_name in zip(df["case_id"], file_names)
+    ]
+    file_map = {
+        file_name: (dst_file, size, md5)
+        for file_name, dst_file, size, md5 in zip(file_names, dst_files, sizes, md5s)
+    }
+
+    # skip files already moved by a previous run
+    done = [
+        file_name
+        for file_name, (dst_file, _, _) in file_map.items()
+        if file_name in journal
+        and journal[file_name]["status"] == "moved"
+        and os.path.exists(dst_file)
+    ]
+    for file_name in done:
+        file_map.pop(file_name)
+    if len(done) > 0:
+        print(f"{len(done)} files already organized, skipping")
+
+    # find downloaded files
+    tasks = []
+    for root, _, files in os.walk(src_dir):
+        for file_name in files:
+            if file_name in file_map:
+                src_file = os.path.join(root, file_name)
+                tasks.append((file_name, src_file, *file_map.pop(file_name)))
+
+    # verify and organize downloaded files, recording progress in the journal
+    corrupted = []
+    with (
+        open(journal_path, "a") as journal_f,
+        ThreadPoolExecutor(max_workers=num_workers) as executor,
+    ):
+        futures = {
+            executor.submit(verify_and_move, src_file, dst_file, size, md5): (
+                file_name,
+                src_file,
+                dst_file,
+            )
+            for file_name, src_file, dst_file, size, md5 in tasks
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            file_name, src_file, dst_file = futures[future]
+            status, reason = future.result()
+            entry = {"file_name": file_name, "status": status, "dst_path": dst_file}
+            journal_f.write(json.dumps(entry) + "\n")
+            journal_f.flush()
+            journal[file_name] = entry
+            if status == "corrupted":
+                corrupted.append(
+                    {"file_name": file_name, "src_path": src_file, "reason": reason}
+                )
+
+    if len(file_map) > 0:
+        not_found_csv = f"{name}-not-found.csv"
+        print(f"Some files were not found, saving list to {not_found_csv}")
+        not_found = pd.DataFrame(
+            [{"file_name": k, "dst_path": v[0]} for k, v in file_map.items()]
+        ).sort_values("file_name")
+        not_found.to_csv(not_found_csv, index=False)
+    if len(corrupted) > 0:
+        corrupted_csv = f"{name}-corrupted.csv"
+        print(
+            f"{len(corrupted)} files failed size/md5 verification and were not moved, "
+            f"saving list to {corrupted_csv}"
+        )
+        pd.DataFrame(corrupted).sort_values("file_name").to_csv(
+            corrupted_csv, index=False
+        )
+
+
+class GDCClient:
+    def __init__(
+        self,
+        base_url=GDC_URL,
+        cache_dir=None,
+        page_size=PAGE_SIZE,
+        num_workers=8,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.cache_dir = cache_dir
+        self.page_size = page_size
+        self.num_workers = num_workers
+        # pooled keep-alive connections shared by the page fetching threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=num_workers,
+            pool_maxsize=num_workers,
+            # GDC 5xx and rate limits are retried as well as connection errors
+            max_retries=Retry(
+                total=5,
+                backoff_factor=1,
+                status_forcelist=[429, 500, 502, 503, 504],
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, endpoint, params):
+        # responses are cached on disk keyed by endpoint and query parameters
+        cache_file = None
+        if self.cache_dir is not None:
+            key = json.dumps([endpoint, params], sort_keys=True)
+            key = hashlib.sha256(key.encode()).hexdigest()
+            cache_file = os.path.join(self.cache_dir, f"{key}.{params['format']}")
+            if os.path.exists(cache_file):
+                with open(cache_file, "rb") as f:
+                    return f.read()
+        response = self.session.get(f"{self.base_url}/{endpoint}", params=params)
+        response.raise_for_status()
+        if cache_file is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(cache_file + ".tmp", "wb") as f:
+                f.write(response.content)
+            os.replace(cache_file + ".tmp", cache_file)
+        return response.content
+
+    def get_total(self, endpoint, filters):
+        content = self.get(
+            endpoint,
+            {"filters": json.dumps(filters), "format": "JSON", "size": "0"},
+        )
+        return json.loads(content)["data"]["pagination"]["total"]
+
+    def get_pages(self, endpoint, filters, fields, sort, format):
+        # page offsets are known from the total so pages are fetched
+        # concurrently, results are yielded in page order
+        total = self.get_total(endpoint, filters)
+        params = [
+            {
+                "filters": json.dumps(filters),
+                "fields": ",".join(fields),
+                "sort": sort,
+                "format": format,
+                "size": str(self.page_size),
+                "from": str(offset),
+            }
+            for offset in range(0, total, self.page_size)
+        ]
+        return total, self.iter_pages(endpoint, params)
+
+    def iter_pages(self, endpoint, params):
+        # at most twice num_workers pages are fetched ahead of the caller, so
+        # each page can be parsed and dropped before the rest arrive
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = deque()
+            for p in params:
+                futures.append(executor.submit(self.get, endpoint, p))
+                if len(futures) >= 2 * self.num_workers:
+                    with stage(f"fetch_{endpoint}", items=1):
+                        page = futures.popleft().result()
+                    yield page
+            while len(futures) > 0:
+                with stage(f"fetch_{endpoint}", items=1):
+                    page = futures.popleft().result()
+                yield page
+
+    def get_tsv(self, endpoint, filters, fields, sort):
+        total, pages = self.get_pages(endpoint, filters, fields, sort, "TSV")
+        with stage(f"parse_{endpoint}", items=total):
+            # pages are read as they arrive and not kept
+            df = pd.concat(
+                (pd.read_csv(io.BytesIO(page), sep="\t") for page in pages),
+                ignore_index=True,
+            )
+        check_total(endpoint, len(df), total)
+        return df
+
+
+def check_total(endpoint, n, total):
+    if n != total:
+        raise RuntimeError(
+            f"Retrieved {n} of {total} entries from GDC {endpoint}, "
+            "results changed during pagination, rerun with an empty cache"
+        )
+
+
+def get_merged_metadata(reports_path, client):
+    exprs, hists = get_expr_hist_metadata(client)
+    clins = get_clin_metadata(client)
 
     texts = pd.read_csv(reports_path)
     texts["case_id"] = texts["patient_filename"].str[:12]
@@ -173,51 +428,43 @@ EXPR_FILTER = {
 }
 
 
-def get_expr_hist_metadata():
-    response = requests.get(
-        "https://api.gdc.cancer.gov/files",
-        params={
-            "filters": json.dumps(
+def get_expr_hist_metadata(client):
+    df = client.get_tsv(
+        "files",
+        filters={
+            "op": "and",
+            "content": [
                 {
-                    "op": "and",
-                    "content": [
-                        {
-                            "op": "in",
-                            "content": {
-                                "field": "cases.project.program.name",
-                                "value": ["TCGA"],
-                            },
-                        },
-                        {
-                            "op": "in",
-                            "content": {
-                                "field": "cases.samples.tissue_type",
-                                "value": ["Tumor"],
-                            },
-                        },
-                        {
-                            "op": "or",
-                            "content": [HIST_FILTER, EXPR_FILTER],
-                        },
-                    ],
-                }
-            ),
-            "fields": ",".join(
-                [
-                    "file_name",
-                    "cases.project.project_id",
-                    "cases.submitter_id",
-                    "experimental_strategy",
-                    "file_size",
-                    "md5sum",
-                    "state",
-                ]
-            ),
-            "format": "TSV",
-            "size": str(MAX_QUERY_SIZE),
+                    "op": "in",
+                    "content": {
+                        "field": "cases.project.program.name",
+                        "value": ["TCGA"],
+                    },
+                },
+                {
+                    "op": "in",
+                    "content": {
+                        "field": "cases.samples.tissue_type",
+                        "value": ["Tumor"],
+                    },
+                },
+                {
+                    "op": "or",
+                    "content": [HIST_FILTER, EXPR_FILTER],
+                },
+            ],
         },
+        fields=[
+            "file_name",
+            "cases.project.project_id",
+            "cases.submitter_id",
+            "experimental_strategy",
+            "file_size",
+            "md5sum",
+            "state",
+        ],
+        sort="file_id:asc",
     )
-    df = pd.read_csv(io.StringIO(response.text), sep="\t")
     df = df.rename(
         columns={
             "cases.0.project.project_id": "project",
@@ -225,7 +472,6 @@ def get_expr_hist_metadata():
         }
     )
     df = df.sort_values(["project", "case_id"])
-    df_len_check(df)
 
     exprs = df[df["experimental_strategy"] == "RNA-Seq"].reset_index(drop=True)
     hists = df[df["experimental_strategy"] == "Diagnostic Slide"].reset_index(drop=True)
@@ -234,110 +480,117 @@ def get_expr_hist_metadata():
     return exprs, hists
 
 
-def get_clin_metadata():
-    response = requests.get(
-        "https://api.gdc.cancer.gov/cases",
-        params={
-            "filters": json.dumps(
+def get_clin_metadata(client):
+    total, pages = client.get_pages(
+        "cases",
+        filters={
+            "op": "and",
+            "content": [
                 {
-                    "op": "and",
-                    "content": [
-                        {
-                            "op": "in",
-                            "content": {
-                                "field": "cases.project.program.name",
-                                "value": ["TCGA"],
-                            },
-                        },
-                    ],
-                }
-            ),
-            "fields": ",".join(
-                [
-                    "project.project_id",
-                    "submitter_id",
-                    "diagnoses.age_at_diagnosis",
-                    "diagnoses.diagnosis_is_primary_disease",
-                    "demographic.days_to_death",
-                    "demographic.vital_status",
-                    "follow_ups.days_to_follow_up",
-                    "demographic.ethnicity",
-                    "demographic.gender",
-                    "demographic.race",
-                ]
-            ),
-            "format": "JSON",
-            "size": str(MAX_QUERY_SIZE),
+                    "op": "in",
+                    "content": {
+                        "field": "cases.project.program.name",
+                        "value": ["TCGA"],
+                    },
+                },
+            ],
         },
+        fields=[
+            "project.project_id",
+            "submitter_id",
+            "diagnoses.age_at_diagnosis",
+            "diagnoses.diagnosis_is_primary_disease",
+            "demographic.days_to_death",
+            "demographic.vital_status",
+            "follow_ups.days_to_follow_up",
+            "demographic.ethnicity",
+            "demographic.gender",
+            "demographic.race",
+        ],
+        sort="case_id:asc",
+        format="JSON",
     )
-    data = []
-    temp = json.loads(response.content)
-    for datum in temp["data"]["hits"]:
-        project = datum["project"]["project_id"]
-        case_id = datum["submitter_id"]
-        sex = np.nan
-        race = np.nan
-        ethnicity = np.nan
-        vital_status = np.nan
-        days_to_death = np.nan
-        if "demographic" in datum:
-            demo = datum["demographic"]
-            if "vital_status" in demo:
-                vital_status = demo.get("vital_status")
-            if "days_to_death" in demo:
-                days_to_death = demo["days_to_death"]
-            if "gender" in demo:
-                sex = demo["gender"]
-            if "race" in demo:
-                race = demo["race"]
-            if "ethnicity" in demo:
-                ethnicity = demo["ethnicity"]
-
-        age = np.nan
-        if "diagnoses" in datum:
-            count = 0
-            for x in datum["diagnoses"]:
-                # get age of primary diagnosis
-                if (
-                    "diagnosis_is_primary_disease" in x
-                    and x["diagnosis_is_primary_disease"]
-                ):
-                    count += 1
-                    aad = x["age_at_diagnosis"]
-                    if isinstance(aad, int):
-                        age = aad / 365
-            if count > 1:
-                print(f"Unclear how {case_id} has multiple primaries:")
-                print(datum["diagnoses"])
+    # each page is parsed as it arrives and dropped before the next
+    with stage("parse_cases", items=total):
+        columns = parse_clin_pages(pages)
+    check_total("cases", len(columns["case_id"]), total)
+    with stage("filter_cases", items=total):
+        clins = filter_clin_columns(columns)
+
+    print("Retrieved Clinical data")
+    return clins
 
-        days_to_last_follow_up = np.nan
-        if "follow_ups" in datum:
-            for x in datum["follow_ups"]:
-                fu_dt = x["days_to_follow_up"]
-                # get latest f/u
-                if isinstance(fu_dt, int):
-                    if (
-                        np.isnan(days_to_last_follow_up)
-                        or fu_dt > days_to_last_follow_up
-                    ):
-                        days_to_last_follow_up = fu_dt
-
-        data.append(
-            {
-                "case_id": case_id,
-                "project": project,
-                "sex": sex,
-                "age": age,
-                "race": race,
-                "ethnicity": ethnicity,
-                "vital_status": vital_status,
-                "days_to_death": days_to_death,
-                "days_to_last_follow_up": days_to_last_follow_up,
-            }
-        )
-    clins = pd.DataFrame(data)
-    df_len_check(clins)
 
+CLIN_STR_COLUMNS = ["case_id", "project", "sex", "race", "ethnicity", "vital_status"]
+CLIN_NUM_COLUMNS = ["age", "days_to_death", "days_to_last_follow_up"]
+
+
+def iter_json_hits(page):
+    # decode hits of a single GDC JSON page one at a time rather than the
+    # whole page
+    text = page.decode() if isinstance(page, bytes) else page
+    decoder = json.JSONDecoder()
+    idx = text.index("[", text.index('"hits"')) + 1
+    while True:
+        while text[idx] in " \t\n\r,":
+            idx += 1
+        if text[idx] == "]":
+            return
+        hit, idx = decoder.raw_decode(text, idx)
+        yield hit
+
+
+def parse_clin_pages(pages):
+    columns = {col: [] for col in CLIN_STR_COLUMNS + CLIN_NUM_COLUMNS}
+    for page in pages:
+        for datum in iter_json_hits(page):
+            case_id = datum["submitter_id"]
+            demo = datum.get("demographic", {})
+            columns["case_id"].append(case_id)
+            columns["project"].append(datum["project"]["project_id"])
+            columns["sex"].append(demo.get("gender"))
+            columns["race"].append(demo.get("race"))
+            columns["ethnicity"].append(demo.get("ethnicity"))
+            columns["vital_status"].append(demo.get("vital_status"))
+            columns["days_to_death"].append(demo.get("days_to_death"))
+
+            # get age of primary diagnosis
+            age = None
+            primaries = [
+                x
+                for x in datum.get("diagnoses", [])
+                if x.get("diagnosis_is_primary_disease")
+            ]
+            for x in primaries:
+                if isinstance(x["age_at_diagnosis"], int):
+                    age = x["age_at_diagnosis"] / 365
+            if len(primaries) > 1:
+                print(f"Unclear how {case_id} has multiple primaries:")
+                print(datum["diagnoses"])
+            columns["age"].append(age)
+
+            # get latest f/u
+            follow_ups = [
+                x["days_to_follow_up"]
+                for x in datum.get("follow_ups", [])
+                if isinstance(x["days_to_follow_up"], int)
+            ]
+            columns["days_to_last_follow_up"].append(
+                max(follow_ups) if len(follow_ups) > 0 else None
+            )
+
+    # None becomes nan in the numeric columns
+    return {
+        col: np.array(values, dtype=np.float64 if col in CLIN_NUM_COLUMNS else object)
+        for col, values in columns.items()
+    }
+
+
+def filter_clin_columns(columns):
+    dead = columns["vital_status"] == "Dead"
+    alive = columns["vital_status"] == "Alive"
+    d2d = columns["days_to_death"]
+    d2f = columns["days_to_last_follow_up"]
     # dead = vital_status == "Dead"
     # d2d = days_to_death not nan
     # d2f = days_to_last_follow_up not nan
@@ -350,28 +603,117 @@ def get_clin_metadata():
     #    F   T   F       F # dead xnor d2d
     #    F   F   T       T
     #    F   F   F       F # d2d or d2f
-    clins = clins[
-        ~((clins["vital_status"] == "Dead") ^ clins["days_to_death"].notna())
-    ].reset_index(drop=True)
-    clins = clins[
-        clins["days_to_death"].notna() | clins["days_to_last_follow_up"].notna()
-    ].reset_index(drop=True)
+    # additionally require age and sex, and non-negative times
+    with np.errstate(invalid="ignore"):
+        include = (
+            ~(dead ^ ~np.isnan(d2d))
+            & (~np.isnan(d2d) | ~np.isnan(d2f))
+            & ~np.isnan(columns["age"])
+            & pd.notna(columns["sex"])
+            & ((dead & (d2d >= 0)) | (alive & (d2f >= 0)))
+        )
 
+    clins = pd.DataFrame({col: columns[col][include] for col in columns})
     for col in ["race", "ethnicity"]:
         clins[col] = clins[col].fillna("not reported")
-
-    clins = clins[(clins["age"].notna()) & (clins["sex"].notna())]
     clins = clins[
-        ((clins["vital_status"] == "Dead") & (clins["days_to_death"] >= 0))
-        | ((clins["vital_status"] == "Alive") & (clins["days_to_last_follow_up"] >= 0))
+        [
+            "case_id",
+            "project",
+            "sex",
+            "age",
+            "race",
+            "ethnicity",
+            "vital_status",
+            "days_to_death",
+            "days_to_last_follow_up",
+        ]
     ]
-
     clins = clins.sort_values(["project", "case_id"]).reset_index(drop=True)
-
-    print("Retrieved Clinical data")
     return clins
 
 
+def make_synthetic_clin_hit(row, case_id, variant):
+    # GDC-shaped case from a row of the clinical CSV, variants other than 0
+    # are broken in a way that must exclude the case
+    demo = {
+        "gender": row["sex"],
+        "race": None if row["race"] == "not reported" else row["race"],
+        "ethnicity": row["ethnicity"],
+        "vital_status": row["vital_status"],
+    }
+    if not np.isnan(row["days_to_death"]):
+        demo["days_to_death"] = int(row["days_to_death"])
+    diagnoses = [
+        {
+            "age_at_diagnosis": round(row["age"] * 365),
+            "diagnosis_is_primary_disease": True,
+        },
+        {"age_at_diagnosis": 1, "diagnosis_is_primary_disease": False},
+    ]
+    follow_ups = [{"days_to_follow_up": None}]
+    if not np.isnan(row["days_to_last_follow_up"]):
+        d2f = int(row["days_to_last_follow_up"])
+        follow_ups += [{"days_to_follow_up": d2f}, {"days_to_follow_up": d2f // 2}]
+
+    if variant == 1:  # dead without days to death or alive with it
+        if row["vital_status"] == "Dead":
+            demo.pop("days_to_death", None)
+        else:
+            demo["days_to_death"] = 1
+    elif variant == 2:  # no primary diagnosis age
+        diagnoses[0]["age_at_diagnosis"] = None
+    elif variant == 3:  # negative time to event
+        demo["days_to_death"] = -1
+        demo["vital_status"] = "Dead"
+    return {
+        "project": {"project_id": row["project"]},
+        "submitter_id": case_id,
+        "demographic": demo,
+        "diagnoses": diagnoses,
+        "follow_ups": follow_ups,
+    }
+
+
+def benchmark_clinical(clinical_data, n_cases, page_size):
+    clins = pd.read_csv(clinical_data)
+    rows = clins.to_dict("records")
+    variants = np.random.default_rng(42).integers(0, 4, size=n_cases)
+    case_ids = [f"{rows[i % len(rows)]['case_id']}-{i}" for i in range(n_cases)]
+    gen_time = [0.0]
+
+    def pages():
+        # payload pages are generated lazily, generation time is not counted
+        for lo in range(0, n_cases, page_size):
+            start = time.perf_counter()
+            hits = [
+                make_synthetic_clin_hit(rows[i % len(rows)], case_ids[i], variants[i])
+                for i in range(lo, min(lo + page_size, n_cases))
+            ]
+            page = json.dumps({"data": {"hits": hits}}).encode()
+            gen_time[0] += time.perf_counter() - start
+            yield page
+
+    start = time.perf_counter()
+    with stage("parse_cases", items=n_cases):
+        columns = parse_clin_pages(pages())
+    parse_time = time.perf_counter() - gen_time[0] - start
+    start = time.perf_counter()
+    with stage("filter_cases", items=n_cases):
+        result = filter_clin_columns(columns)
+    filter_time = time.perf_counter() - start
+
+    keep = np.flatnonzero(variants == 0)
+    expected = pd.DataFrame([rows[i % len(rows)] for i in keep])
+    expected["case_id"] = [case_ids[i] for i in keep]
+    expected = expected.sort_values(["project", "case_id"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected)
+
+    print(f"{n_cases} synthetic cases, {len(result)} included, matches reference")
+    print(f"Parse: {parse_time:.2f}s ({n_cases / parse_time:.0f} cases/sec)")
+    print(f"Filter: {filter_time:.2f}s ({n_cases / filter_time:.0f} cases/sec)")
+
+
 if __name__ == "__main__":
     args = parse_args()
     main(args)
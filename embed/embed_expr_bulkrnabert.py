@@ -1,91 +1,377 @@
 import argparse
+import functools
+import json
 import os
+import sys
+import tempfile
+import time
 from pathlib import Path
 
 import h5py
-import haiku as hk
-import jax
-import jax.numpy as jnp
 import numpy as np
 import pandas as pd
-from multiomics_open_research.bulk_rna_bert.preprocess import (
-    preprocess_rna_seq_for_bulkrnabert,
-    preprocess_tcga_rna_seq_dataset,
-)
-from multiomics_open_research.bulk_rna_bert.pretrained import get_pretrained_model
-from tqdm import trange
+from tqdm import tqdm, trange
+
+# stage profiling is shared with the data and experiment scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
+
+from embed_utils import add_plan_argument, plan_missing, write_embeddings
+from expr_ingest import CACHE_COLUMNS, ExprCache, find_expr_files, find_expr_keys
+from profiling import add_profile_argument, enable_profiling, stage
+from quantization import add_quantization_argument
+
+# the expression cache is checked against the library preprocessing the first
+# time it is used, and the result is recorded next to its matrices
+CHECK_SAMPLES = 8
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--dataset-folder", required=True)
-    parser.add_argument("--preprocessed-cache", default="preprocessed_genes.csv")
+    parser.add_argument(
+        "--expr-cache",
+        default="expr-cache",
+        help="Directory of expression matrix caches shared with UCE.",
+    )
+    parser.add_argument(
+        "--expr-manifest",
+        default=None,
+        help="GDC manifest whose md5s identify the downloaded files in the cache key.",
+    )
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
     parser.add_argument("--output-h5", required=True)
     parser.add_argument("--gene-list", required=True)
-    parser.add_argument("--rna-seq-column", default="tpm_unstranded")
+    parser.add_argument(
+        "--rna-seq-column", default="tpm_unstranded", choices=list(CACHE_COLUMNS)
+    )
     parser.add_argument("--model-name", default="bulk_rna_bert_gtex_encode")
     parser.add_argument("--weights-folder", required=True)
     parser.add_argument("--aggregation", required=True, choices=["mean", "max"])
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="Run a jitted forward over fixed-shape batches, otherwise one sample at a time.",
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        default=None,
+        help="Compare throughput of the batched and per-sample paths on this many samples, then exit.",
+    )
+    parser.add_argument(
+        "--check-preprocessing",
+        type=int,
+        default=None,
+        help=(
+            "Compare the cached expression of the first N samples with "
+            "preprocess_tcga_rna_seq_dataset on the same files, then exit. "
+            f"The first {CHECK_SAMPLES} samples are checked automatically "
+            "the first time a cache is used."
+        ),
+    )
+    add_quantization_argument(parser)
+    add_plan_argument(parser)
+    add_profile_argument(parser)
     args = parser.parse_args()
     return args
 
 
+def aggregate(embs, aggregation):
+    # works on numpy and jax arrays alike, gene axis=1
+    if aggregation == "mean":
+        return embs.mean(axis=1)
+    elif aggregation == "max":
+        return embs.max(axis=1)
+    else:
+        raise ValueError(f"Unknown aggregation method: {aggregation}")
+
+
+def embed_per_sample(parameters, forward_fn, tokenizer, rna_seq_array, aggregation):
+    # yields the start index and embeddings of each sample as it completes
+    import jax
+    import jax.numpy as jnp
+
+    random_key = jax.random.PRNGKey(0)
+    for i in trange(len(rna_seq_array)):
+        batch_array = rna_seq_array[i : i + 1]  # requires batch dim
+        with stage("tokenize", items=1):
+            tokens_ids = tokenizer.batch_tokenize(batch_array)
+        with stage("forward", items=1):
+            tokens = jnp.asarray(tokens_ids, dtype=jnp.int32)
+            outs = forward_fn.apply(parameters, random_key, tokens)
+            emb = np.array(outs["embeddings_4"])  # (Batch, Genes, Hidden)
+            emb = aggregate(emb, aggregation)
+        yield i, emb
+
+
+@functools.lru_cache
+def make_embed_fn(forward_fn, aggregation):
+    # built once per model and aggregation, so warmup calls compile the
+    # forward that later calls with the same batch shape reuse
+    import jax
+
+    random_key = jax.random.PRNGKey(0)
+
+    # aggregate on device so only (Batch, Hidden) is copied back to host
+    @jax.jit
+    def embed_fn(parameters, tokens):
+        outs = forward_fn.apply(parameters, random_key, tokens)
+        return aggregate(outs["embeddings_4"], aggregation)
+
+    return embed_fn
+
+
+def embed_batched(
+    parameters, forward_fn, tokenizer, rna_seq_array, aggregation, batch_size
+):
+    # yields the start index and embeddings of each batch as it completes
+    import jax.numpy as jnp
+
+    embed_fn = make_embed_fn(forward_fn, aggregation)
+    with stage("tokenize", items=len(rna_seq_array)):
+        tokens_ids = tokenizer.batch_tokenize(rna_seq_array)
+        tokens_ids = np.asarray(tokens_ids, dtype=np.int32)
+    n = len(tokens_ids)
+    # pad the last batch with repeats of the first sample so every batch
+    # has the same shape and the forward is only compiled once
+    n_pad = -n % batch_size
+    if n_pad > 0:
+        tokens_ids = np.concatenate([tokens_ids, tokens_ids[:1].repeat(n_pad, axis=0)])
+    for i in tqdm(range(0, n, batch_size)):
+        with stage("forward", items=min(batch_size, n - i)):
+            tokens = jnp.asarray(tokens_ids[i : i + batch_size])
+            embs = np.asarray(embed_fn(parameters, tokens))
+        yield i, embs[: n - i]
+
+
+def collect(batches) -> np.ndarray:
+    return np.concatenate([embs for _, embs in batches], axis=0)
+
+
+def benchmark(
+    parameters, forward_fn, tokenizer, rna_seq_array, aggregation, batch_size
+):
+    import jax
+
+    # warmup compiles so that only steady-state throughput is compared
+    collect(
+        embed_batched(
+            parameters,
+            forward_fn,
+            tokenizer,
+            rna_seq_array[:1],
+            aggregation,
+            batch_size,
+        )
+    )
+    collect(
+        embed_per_sample(
+            parameters, forward_fn, tokenizer, rna_seq_array[:1], aggregation
+        )
+    )
+
+    n = len(rna_seq_array)
+    start = time.perf_counter()
+    batched = collect(
+        embed_batched(
+            parameters, forward_fn, tokenizer, rna_seq_array, aggregation, batch_size
+        )
+    )
+    batched_time = time.perf_counter() - start
+    start = time.perf_counter()
+    per_sample = collect(
+        embed_per_sample(parameters, forward_fn, tokenizer, rna_seq_array, aggregation)
+    )
+    per_sample_time = time.perf_counter() - start
+
+    print(f"Benchmarked {n} samples on {jax.default_backend()}")
+    print(f"Per-sample: {n / per_sample_time:.2f} samples/sec")
+    print(f"Batched (batch size {batch_size}): {n / batched_time:.2f} samples/sec")
+    print(f"Speedup: {per_sample_time / batched_time:.2f}x")
+    print(f"Max abs difference: {np.abs(batched - per_sample).max():.3e}")
+
+
+def check_preprocessing(
+    dataset_folder, matrix, reference_gene_ids, rna_seq_column, n_samples
+):
+    # the cache replaced the library's per-file preprocessing of the TSVs,
+    # so compare its rows with the library on a copy of the first files.
+    # both hold untransformed values, preprocess_rna_seq_for_bulkrnabert
+    # applies the model's transform afterwards either way
+    from multiomics_open_research.bulk_rna_bert.preprocess import (
+        preprocess_tcga_rna_seq_dataset,
+    )
+
+    # cache rows follow the sorted file listing
+    fpaths = sorted(find_expr_files(dataset_folder))[:n_samples]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_folder = os.path.join(tmp_dir, "expr")
+        for _, fpath in fpaths:
+            link = os.path.join(tmp_folder, os.path.relpath(fpath, dataset_folder))
+            os.makedirs(os.path.dirname(link), exist_ok=True)
+            os.symlink(os.path.abspath(fpath), link)
+        df = preprocess_tcga_rna_seq_dataset(
+            dataset_path=Path(tmp_folder),
+            output_file=os.path.join(tmp_dir, "preprocessed.csv"),
+            reference_gene_ids=reference_gene_ids,
+            rna_seq_column=rna_seq_column,
+        )
+
+    case_ids, file_ids = find_expr_keys(dataset_folder)
+    keys = list(zip(case_ids, file_ids))[:n_samples]
+    df = df.set_index(["case_id", "identifier"])
+    gene_ids = df.columns.astype(str).to_list()
+    if gene_ids != reference_gene_ids:
+        raise ValueError(
+            f"Library preprocessing has {len(gene_ids)} genes in a different "
+            f"order than the {len(reference_gene_ids)} of the gene list"
+        )
+    missing = [key for key in keys if key not in df.index]
+    if len(missing) > 0:
+        raise ValueError(f"Library preprocessing is missing samples: {missing[:5]}")
+    expected = df.loc[keys, reference_gene_ids].to_numpy(dtype=np.float64)
+    actual = np.asarray(matrix[: len(keys)], dtype=np.float64)
+    diff = np.abs(actual - expected)
+    print(
+        f"Checked {len(keys)} samples x {len(gene_ids)} genes against "
+        f"preprocess_tcga_rna_seq_dataset, max abs difference {diff.max():.3e}"
+    )
+    if not np.allclose(actual, expected):
+        i, j = np.unravel_index(diff.argmax(), diff.shape)
+        raise ValueError(
+            f"Cached {rna_seq_column} differs from the library preprocessing, "
+            f"e.g. {keys[i]} {gene_ids[j]}: {actual[i, j]} vs {expected[i, j]}"
+        )
+    return {
+        "rna_seq_column": rna_seq_column,
+        "n_samples": len(keys),
+        "n_genes": len(gene_ids),
+        "max_abs_difference": float(diff.max()),
+    }
+
+
+def get_check_path(cache_path: str, rna_seq_column: str) -> str:
+    return os.path.join(cache_path, f"preprocessing-check-{rna_seq_column}.json")
+
+
 def main(args):
+    enable_profiling(args.profile)
+    check = args.benchmark is not None or args.check_preprocessing is not None
+    if not check:
+        # output keys are checked against the file listing before the
+        # expression cache, model or preprocessing are touched
+        case_ids, file_ids = find_expr_keys(args.dataset_folder)
+        missing = plan_missing(args.output_h5, case_ids, file_ids, "samples")
+        if args.plan or len(missing) == 0:
+            return
+        todo = {(case_ids[i], file_ids[i]) for i in missing}
+
+    import haiku as hk
+    from multiomics_open_research.bulk_rna_bert.preprocess import (
+        preprocess_rna_seq_for_bulkrnabert,
+    )
+    from multiomics_open_research.bulk_rna_bert.pretrained import get_pretrained_model
+
     with open(args.gene_list, "r") as f:
         reference_gene_ids = [line.strip() for line in f.readlines()]
 
-    if os.path.exists(args.preprocessed_cache):
-        print("Using cached preprocessed dataset")
-        df = pd.read_csv(args.preprocessed_cache)
-    else:
-        print("Preprocessing dataset")
-        df = preprocess_tcga_rna_seq_dataset(
-            dataset_path=Path(args.dataset_folder),
-            output_file=args.preprocessed_cache,
-            reference_gene_ids=reference_gene_ids,
-            rna_seq_column=args.rna_seq_column,
+    with stage("expr_cache"):
+        expr_cache = ExprCache.load(
+            dataset_folder=args.dataset_folder,
+            cache_root=args.expr_cache,
+            gene_type=None,
+            gene_list=reference_gene_ids,
+            manifest=args.expr_manifest,
+            num_workers=args.num_workers,
         )
-    df = df.sort_values(["case_id", "identifier"]).reset_index(drop=True)
+    check_path = get_check_path(expr_cache.path, args.rna_seq_column)
+    if args.check_preprocessing is not None or not os.path.exists(check_path):
+        # a mismatch raises before the record is written, so every run
+        # fails until the cache and the library agree
+        with stage("check_preprocessing"):
+            result = check_preprocessing(
+                args.dataset_folder,
+                expr_cache.matrices[args.rna_seq_column],
+                reference_gene_ids,
+                args.rna_seq_column,
+                args.check_preprocessing or CHECK_SAMPLES,
+            )
+        with open(check_path, "w") as f:
+            json.dump(result, f, indent=2)
+        if args.check_preprocessing is not None:
+            return
 
-    parameters, forward_fn, tokenizer, config = get_pretrained_model(
-        model_name=args.model_name,
-        embeddings_layers_to_save=(4,),
-        checkpoint_directory=args.weights_folder,
+    files = expr_cache.files
+    if not check:
+        # only the samples missing from the output are read and preprocessed
+        rows = [
+            i
+            for i, key in enumerate(zip(files["case_id"], files["file_id"]))
+            if key in todo
+        ]
+    else:
+        rows = list(range(len(files)))
+    df = pd.DataFrame(
+        expr_cache.matrices[args.rna_seq_column][rows], columns=reference_gene_ids
     )
+    df["case_id"] = files["case_id"].iloc[rows].to_list()
+    df["identifier"] = files["file_id"].iloc[rows].to_list()
+    df = df.sort_values(["case_id", "identifier"]).reset_index(drop=True)
+
+    with stage("load_model"):
+        parameters, forward_fn, tokenizer, config = get_pretrained_model(
+            model_name=args.model_name,
+            embeddings_layers_to_save=(4,),
+            checkpoint_directory=args.weights_folder,
+        )
     forward_fn = hk.transform(forward_fn)
 
     case_ids = df["case_id"].to_list()
     file_ids = df["identifier"].to_list()
     df = df.drop(columns=["identifier", "case_id"])
 
-    rna_seq_array = preprocess_rna_seq_for_bulkrnabert(df, config)
-    random_key = jax.random.PRNGKey(0)
+    with stage("preprocess", items=len(df)):
+        rna_seq_array = preprocess_rna_seq_for_bulkrnabert(df, config)
+
+    if args.benchmark is not None:
+        benchmark(
+            parameters,
+            forward_fn,
+            tokenizer,
+            rna_seq_array[: args.benchmark],
+            args.aggregation,
+            args.batch_size or 8,
+        )
+        return
 
     print("Generating embeddings")
-    if os.path.exists(args.output_h5):
-        print(f"Output H5 already exists, will not overwrite existing keys")
+    if args.batch_size is None:
+        batches = embed_per_sample(
+            parameters,
+            forward_fn,
+            tokenizer,
+            rna_seq_array,
+            args.aggregation,
+        )
+    else:
+        batches = embed_batched(
+            parameters,
+            forward_fn,
+            tokenizer,
+            rna_seq_array,
+            args.aggregation,
+            args.batch_size,
+        )
+    # each batch is written as it completes, so an interrupted run only
+    # loses the batch in progress and reruns skip what was written
     with h5py.File(args.output_h5, mode="a") as h5:
-        for i in trange(len(df)):
-            case_id = case_ids[i]
-            file_id = file_ids[i]
-            if case_id in h5 and file_id in h5[case_id]:
-                print(f"{case_id}/{file_id} already exists, skipping")
-                continue
-            elif case_id not in h5:
-                h5.create_group(case_id)
-            batch_array = rna_seq_array[i : i + 1]  # requires batch dim
-            tokens_ids = tokenizer.batch_tokenize(batch_array)
-            tokens = jnp.asarray(tokens_ids, dtype=jnp.int32)
-            outs = forward_fn.apply(parameters, random_key, tokens)
-            embs = np.array(outs["embeddings_4"])  # (Batch, Genes, Hidden)
-            if args.aggregation == "mean":
-                embs = embs.mean(axis=1)  # along gene axis=1
-            elif args.aggregation == "max":
-                embs = embs.max(axis=1)
-            else:
-                raise ValueError(f"Unknown aggregation method: {args.aggregation}")
-            emb = embs[0]  # unwrap batch dim
-            h5[case_id].create_dataset(file_id, data=emb)
+        for lo, embs in batches:
+            hi = lo + len(embs)
+            write_embeddings(
+                h5, case_ids[lo:hi], file_ids[lo:hi], embs, args.quantization
+            )
+            h5.flush()
 
 
 if __name__ == "__main__":
@@ -1,13 +1,18 @@
 import argparse
 import os
+import sys
 import tempfile
 
-import anndata
 import h5py
 import pandas as pd
-from accelerate import Accelerator
-from tqdm import tqdm, trange
-from uce.evaluate import AnndataProcessor
+
+# stage profiling is shared with the data and experiment scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
+
+from embed_utils import add_plan_argument, plan_missing, write_embeddings
+from expr_ingest import ExprCache, find_expr_keys
+from profiling import add_profile_argument, enable_profiling, stage
+from quantization import add_quantization_argument
 
 
 def parse_args(tmp_dir):
@@ -15,11 +20,23 @@ def parse_args(tmp_dir):
     parser.add_argument("--dataset-folder", required=True)
     parser.add_argument("--output-h5", required=True)
     parser.add_argument("--weights-folder", required=True)
-    parser.add_argument("--preprocessed-cache", default="for_uce.h5ad")
+    parser.add_argument(
+        "--expr-cache",
+        default="expr-cache",
+        help="Directory of expression matrix caches shared with BulkRNABert.",
+    )
+    parser.add_argument(
+        "--expr-manifest",
+        default=None,
+        help="GDC manifest whose md5s identify the downloaded files in the cache key.",
+    )
     parser.add_argument("--batch-size", type=int, default=25)
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    add_quantization_argument(parser)
+    add_plan_argument(parser)
+    add_profile_argument(parser)
     args = parser.parse_args()
 
-    args.adata_path = args.preprocessed_cache
     args.dir = os.path.join(tmp_dir, "")  # trailing slash
     args.species = "human"
     args.filter = True
@@ -48,84 +65,84 @@ def parse_args(tmp_dir):
     return args
 
 
-def prepare_adata_for_uce(dataset_folder, preprocessed_cache, debug=None):
-    fpaths = []
-    for root, _, files in os.walk(dataset_folder):
-        for f in files:
-            if f.endswith(".tsv"):
-                case_id = root.replace(dataset_folder, "").lstrip("/").split("/")[0]
-                fpath = os.path.join(root, f)
-                fpaths.append((case_id, fpath))
-    if debug is not None:
-        fpaths = fpaths[:debug]
-    exps = []
-    for case_id, fpath in tqdm(fpaths):
-        df = pd.read_csv(fpath, sep="\t", skiprows=1)
-        exp = df.loc[
-            df["gene_type"] == "protein_coding", ["gene_name", "gene_id", "unstranded"]
-        ]
-        exp = exp.sort_values(["gene_name", "gene_id"]).set_index("gene_name")
-        exp.index.name = None
-        exp = exp.T.rename(index={"unstranded": case_id})
-        exps.append(exp.loc[[case_id]].astype(int))
-    for e in exps:
-        assert (e.columns == exps[0].columns).all()
-    X = pd.concat(exps)
-
-    # sum together duplicate genes
-    X = X.T.groupby(level=0).sum().T
+def prepare_adata_for_uce(expr_cache, preprocessed_h5ad):
+    import anndata
 
+    # protein coding genes sorted by name with duplicate names summed
+    X, var_names = expr_cache.sum_duplicate_genes("unstranded")
     obs = pd.DataFrame(
-        {"file_id": [os.path.basename(fpath).split(".")[0] for _, fpath in fpaths]},
-        index=[case_id for case_id, _ in fpaths],
+        {"file_id": expr_cache.files["file_id"].to_list()},
+        index=expr_cache.files["case_id"].to_list(),
     )
-    adata = anndata.AnnData(X, obs=obs)
+    var = pd.DataFrame(index=var_names)
+    adata = anndata.AnnData(X, obs=obs, var=var)
 
-    adata.write_h5ad(preprocessed_cache)
+    adata.write_h5ad(preprocessed_h5ad)
     return adata
 
 
 def main(args):
-    if os.path.exists(args.preprocessed_cache):
-        print("Using cached preprocessed dataset")
-        adata = anndata.read_h5ad(args.preprocessed_cache)
-    else:
-        print("Preprocessing dataset")
-        adata = prepare_adata_for_uce(
-            dataset_path=args.dataset_folder,
-            preprocessed_cache=args.preprocessed_cache,
-            # debug=100,
+    enable_profiling(args.profile)
+    # output keys are checked against the file listing before the expression
+    # cache, model or UCE preprocessing are touched
+    case_ids, file_ids = find_expr_keys(args.dataset_folder)
+    missing = plan_missing(args.output_h5, case_ids, file_ids, "samples")
+    if args.plan or len(missing) == 0:
+        return
+
+    import anndata
+
+    with stage("expr_cache"):
+        expr_cache = ExprCache.load(
+            dataset_folder=args.dataset_folder,
+            cache_root=args.expr_cache,
+            gene_type="protein_coding",
+            manifest=args.expr_manifest,
+            num_workers=args.num_workers,
         )
+    # derived from the cache entry so it is rebuilt along with it
+    args.adata_path = os.path.join(expr_cache.path, "for_uce.h5ad")
+    if not os.path.exists(args.adata_path):
+        print("Preparing dataset for UCE")
+        with stage("prepare_adata"):
+            prepare_adata_for_uce(expr_cache, args.adata_path)
+    if len(missing) < len(case_ids):
+        # only the samples missing from the output are passed to UCE
+        todo = {file_ids[i] for i in missing}
+        adata = anndata.read_h5ad(args.adata_path)
+        adata = adata[adata.obs["file_id"].isin(todo).to_numpy()]
+        args.adata_path = os.path.join(args.dir, "for_uce.h5ad")
+        adata.write_h5ad(args.adata_path)
+
+    # model dependencies are only needed here, so the preparation above can
+    # run without them
+    from accelerate import Accelerator
+    from uce.evaluate import AnndataProcessor
 
     print("Generating embeddings")
     accelerator = Accelerator(project_dir=args.dir)
     processor = AnndataProcessor(args, accelerator)
-    processor.preprocess_anndata()
-    processor.generate_idxs()
-    processor.run_evaluation()
+    with stage("preprocess"):
+        processor.preprocess_anndata()
+        processor.generate_idxs()
+    with stage("embed", items=len(missing)):
+        processor.run_evaluation()
 
     print("Organizing results")
     uce_h5ad = os.path.join(
-        tmp_dir,
-        os.path.basename(args.preprocessed_cache).replace(".h5ad", "_uce_adata.h5ad"),
+        args.dir,
+        os.path.basename(args.adata_path).replace(".h5ad", "_uce_adata.h5ad"),
     )
     uce_adata = anndata.read_h5ad(uce_h5ad)
-
     df = uce_adata.obs.reset_index(names="case_id")
-
-    if os.path.exists(args.output_h5):
-        print(f"Output H5 already exists, will not overwrite existing keys")
     with h5py.File(args.output_h5, mode="a") as h5:
-        for i in trange(len(df)):
-            case_id = df["case_id"].iloc[i]
-            file_id = df["file_id"].iloc[i]
-            if case_id in h5 and file_id in h5[case_id]:
-                print(f"{case_id}/{file_id} already exists, skipping")
-                continue
-            elif case_id not in h5:
-                h5.create_group(case_id)
-            emb = uce_adata.obsm["X_uce"][i]
-            h5[case_id].create_dataset(file_id, data=emb)
+        write_embeddings(
+            h5,
+            df["case_id"].to_list(),
+            df["file_id"].to_list(),
+            uce_adata.obsm["X_uce"],
+            args.quantization,
+        )
 
 
 if __name__ == "__main__":
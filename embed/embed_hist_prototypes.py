@@ -0,0 +1,330 @@
+import argparse
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import IncrementalPCA
+from tqdm import tqdm
+
+# stage profiling is shared with the data and experiment scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
+
+from embed_hist_uni2 import find_slides
+from embed_utils import add_plan_argument, get_existing_keys, write_embeddings
+from profiling import add_profile_argument, enable_profiling, profiled, stage
+from quantization import add_quantization_argument
+
+# Dataset-wide reduction of UNI2 tile features in three streaming passes:
+#   1. IncrementalPCA (whitened by default) fit on batches of tiles
+#   2. mini-batch k-means prototypes fit on the reduced tiles
+#   3. per slide, the histogram of nearest prototypes and the mean reduced
+#      tile, saved to <output>-histogram.h5 and <output>-mean.h5
+# The fits read tile chunks in a seeded random order, so each batch mixes
+# tiles of many slides. Chunks are read by worker processes with a bounded
+# number in flight, so memory does not depend on the number of tiles. The
+# fitted transform is saved to <output>-model.npz and reused by later runs,
+# which only embed the slides missing from the outputs
+MODEL_KEYS = ["mean", "components", "scale", "centroids"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset-folder", required=True)
+    parser.add_argument(
+        "--output-h5",
+        required=True,
+        help=(
+            "Outputs are named after this path with -histogram, -mean and "
+            "-model (the fitted transform) as suffixes."
+        ),
+    )
+    parser.add_argument("--n-components", type=int, default=64)
+    parser.add_argument("--n-prototypes", type=int, default=32)
+    parser.add_argument(
+        "--no-whiten",
+        action="store_true",
+        help="Keep the variance of the principal components.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=4096,
+        help="Number of tiles read from a slide at a time.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=32768,
+        help="Number of tiles per IncrementalPCA and k-means update.",
+    )
+    parser.add_argument(
+        "--max-fit-tiles",
+        type=int,
+        default=None,
+        help="Fit on this many randomly chosen tiles (in chunks), all by default.",
+    )
+    parser.add_argument(
+        "--kmeans-epochs",
+        type=int,
+        default=1,
+        help="Passes over the fit tiles for the k-means prototypes.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=None,
+        help="Chunks read ahead of the fits, twice the workers by default.",
+    )
+    add_quantization_argument(parser)
+    add_plan_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    if args.batch_size < max(args.n_components, args.n_prototypes):
+        parser.error("--batch-size must be at least --n-components and --n-prototypes")
+    return args
+
+
+def get_output_paths(output_h5: str) -> dict[str, str]:
+    root, ext = os.path.splitext(output_h5)
+    return {
+        "histogram": f"{root}-histogram{ext}",
+        "mean": f"{root}-mean{ext}",
+        "model": f"{root}-model.npz",
+    }
+
+
+def count_tiles(file_path: str) -> int:
+    with h5py.File(file_path, "r") as h5:
+        return h5["features"].shape[-2]
+
+
+def read_chunk(features: h5py.Dataset, lo: int, hi: int) -> np.ndarray:
+    # features are 1 x num_patches x 1536 or num_patches x 1536
+    with stage("read_tiles", items=hi - lo):
+        if features.ndim == 3:
+            chunk = features[0, lo:hi]
+        else:
+            chunk = features[lo:hi]
+    return chunk.astype(np.float32)
+
+
+def transform(chunk: np.ndarray, model: dict) -> np.ndarray:
+    return (chunk - model["mean"]) @ model["components"].T / model["scale"]
+
+
+def nearest(z: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # squared distances up to the constant |z|^2
+    distances = (centroids**2).sum(axis=1) - 2 * z @ centroids.T
+    return distances.argmin(axis=1)
+
+
+_worker_state = dict()
+
+
+def _init_worker(model):
+    _worker_state["model"] = model
+
+
+def _read_fit_chunk(file_path: str, lo: int, hi: int) -> np.ndarray:
+    # raw tiles before the transform is fit, reduced tiles after
+    with h5py.File(file_path, "r") as h5:
+        chunk = read_chunk(h5["features"], lo, hi)
+    if "model" in _worker_state:
+        chunk = transform(chunk, _worker_state["model"]).astype(np.float32)
+    return chunk
+
+
+@profiled("embed_slide")
+def _embed_slide(file_path: str, chunk_size: int) -> tuple[np.ndarray, np.ndarray]:
+    # prototype frequencies and mean reduced tile of one slide
+    model = _worker_state["model"]
+    n_prototypes = len(model["centroids"])
+    counts = np.zeros(n_prototypes, dtype=np.int64)
+    total = np.zeros(model["components"].shape[0], dtype=np.float64)
+    with h5py.File(file_path, "r") as h5:
+        features = h5["features"]
+        n_tiles = features.shape[-2]
+        for lo in range(0, n_tiles, chunk_size):
+            z = transform(read_chunk(features, lo, lo + chunk_size), model)
+            counts += np.bincount(
+                nearest(z, model["centroids"]), minlength=n_prototypes
+            )
+            total += z.sum(axis=0, dtype=np.float64)
+    histogram = (counts / max(n_tiles, 1)).astype(np.float32)
+    mean = (total / max(n_tiles, 1)).astype(np.float32)
+    return histogram, mean
+
+
+def iter_ordered(executor, fn, tasks, prefetch: int):
+    # results in task order with at most prefetch tasks in flight, so the
+    # fits are reproducible and buffered chunks stay bounded
+    futures = deque()
+    for task in tasks:
+        futures.append(executor.submit(fn, *task))
+        if len(futures) >= prefetch:
+            yield futures.popleft().result()
+    while len(futures) > 0:
+        yield futures.popleft().result()
+
+
+def iter_batches(chunks, batch_size: int, min_size: int):
+    # concatenated chunks of batch_size rows, a last batch smaller than
+    # min_size cannot update the fits and is dropped
+    buffer = []
+    n = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        n += len(chunk)
+        if n >= batch_size:
+            yield np.concatenate(buffer)
+            buffer = []
+            n = 0
+    if n >= min_size:
+        yield np.concatenate(buffer)
+
+
+def get_fit_tasks(slides, n_tiles, chunk_size, max_fit_tiles, seed):
+    # every chunk of every slide in a seeded random order, truncated to
+    # max_fit_tiles
+    tasks = [
+        (file_path, lo, min(lo + chunk_size, n))
+        for (_, _, file_path), n in zip(slides, n_tiles)
+        for lo in range(0, n, chunk_size)
+    ]
+    order = np.random.default_rng(seed).permutation(len(tasks))
+    tasks = [tasks[i] for i in order]
+    if max_fit_tiles is not None:
+        ends = np.cumsum([hi - lo for _, lo, hi in tasks])
+        tasks = tasks[: np.searchsorted(ends, max_fit_tiles) + 1]
+    return tasks
+
+
+def fit_model(args, slides, prefetch: int) -> dict:
+    with stage("count_tiles", items=len(slides)):
+        n_tiles = [count_tiles(file_path) for _, _, file_path in slides]
+    tasks = get_fit_tasks(
+        slides, n_tiles, args.chunk_size, args.max_fit_tiles, args.seed
+    )
+    n_fit_tiles = sum(hi - lo for _, lo, hi in tasks)
+    print(f"Fitting on {n_fit_tiles} of {sum(n_tiles)} tiles")
+
+    print("Fitting IncrementalPCA")
+    pca = IncrementalPCA(n_components=args.n_components)
+    with (
+        ProcessPoolExecutor(max_workers=args.num_workers) as executor,
+        tqdm(total=n_fit_tiles) as pbar,
+    ):
+        chunks = iter_ordered(executor, _read_fit_chunk, tasks, prefetch)
+        for batch in iter_batches(chunks, args.batch_size, args.n_components):
+            with stage("pca_fit", items=len(batch)):
+                pca.partial_fit(batch)
+            pbar.update(len(batch))
+    scale = np.ones(args.n_components)
+    if not args.no_whiten:
+        scale = np.sqrt(pca.explained_variance_)
+    model = {
+        "mean": pca.mean_.astype(np.float32),
+        "components": pca.components_.astype(np.float32),
+        "scale": scale.astype(np.float32),
+    }
+
+    print("Fitting k-means prototypes")
+    kmeans = MiniBatchKMeans(n_clusters=args.n_prototypes, random_state=args.seed)
+    with ProcessPoolExecutor(
+        max_workers=args.num_workers, initializer=_init_worker, initargs=(model,)
+    ) as executor:
+        for epoch in range(args.kmeans_epochs):
+            rng = np.random.default_rng([args.seed, epoch])
+            epoch_tasks = [tasks[i] for i in rng.permutation(len(tasks))]
+            chunks = iter_ordered(executor, _read_fit_chunk, epoch_tasks, prefetch)
+            with tqdm(total=n_fit_tiles, desc=f"Epoch {epoch + 1}") as pbar:
+                for batch in iter_batches(chunks, args.batch_size, args.n_prototypes):
+                    with stage("kmeans_fit", items=len(batch)):
+                        kmeans.partial_fit(batch)
+                    pbar.update(len(batch))
+    model["centroids"] = kmeans.cluster_centers_.astype(np.float32)
+    return model
+
+
+def main(args):
+    enable_profiling(args.profile)
+    prefetch = args.prefetch or 2 * args.num_workers
+    slides = find_slides(args.dataset_folder)
+    output_paths = get_output_paths(args.output_h5)
+
+    # outputs are read once, and only opened for writing when slides remain
+    with stage("plan", items=len(slides)):
+        existing = dict()
+        for name in ["histogram", "mean"]:
+            existing[name] = set()
+            if os.path.exists(output_paths[name]):
+                with h5py.File(output_paths[name], mode="r") as h5:
+                    existing[name] = get_existing_keys(h5)
+        todo = [
+            (case_id, file_id, file_path)
+            for case_id, file_id, file_path in slides
+            if any((case_id, file_id) not in keys for keys in existing.values())
+        ]
+    print(
+        f"{len(slides) - len(todo)} of {len(slides)} slides already embedded, "
+        f"{len(todo)} to embed"
+    )
+    if len(todo) == 0:
+        return
+    fitted = os.path.exists(output_paths["model"])
+    print(("Reusing " if fitted else "Fitting ") + output_paths["model"])
+    if args.plan:
+        return
+
+    if fitted:
+        model = dict(np.load(output_paths["model"]))
+    else:
+        # embeddings of slides already in the outputs came from another fit
+        if len(todo) < len(slides):
+            raise ValueError(
+                f"{output_paths['model']} is missing but the outputs hold "
+                "embeddings of an earlier fit, remove them to refit"
+            )
+        model = fit_model(args, slides, prefetch)
+        tmp_path = f"{output_paths['model']}.tmp.npz"
+        np.savez(tmp_path, **{k: model[k] for k in MODEL_KEYS})
+        os.replace(tmp_path, output_paths["model"])
+
+    print("Generating slide-level embeddings")
+    h5s = dict()
+    try:
+        # this process is the only writer, workers just return embeddings
+        for name in ["histogram", "mean"]:
+            h5s[name] = h5py.File(output_paths[name], mode="a")
+        with ProcessPoolExecutor(
+            max_workers=args.num_workers, initializer=_init_worker, initargs=(model,)
+        ) as executor:
+            tasks = [(file_path, args.chunk_size) for _, _, file_path in todo]
+            results = iter_ordered(executor, _embed_slide, tasks, prefetch)
+            for (case_id, file_id, _), embs in tqdm(
+                zip(todo, results), total=len(todo)
+            ):
+                for name, emb in zip(["histogram", "mean"], embs):
+                    if (case_id, file_id) in existing[name]:
+                        continue
+                    write_embeddings(
+                        h5s[name],
+                        [case_id],
+                        [file_id],
+                        emb[np.newaxis],
+                        args.quantization,
+                    )
+    finally:
+        for h5 in h5s.values():
+            h5.close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
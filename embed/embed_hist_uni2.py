@@ -1,50 +1,213 @@
 import argparse
 import os
-from pathlib import Path
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import h5py
 import numpy as np
 from tqdm import tqdm
 
+# stage profiling is shared with the data and experiment scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
+
+from embed_utils import add_plan_argument, get_existing_keys, write_embeddings
+from profiling import add_profile_argument, enable_profiling, profiled, stage
+from quantization import add_quantization_argument
+
+BASIC_STATS = ["mean", "max", "min", "std"]
+QUANTILE_STAT = re.compile(r"^q(\d{1,2})$")  # e.g. q25, q50, q75
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--dataset-folder", required=True)
     parser.add_argument("--output-h5", required=True)
-    parser.add_argument("--aggregation", required=True, choices=["mean", "max"])
+    parser.add_argument(
+        "--aggregation",
+        required=True,
+        nargs="+",
+        help=(
+            f"One or more of {', '.join(BASIC_STATS)} or a quantile qNN (e.g. q50). "
+            "With multiple aggregations, each is saved to its own H5 "
+            "named after --output-h5 with the aggregation as suffix."
+        ),
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=2048,
+        help=(
+            "Number of tiles read from a slide at a time. Each worker holds "
+            "about 30 KB per tile of a chunk (float64 copies of the features), "
+            "about 60 MB at the default, so scale --num-workers to memory."
+        ),
+    )
+    parser.add_argument(
+        "--reservoir-size",
+        type=int,
+        default=65536,
+        help=(
+            "Maximum number of tiles sampled per slide to estimate quantiles, "
+            "each worker holds up to twice as many tiles (about 800 MB at the "
+            "default) when quantiles are requested."
+        ),
+    )
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    add_quantization_argument(parser)
+    add_plan_argument(parser)
+    add_profile_argument(parser)
     args = parser.parse_args()
+    for stat in args.aggregation:
+        if stat not in BASIC_STATS and QUANTILE_STAT.match(stat) is None:
+            parser.error(f"Unknown aggregation method: {stat}")
     return args
 
 
-def main(args):
+def get_output_paths(output_h5: str, stats: list[str]) -> dict[str, str]:
+    if len(stats) == 1:
+        return {stats[0]: output_h5}
+    root, ext = os.path.splitext(output_h5)
+    return {stat: f"{root}-{stat}{ext}" for stat in stats}
+
+
+@profiled()
+def aggregate_slide(
+    file_path: str,
+    stats: list[str],
+    chunk_size: int,
+    reservoir_size: int,
+) -> dict[str, np.ndarray]:
+    # single streaming pass over the tile rows, running mean/variance are
+    # merged per chunk (Chan et al.) and quantiles are estimated from a
+    # uniform bottom-k sample of tiles which is exact for smaller slides
+    quantiles = [int(QUANTILE_STAT.match(s).group(1)) for s in stats if s[0] == "q"]
+    rng = np.random.default_rng(0)
+    with h5py.File(file_path, "r") as h5_in:
+        features = h5_in["features"]  # 1 x num_patches x 1536
+        squeeze = features.ndim == 3
+        dtype = features.dtype
+        n_tiles, dim = features.shape[-2:]
+        count = 0
+        mean = np.zeros(dim, dtype=np.float64)
+        m2 = np.zeros(dim, dtype=np.float64)
+        maximum = np.full(dim, -np.inf)
+        minimum = np.full(dim, np.inf)
+        reservoir = np.empty((0, dim), dtype=dtype)
+        reservoir_keys = np.empty(0)
+        for lo in range(0, n_tiles, chunk_size):
+            with stage("read_tiles") as read_stage:
+                if squeeze:
+                    chunk = features[0, lo : lo + chunk_size]
+                else:
+                    chunk = features[lo : lo + chunk_size]
+                read_stage.add(len(chunk))
+            chunk64 = chunk.astype(np.float64)
+            n = len(chunk)
+            chunk_mean = chunk64.mean(axis=0)
+            chunk64 -= chunk_mean  # in place to hold a single float64 copy
+            chunk_m2 = (chunk64**2).sum(axis=0)
+            delta = chunk_mean - mean
+            total = count + n
+            mean += delta * n / total
+            m2 += chunk_m2 + delta**2 * count * n / total
+            count = total
+            np.maximum(maximum, chunk.max(axis=0), out=maximum)
+            np.minimum(minimum, chunk.min(axis=0), out=minimum)
+            if len(quantiles) > 0:
+                reservoir = np.concatenate([reservoir, chunk])
+                reservoir_keys = np.concatenate([reservoir_keys, rng.random(n)])
+                if len(reservoir) > reservoir_size:
+                    keep = np.argpartition(reservoir_keys, reservoir_size)
+                    keep = keep[:reservoir_size]
+                    reservoir = reservoir[keep]
+                    reservoir_keys = reservoir_keys[keep]
+
+    results = {
+        "mean": mean,
+        "max": maximum,
+        "min": minimum,
+        "std": np.sqrt(m2 / count),
+    }
+    for q in quantiles:
+        results[f"q{q}"] = np.quantile(reservoir, q / 100, axis=0)
+    return {stat: results[stat].astype(dtype) for stat in stats}
+
+
+def find_slides(dataset_folder: str) -> list[tuple[str, str, str]]:
+    # case id, file id and path of every organized tile feature H5
     files = []
-    for root, _, fs in os.walk(args.dataset_folder):
+    for root, _, fs in os.walk(dataset_folder):
         for f in fs:
             if f.endswith(".h5"):
                 case_id = os.path.basename(root)
                 file_id = f[:-3]
                 files.append((case_id, file_id, os.path.join(root, f)))
+    return files
 
-    print("Generating slide-level embeddings")
-    if os.path.exists(args.output_h5):
-        print(f"Output H5 already exists, will not overwrite existing keys")
-    with h5py.File(args.output_h5, mode="a") as h5:
-        for case_id, file_id, file_path in tqdm(files):
-            if case_id in h5 and file_id in h5[case_id]:
-                print(f"{case_id}/{file_id} already exists, skipping")
-                continue
-            elif case_id not in h5:
-                h5.create_group(case_id)
+
+def main(args):
+    enable_profiling(args.profile)
+    files = find_slides(args.dataset_folder)
+
+    # outputs are read once, and only opened for writing when slides remain
+    output_paths = get_output_paths(args.output_h5, args.aggregation)
+    with stage("plan", items=len(files)):
+        existing = dict()
+        for stat, output_path in output_paths.items():
+            existing[stat] = set()
+            if os.path.exists(output_path):
+                with h5py.File(output_path, mode="r") as h5:
+                    existing[stat] = get_existing_keys(h5)
+        todo = []
+        for case_id, file_id, file_path in files:
+            stats = [s for s in output_paths if (case_id, file_id) not in existing[s]]
+            if len(stats) > 0:
+                todo.append((case_id, file_id, file_path, stats))
+    print(
+        f"{len(files) - len(todo)} of {len(files)} slides already aggregated, "
+        f"{len(todo)} to aggregate"
+    )
+    if args.plan:
+        n_tiles = 0
+        for _, _, file_path, _ in todo:
             with h5py.File(file_path, "r") as h5_in:
-                tile_embs = h5_in["features"][:]  # 1 x num_patches x 1536
-                tile_embs = np.squeeze(tile_embs)
-                if args.aggregation == "mean":
-                    emb = np.mean(tile_embs, axis=0)
-                elif args.aggregation == "max":
-                    emb = np.max(tile_embs, axis=0)
-                else:
-                    raise ValueError(f"Unknown aggregation method: {args.aggregation}")
-            h5[case_id].create_dataset(file_id, data=emb)
+                n_tiles += h5_in["features"].shape[-2]
+        print(f"{n_tiles} tiles to read")
+    if args.plan or len(todo) == 0:
+        return
+
+    print("Generating slide-level embeddings")
+    h5s = dict()
+    try:
+        # this process is the only writer, workers just return aggregations
+        for stat, output_path in output_paths.items():
+            h5s[stat] = h5py.File(output_path, mode="a")
+        with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+            futures = {
+                executor.submit(
+                    aggregate_slide,
+                    file_path,
+                    stats,
+                    args.chunk_size,
+                    args.reservoir_size,
+                ): (case_id, file_id)
+                for case_id, file_id, file_path, stats in todo
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                case_id, file_id = futures[future]
+                results = future.result()
+                for stat, emb in results.items():
+                    write_embeddings(
+                        h5s[stat],
+                        [case_id],
+                        [file_id],
+                        emb[np.newaxis],
+                        args.quantization,
+                    )
+    finally:
+        for h5 in h5s.values():
+            h5.close()
 
 
 if __name__ == "__main__":
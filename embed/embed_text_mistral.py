@@ -1,11 +1,22 @@
 import argparse
 import os
+import sys
 
 import h5py
-import numpy as np
 import pandas as pd
-from tqdm import trange
-from vllm import LLM
+
+# stage profiling is shared with the data and experiment scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
+
+from embed_utils import (
+    add_plan_argument,
+    count_tokens,
+    embed_texts_batched,
+    plan_missing,
+    write_embeddings,
+)
+from profiling import add_profile_argument, enable_profiling, stage
+from quantization import add_quantization_argument
 
 
 def parse_args() -> argparse.Namespace:
@@ -20,37 +31,66 @@ def parse_args() -> argparse.Namespace:
         required=True,
         help="Path to save extracted report features.",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=256,
+        help="Maximum number of reports per call to the embedding model.",
+    )
+    parser.add_argument(
+        "--max-batch-tokens",
+        type=int,
+        default=None,
+        help="Maximum padded tokens per call, reports are bucketed by length.",
+    )
+    add_quantization_argument(parser)
+    add_plan_argument(parser)
+    add_profile_argument(parser)
     args = parser.parse_args()
 
     return args
 
 
 def main(args):
+    enable_profiling(args.profile)
     df = pd.read_csv(args.input_csv)
+    file_ids = df["patient_filename"].to_list()
+    case_ids = [file_id.split(".")[0] for file_id in file_ids]
+    # the model is only loaded when there are reports left to embed
+    missing = plan_missing(args.output_h5, case_ids, file_ids, "reports")
+    if args.plan or len(missing) == 0:
+        return
 
-    model = LLM(
-        model="mistralai/Mistral-7B-Instruct-v0.1",
-        task="embed",
-        enforce_eager=True,
-    )
+    from vllm import LLM
+
+    with stage("load_model"):
+        model = LLM(
+            model="mistralai/Mistral-7B-Instruct-v0.1",
+            task="embed",
+            enforce_eager=True,
+        )
 
     print("Generating report embeddings")
-    if os.path.exists(args.output_h5):
-        print(f"Output H5 already exists, will not overwrite existing keys")
     with h5py.File(args.output_h5, mode="a") as h5:
-        for i in trange(len(df)):
-            file_id = df.loc[i, "patient_filename"]
-            case_id = file_id.split(".")[0]
-            if case_id in h5 and file_id in h5[case_id]:
-                print(f"{case_id}/{file_id} already exists, skipping")
-                continue
-            elif case_id not in h5:
-                h5.create_group(case_id)
-            report = df.loc[i, "text"]
-            output = model.embed([report], use_tqdm=False)
-            emb = output[0].outputs.embedding
-            emb = np.asarray(emb, dtype=np.float32)
-            h5[case_id].create_dataset(file_id, data=emb)
+        reports = df["text"].iloc[missing].to_list()
+        lengths = count_tokens(model, reports)
+        # each batch is written as it completes, so an interrupted run only
+        # loses the batch in progress and reruns skip what was written
+        for bucket, embs in embed_texts_batched(
+            model,
+            reports,
+            lengths,
+            batch_size=args.batch_size,
+            max_batch_tokens=args.max_batch_tokens,
+        ):
+            write_embeddings(
+                h5,
+                [case_ids[missing[i]] for i in bucket],
+                [file_ids[missing[i]] for i in bucket],
+                embs,
+                args.quantization,
+            )
+            h5.flush()
 
 
 if __name__ == "__main__":
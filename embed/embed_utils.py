@@ -0,0 +1,142 @@
+import os
+import sys
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+# stage profiling is shared with the data and experiment scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
+
+from profiling import profiled, stage
+from quantization import create_embedding_dataset, quantize
+
+
+@profiled("read_existing_keys")
+def get_existing_keys(h5: h5py.File) -> set[tuple[str, str]]:
+    # single pass over the output H5 instead of a membership check per row
+    return {(case_id, file_id) for case_id in h5 for file_id in h5[case_id]}
+
+
+def get_missing_idxs(
+    h5: h5py.File,
+    case_ids: list[str],
+    file_ids: list[str],
+) -> np.ndarray:
+    existing = get_existing_keys(h5)
+    missing = [
+        i for i, key in enumerate(zip(case_ids, file_ids)) if key not in existing
+    ]
+    return np.asarray(missing, dtype=np.int64)
+
+
+def add_plan_argument(parser):
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Report the remaining work and exit without loading the model.",
+    )
+
+
+def plan_missing(
+    output_h5: str,
+    case_ids: list[str],
+    file_ids: list[str],
+    unit: str,
+) -> np.ndarray:
+    # the output is opened read-only, so planning never creates or locks it
+    with stage("plan", items=len(case_ids)):
+        if os.path.exists(output_h5):
+            with h5py.File(output_h5, mode="r") as h5:
+                missing = get_missing_idxs(h5, case_ids, file_ids)
+        else:
+            missing = np.arange(len(case_ids), dtype=np.int64)
+    print(
+        f"{output_h5}: {len(case_ids) - len(missing)} of {len(case_ids)} {unit} "
+        f"already embedded, {len(missing)} to embed"
+    )
+    return missing
+
+
+def write_embeddings(
+    h5: h5py.File,
+    case_ids: list[str],
+    file_ids: list[str],
+    embs: np.ndarray,
+    quantization: str | None = None,
+):
+    with stage("write_h5", items=len(case_ids)):
+        values, scales = quantize(embs, quantization)
+        for i, (case_id, file_id) in enumerate(zip(case_ids, file_ids)):
+            if case_id not in h5:
+                h5.create_group(case_id)
+            create_embedding_dataset(
+                h5[case_id],
+                file_id,
+                values[i],
+                quantization,
+                None if scales is None else scales[i],
+            )
+
+
+def count_tokens(model, texts: list[str]) -> np.ndarray:
+    with stage("tokenize", items=len(texts)):
+        tokenizer = model.get_tokenizer()
+        input_ids = tokenizer(texts)["input_ids"]
+    return np.asarray([len(ids) for ids in input_ids], dtype=np.int64)
+
+
+def length_buckets(
+    lengths: np.ndarray,
+    batch_size: int,
+    max_batch_tokens: int | None = None,
+) -> list[np.ndarray]:
+    # sort by length so each batch holds similarly sized sequences,
+    # a batch is closed when it is full or its padded size exceeds the budget
+    order = np.argsort(lengths, kind="stable")
+    buckets = []
+    bucket = []
+    bucket_max = 0
+    for i in order:
+        length = int(lengths[i])
+        new_max = max(bucket_max, length)
+        if len(bucket) > 0 and (
+            len(bucket) == batch_size
+            or (
+                max_batch_tokens is not None
+                and new_max * (len(bucket) + 1) > max_batch_tokens
+            )
+        ):
+            buckets.append(np.asarray(bucket, dtype=np.int64))
+            bucket = []
+            new_max = length
+        bucket.append(i)
+        bucket_max = new_max
+    if len(bucket) > 0:
+        buckets.append(np.asarray(bucket, dtype=np.int64))
+    return buckets
+
+
+def embed_texts_batched(
+    model,
+    texts: list[str],
+    lengths: np.ndarray,
+    batch_size: int,
+    max_batch_tokens: int | None = None,
+):
+    # model only needs an `embed` method with the vLLM LLM.embed signature,
+    # yields the indices into texts and the embeddings of each batch as it
+    # completes, so callers can write them before the next batch
+    buckets = length_buckets(lengths, batch_size, max_batch_tokens)
+    with tqdm(total=len(texts)) as pbar:
+        for bucket in buckets:
+            with stage("embed", items=len(bucket)):
+                outputs = model.embed([texts[i] for i in bucket], use_tqdm=False)
+            embs = np.stack(
+                [
+                    np.asarray(output.outputs.embedding, dtype=np.float32)
+                    for output in outputs
+                ]
+            )
+            yield bucket, embs
+            pbar.update(len(bucket))
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+# stage profiling is shared with the data and experiment scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
+
+from profiling import profiled
+
+# STAR-count TSVs from GDC all share the same GENCODE row layout:
+# a "# gene-model" comment line, the header, 4 N_* summary rows, then genes
+
+CACHE_VERSION = 1
+CACHE_COLUMNS = {"unstranded": np.int32, "tpm_unstranded": np.float64}
+
+
+def find_expr_files(dataset_folder: str) -> list[tuple[str, str]]:
+    fpaths = []
+    for root, _, files in os.walk(dataset_folder):
+        for f in files:
+            if f.endswith(".tsv"):
+                case_id = root.replace(dataset_folder, "").lstrip("/").split("/")[0]
+                fpath = os.path.join(root, f)
+                fpaths.append((case_id, fpath))
+    return fpaths
+
+
+def get_file_id(fpath: str) -> str:
+    # GDC file names start with the file UUID
+    return os.path.basename(fpath).split(".")[0]
+
+
+def find_expr_keys(dataset_folder: str) -> tuple[list[str], list[str]]:
+    # case and file ids of the expression files in cache row order, from the
+    # directory listing alone
+    fpaths = sorted(find_expr_files(dataset_folder))
+    return [case_id for case_id, _ in fpaths], [get_file_id(f) for _, f in fpaths]
+
+
+def read_gene_index(
+    fpath: str,
+    gene_type: str | None = "protein_coding",
+    gene_list: list[str] | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # row positions, ids and names of the selected genes, fixed once from a
+    # reference file and reused to parse every other file. genes are selected
+    # either by type or by a list of unversioned gene ids, in list order
+    df = pd.read_csv(
+        fpath, sep="\t", skiprows=1, usecols=["gene_id", "gene_name", "gene_type"]
+    )
+    if gene_list is not None:
+        # first row of each id, later rows are the chrY PAR copies
+        unversioned = df["gene_id"].str.split(".").str[0]
+        first_rows = pd.Series(np.arange(len(df))).groupby(unversioned.values).min()
+        missing = [g for g in gene_list if g not in first_rows.index]
+        if len(missing) > 0:
+            raise ValueError(
+                f"{len(missing)} genes not found in {fpath}: {missing[:5]}"
+            )
+        row_idxs = first_rows.loc[gene_list].to_numpy()
+    else:
+        row_idxs = np.flatnonzero(df["gene_type"] == gene_type)
+    gene_ids = df["gene_id"].to_numpy()[row_idxs].astype(str)
+    gene_names = df["gene_name"].to_numpy()[row_idxs].astype(str)
+    return row_idxs, gene_ids, gene_names
+
+
+_worker_state = dict()
+
+
+def _init_worker(out_dir, row_idxs, gene_ids, col_map, columns):
+    _worker_state["X"] = {
+        column: np.load(os.path.join(out_dir, f"{column}.npy"), mmap_mode="r+")
+        for column in columns
+    }
+    _worker_state["row_idxs"] = row_idxs
+    _worker_state["gene_ids"] = gene_ids
+    _worker_state["col_map"] = col_map
+
+
+@profiled("ingest_file")
+def _ingest_file(i: int, fpath: str):
+    X = _worker_state["X"]
+    row_idxs = _worker_state["row_idxs"]
+    col_map = _worker_state["col_map"]
+    df = pd.read_csv(fpath, sep="\t", skiprows=1, usecols=["gene_id"] + list(X))
+    gene_ids = df["gene_id"].to_numpy()[row_idxs]
+    if not (gene_ids == _worker_state["gene_ids"]).all():
+        raise ValueError(f"Gene rows of {fpath} do not match the reference file")
+    for column, X_column in X.items():
+        values = df[column].to_numpy()[row_idxs]
+        # sums rows mapped to the same output column, e.g. duplicate gene names
+        row = np.bincount(col_map, weights=values, minlength=X_column.shape[1])
+        X_column[i] = row.astype(X_column.dtype)
+
+
+def ingest_expr_files(
+    fpaths: list[str],
+    out_dir: str,
+    columns: dict[str, np.dtype],
+    row_idxs: np.ndarray,
+    gene_ids: np.ndarray,
+    col_map: np.ndarray,
+    n_cols: int,
+    num_workers: int | None = None,
+) -> dict[str, np.ndarray]:
+    # workers parse files in parallel straight into a preallocated
+    # (n_files, n_cols) .npy per column which is returned memory-mapped
+    for column, dtype in columns.items():
+        X = np.lib.format.open_memmap(
+            os.path.join(out_dir, f"{column}.npy"),
+            mode="w+",
+            dtype=dtype,
+            shape=(len(fpaths), n_cols),
+        )
+        X.flush()
+        del X
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_init_worker,
+        initargs=(out_dir, row_idxs, gene_ids, col_map, list(columns)),
+    ) as executor:
+        futures = [
+            executor.submit(_ingest_file, i, fpath) for i, fpath in enumerate(fpaths)
+        ]
+        for future in tqdm(futures):
+            future.result()
+    return {
+        column: np.load(os.path.join(out_dir, f"{column}.npy"), mmap_mode="r")
+        for column in columns
+    }
+
+
+def read_manifest_md5s(manifest: str | None) -> dict[str, str]:
+    if manifest is None:
+        return dict()
+    df = pd.read_csv(manifest, sep="\t")
+    return dict(zip(df["filename"], df["md5"]))
+
+
+def get_cache_key(
+    fpaths: list[tuple[str, str]],
+    md5s: dict[str, str],
+    gene_type: str | None,
+    gene_list: list[str] | None,
+) -> str:
+    # files are identified by their manifest md5, falling back to size and
+    # mtime for files missing from the manifest
+    files = []
+    for case_id, fpath in fpaths:
+        file_name = os.path.basename(fpath)
+        if file_name in md5s:
+            stamp = md5s[file_name]
+        else:
+            stat = os.stat(fpath)
+            stamp = f"{stat.st_size}:{stat.st_mtime_ns}"
+        files.append([case_id, file_name, stamp])
+    key = {
+        "version": CACHE_VERSION,
+        "files": files,
+        "gene_type": gene_type,
+        "gene_list": gene_list,
+    }
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+class ExprCache:
+    def __init__(self, cache_path: str):
+        self.path = cache_path
+        self.files = pd.read_csv(os.path.join(cache_path, "files.csv"))
+        self.genes = pd.read_csv(os.path.join(cache_path, "genes.csv"))
+        self.matrices = {
+            column: np.load(os.path.join(cache_path, f"{column}.npy"), mmap_mode="r")
+            for column in CACHE_COLUMNS
+        }
+
+    @classmethod
+    def load(
+        cls,
+        dataset_folder: str,
+        cache_root: str,
+        gene_type: str | None = "protein_coding",
+        gene_list: list[str] | None = None,
+        manifest: str | None = None,
+        num_workers: int | None = None,
+    ) -> "ExprCache":
+        # cache entries are addressed by the hash of their inputs, so changed
+        # downloads or gene selections build a new entry instead of reusing
+        fpaths = sorted(find_expr_files(dataset_folder))
+        key = get_cache_key(fpaths, read_manifest_md5s(manifest), gene_type, gene_list)
+        cache_path = os.path.join(cache_root, key[:16])
+        if os.path.exists(os.path.join(cache_path, "meta.json")):
+            print(f"Using cached expression matrices from {cache_path}")
+            return cls(cache_path)
+
+        print(f"Building expression cache {cache_path}")
+        os.makedirs(cache_path, exist_ok=True)
+        row_idxs, gene_ids, gene_names = read_gene_index(
+            fpaths[0][1], gene_type=gene_type, gene_list=gene_list
+        )
+        ingest_expr_files(
+            fpaths=[fpath for _, fpath in fpaths],
+            out_dir=cache_path,
+            columns=CACHE_COLUMNS,
+            row_idxs=row_idxs,
+            gene_ids=gene_ids,
+            col_map=np.arange(len(row_idxs)),
+            n_cols=len(row_idxs),
+            num_workers=num_workers,
+        )
+        pd.DataFrame(
+            {
+                "case_id": [case_id for case_id, _ in fpaths],
+                "file_id": [get_file_id(f) for _, f in fpaths],
+                "file_name": [os.path.basename(f) for _, f in fpaths],
+            }
+        ).to_csv(os.path.join(cache_path, "files.csv"), index=False)
+        pd.DataFrame({"gene_id": gene_ids, "gene_name": gene_names}).to_csv(
+            os.path.join(cache_path, "genes.csv"), index=False
+        )
+        # meta is written last so an interrupted build is rebuilt
+        with open(os.path.join(cache_path, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "version": CACHE_VERSION,
+                    "key": key,
+                    "dataset_folder": os.path.abspath(dataset_folder),
+                    "manifest": manifest,
+                    "gene_type": gene_type,
+                    "n_files": len(fpaths),
+                    "n_genes": len(gene_ids),
+                },
+                f,
+                indent=2,
+            )
+        return cls(cache_path)
+
+    def sum_duplicate_genes(self, column: str) -> tuple[np.ndarray, np.ndarray]:
+        # genes sorted by name, with columns of duplicate names summed
+        var_names, col_map = np.unique(
+            self.genes["gene_name"].to_numpy().astype(str), return_inverse=True
+        )
+        order = np.argsort(col_map, kind="stable")
+        starts = np.flatnonzero(np.diff(col_map[order], prepend=-1))
+        X = self.matrices[column]
+        dtype = np.int64 if np.issubdtype(X.dtype, np.integer) else np.float64
+        X = np.add.reduceat(X[:, order], starts, axis=1, dtype=dtype)
+        return X, var_names
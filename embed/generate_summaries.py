@@ -1,8 +1,16 @@
 import argparse
+import json
+import os
+import sys
 
 import pandas as pd
-from tqdm import trange
-from vllm import LLM, SamplingParams
+from tqdm import tqdm
+
+# stage profiling is shared with the data and experiment scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
+
+from embed_utils import add_plan_argument, count_tokens, length_buckets
+from profiling import add_profile_argument, enable_profiling, stage
 
 PROMPT = [
     {
@@ -28,35 +36,152 @@ def parse_args():
     parser.add_argument("--input-csv", required=True)
     parser.add_argument("--output-csv", required=True)
     parser.add_argument("--model", default="meta-llama/Llama-3.1-8B-Instruct")
-    parser.add_argument("--batch-size", default=16, type=int)
+    parser.add_argument(
+        "--batch-size",
+        default=256,
+        type=int,
+        help="Maximum number of reports per call to the model.",
+    )
+    parser.add_argument(
+        "--max-batch-tokens",
+        default=131072,
+        type=int,
+        help=(
+            "Maximum padded report tokens per call, reports are bucketed by "
+            "length. Lower it if the model runs out of memory."
+        ),
+    )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        help="JSONL of completed summaries, defaults to the output CSV path + .jsonl",
+    )
+    add_plan_argument(parser)
+    add_profile_argument(parser)
     args = parser.parse_args()
+    if args.shard is None:
+        args.shard = args.output_csv + ".jsonl"
     return args
 
 
+def read_shard(shard_path):
+    summaries = dict()
+    if os.path.exists(shard_path):
+        with open(shard_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # partially written line of an interrupted run
+                summaries[entry["patient_filename"]] = entry["text"]
+    return summaries
+
+
+def truncate_partial_line(shard_path):
+    # drop the partially written last line of an interrupted run, so appended
+    # entries start on their own line
+    if not os.path.exists(shard_path):
+        return
+    with open(shard_path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(pos - (1 << 16), 0)
+            f.seek(start)
+            i = f.read(pos - start).rfind(b"\n")
+            if i >= 0:
+                pos = start + i + 1
+                break
+            pos = start
+        if pos < end:
+            f.truncate(pos)
+
+
+def summarize_reports(
+    llm,
+    sampling_params,
+    df,
+    shard_path,
+    batch_size,
+    max_batch_tokens=None,
+    summaries=None,
+):
+    # llm only needs the chat and get_tokenizer methods of the vLLM LLM.
+    # summaries are appended to the shard as each batch completes,
+    # reports already in the shard (or in summaries, if already read) are
+    # skipped
+    if summaries is None:
+        summaries = read_shard(shard_path)
+    todo = df[~df["patient_filename"].isin(summaries)]
+    print(f"{len(summaries)} reports already summarized, skipping")
+    if len(todo) > 0:
+        filenames = todo["patient_filename"].to_list()
+        reports = todo["text"].to_list()
+        lengths = count_tokens(llm, reports)
+        buckets = length_buckets(lengths, batch_size, max_batch_tokens)
+        truncate_partial_line(shard_path)
+        with open(shard_path, "a") as f, tqdm(total=len(reports)) as pbar:
+            # longest first so an out of memory error surfaces early
+            for bucket in reversed(buckets):
+                # every prompt starts with the same system messages
+                prepared_prompts = [
+                    PROMPT + [{"role": "user", "content": reports[i]}] for i in bucket
+                ]
+                with stage("generate", items=len(bucket)):
+                    outputs = llm.chat(
+                        prepared_prompts, sampling_params, use_tqdm=False
+                    )
+                for i, output in zip(bucket, outputs):
+                    summary = output.outputs[0].text
+                    summaries[filenames[i]] = summary
+                    entry = {"patient_filename": filenames[i], "text": summary}
+                    f.write(json.dumps(entry) + "\n")
+                f.flush()
+                pbar.update(len(bucket))
+    return [summaries[filename] for filename in df["patient_filename"]]
+
+
 def main(args):
+    enable_profiling(args.profile)
     df = pd.read_csv(args.input_csv)
-    llm = LLM(
-        model=args.model,
-        enforce_eager=True,
-        task="generate",
+    done = read_shard(args.shard)
+    n_todo = int((~df["patient_filename"].isin(done)).sum())
+    print(
+        f"{args.shard}: {len(df) - n_todo} of {len(df)} reports already summarized, "
+        f"{n_todo} to summarize"
     )
-    sampling_params = SamplingParams(
-        n=1,
-        temperature=0,
-        max_tokens=1024,
-        seed=42,
+    if args.plan:
+        return
+
+    # the model is only loaded when there are reports left, summarize_reports
+    # takes any model with the vLLM API
+    llm = sampling_params = None
+    if n_todo > 0:
+        from vllm import LLM, SamplingParams
+
+        with stage("load_model"):
+            llm = LLM(
+                model=args.model,
+                enforce_eager=True,
+                task="generate",
+                # reuse the KV cache of the system prompt shared by all requests
+                enable_prefix_caching=True,
+            )
+        sampling_params = SamplingParams(
+            n=1,
+            temperature=0,
+            max_tokens=1024,
+            seed=42,
+        )
+    summaries = summarize_reports(
+        llm,
+        sampling_params,
+        df,
+        args.shard,
+        batch_size=args.batch_size,
+        max_batch_tokens=args.max_batch_tokens,
+        summaries=done,
     )
-    summaries = []
-    for i in trange(0, len(df), args.batch_size):
-        lo, hi = i, i + args.batch_size
-        reports = df.iloc[lo:hi, 1].to_list()
-        prepared_prompts = [
-            PROMPT + [{"role": "user", "content": report}] for report in reports
-        ]
-        outputs = llm.chat(prepared_prompts, sampling_params)
-        for output in outputs:
-            summary = output.outputs[0].text
-            summaries.append(summary)
     df["text"] = summaries
     df.to_csv(args.output_csv, index=False)
 
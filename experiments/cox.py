@@ -0,0 +1,283 @@
+import argparse
+import time
+import warnings
+from itertools import combinations
+
+import numpy as np
+from sklearn.exceptions import ConvergenceWarning
+from sksurv.linear_model import CoxPHSurvivalAnalysis
+
+# Cox proportional hazards with Breslow ties, fit by the same Newton iteration
+# as sksurv.linear_model.CoxPHSurvivalAnalysis: the loss is the negative
+# partial log-likelihood over n plus alpha / (2 n) ||coef||^2, steps are
+# halved when the loss increases and fits stop once the relative change of
+# the loss is below tol. Samples are sorted by time once, so risk set sums
+# are cumulative sums, and many models on column subsets of one design
+# matrix are fit together with masks zeroing the excluded coefficients
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-samples", type=int, default=6400)
+    parser.add_argument("--n-features", type=int, default=5)
+    parser.add_argument(
+        "--pca-components", nargs="+", type=int, default=[4, 8, 16, 32, 64, 128, 256]
+    )
+    args = parser.parse_args()
+    return args
+
+
+class RiskSets:
+    def __init__(self, event_indicator: np.ndarray, event_time: np.ndarray):
+        event_indicator = np.asarray(event_indicator, dtype=bool)
+        event_time = np.asarray(event_time, dtype=np.float64)
+        self.n = len(event_time)
+        # descending time, so the risk set of a time is a prefix
+        self.order = np.argsort(-event_time, kind="mergesort")
+        sorted_time = event_time[self.order]
+        self.event = event_indicator[self.order]
+        group_end = np.r_[sorted_time[1:] != sorted_time[:-1], True]
+        group = np.cumsum(np.r_[True, group_end[:-1]]) - 1
+        n_events = np.bincount(group, weights=self.event)
+        # last sample and number of events of each distinct event time
+        has_events = n_events > 0
+        self.ends = np.flatnonzero(group_end)[has_events]
+        self.n_events = n_events[has_events]
+
+
+def _linear_predictor(X, coef):
+    xw = X @ coef.T
+    shift = xw.max(axis=0)
+    return xw, np.exp(xw - shift), shift
+
+
+def nlog_likelihood(risk_sets: RiskSets, X: np.ndarray, coef: np.ndarray, alpha):
+    # per model losses of coef (n_models, n_features), X sorted by risk_sets
+    xw, exp_xw, shift = _linear_predictor(X, coef)
+    risk_set = np.cumsum(exp_xw, axis=0)[risk_sets.ends]
+    log_risk_set = np.log(risk_set) + shift
+    loglik = xw[risk_sets.event].sum(axis=0) - risk_sets.n_events @ log_risk_set
+    penalty = alpha * np.square(coef).sum(axis=1) / 2
+    return (penalty - loglik) / risk_sets.n
+
+
+def gradient_hessian(risk_sets: RiskSets, X: np.ndarray, coef: np.ndarray, alpha):
+    # gradient (n_models, n_features) and hessian (n_models, n_features,
+    # n_features) of the loss of each model
+    n = risk_sets.n
+    _, exp_xw, _ = _linear_predictor(X, coef)
+    ends, n_events = risk_sets.ends, risk_sets.n_events
+    risk_set = np.cumsum(exp_xw, axis=0)[ends]
+    risk_set_x = np.cumsum(exp_xw[:, :, np.newaxis] * X[:, np.newaxis], axis=0)[ends]
+    z = risk_set_x / risk_set[:, :, np.newaxis]
+
+    x_events = X[risk_sets.event].sum(axis=0)
+    gradient = (np.einsum("g,gmf->mf", n_events, z) - x_events + alpha * coef) / n
+
+    # sum over event times of the risk set weighted second moments, as a
+    # single weighted product where each sample is weighted by the events
+    # whose risk set it belongs to
+    weight = np.zeros_like(exp_xw)
+    weight[ends] = n_events[:, np.newaxis] / risk_set
+    weight = np.cumsum(weight[::-1], axis=0)[::-1] * exp_xw
+    hessian = np.empty((len(coef), X.shape[1], X.shape[1]))
+    for m in range(len(coef)):
+        hessian[m] = (X * weight[:, m, np.newaxis]).T @ X
+        hessian[m] -= (z[:, m].T * n_events) @ z[:, m]
+    hessian /= n
+    hessian += np.eye(X.shape[1]) * alpha / n
+    return gradient, hessian
+
+
+def fit_cox_batch(
+    X: np.ndarray,
+    y: np.ndarray,
+    masks: np.ndarray | None = None,
+    alpha: float = 0.1,
+    n_iter: int = 100,
+    tol: float = 1e-9,
+    init: np.ndarray | None = None,
+) -> np.ndarray:
+    # coefficients (n_models, n_features) of one model per row of masks
+    # (n_models, n_features), fit on the masked columns of X. init
+    # (n_models, n_features) warm starts the iteration, zeros otherwise
+    X = np.asarray(X, dtype=np.float64)
+    n_features = X.shape[1]
+    if masks is None:
+        masks = np.ones((1, n_features), dtype=bool)
+    masks = np.asarray(masks, dtype=bool)
+    n_models = len(masks)
+
+    risk_sets = RiskSets(y["Status"], y["Survival_in_days"])
+    X = X[risk_sets.order]
+    if init is None:
+        coef = np.zeros((n_models, n_features))
+    else:
+        coef = np.where(masks, init, 0).astype(np.float64)
+    coef_prev = coef.copy()
+    loss = np.full(n_models, np.inf)
+    active = np.ones(n_models, dtype=bool)
+    for _ in range(n_iter):
+        m = np.flatnonzero(active)
+        w, w_prev, mask = coef[m], coef_prev[m], masks[m]
+        gradient, hessian = gradient_hessian(risk_sets, X, w, alpha)
+        # excluded columns get a zero step from an identity block
+        gradient[~mask] = 0
+        excluded = ~(mask[:, :, np.newaxis] & mask[:, np.newaxis, :])
+        hessian[excluded] = 0
+        hessian[:, np.arange(n_features), np.arange(n_features)] += ~mask
+        delta = np.linalg.solve(hessian, gradient[:, :, np.newaxis])[:, :, 0]
+        if not np.all(np.isfinite(delta)):
+            raise ValueError("search direction contains NaN or infinite values")
+
+        w_new = w - delta
+        loss_new = nlog_likelihood(risk_sets, X, w_new, alpha)
+        # step-halving if the loss does not decrease
+        worse = loss_new > loss[m]
+        if worse.any():
+            halved = (w_prev[worse] + w[worse]) / 2
+            coef[m[worse]] = halved
+            loss[m[worse]] = nlog_likelihood(risk_sets, X, halved, alpha)
+
+        better = ~worse
+        res = np.abs(1 - loss_new[better] / loss[m[better]])
+        coef_prev[m[better]] = w[better]
+        coef[m[better]] = w_new[better]
+        loss[m[better]] = loss_new[better]
+        active[m[better][res < tol]] = False
+        if not active.any():
+            break
+    else:
+        warnings.warn(
+            (
+                f"Optimization of {active.sum()} models did not converge: "
+                "Maximum number of iterations has been exceeded."
+            ),
+            stacklevel=2,
+            category=ConvergenceWarning,
+        )
+    return coef
+
+
+def fit_cox(
+    X: np.ndarray,
+    y: np.ndarray,
+    alpha: float = 0.1,
+    init: np.ndarray | None = None,
+) -> np.ndarray:
+    # coefficients (n_features,) of a single model on all columns of X
+    if init is not None:
+        init = np.asarray(init)[np.newaxis]
+    return fit_cox_batch(X, y, alpha=alpha, init=init)[0]
+
+
+def fit_cox_path(
+    X: np.ndarray,
+    y: np.ndarray,
+    n_features: list[int],
+    alpha: float = 0.1,
+) -> dict[int, np.ndarray]:
+    # coefficients of models on the leading n_features columns of X, e.g.
+    # nested PCA scores. each fit is warm started from the previous smaller
+    # one padded with zeros, which is close when the added columns carry
+    # little signal, so later ranks converge in a few Newton steps
+    coefs = dict()
+    coef = np.zeros(0)
+    for k in sorted(n_features):
+        init = np.zeros(k)
+        init[: len(coef)] = coef[:k]
+        coef = fit_cox(X[:, :k], y, alpha=alpha, init=init)
+        coefs[k] = coef
+    return coefs
+
+
+def get_subset_masks(n_features: int, min_size: int = 1) -> np.ndarray:
+    masks = []
+    for r in range(min_size, n_features + 1):
+        for subset in combinations(range(n_features), r):
+            mask = np.zeros(n_features, dtype=bool)
+            mask[list(subset)] = True
+            masks.append(mask)
+    return np.stack(masks)
+
+
+def get_synthetic_data(n_samples: int, n_features: int, decay: float = 0):
+    # decay > 0 gives column variances falling off like PCA scores, with the
+    # risk carried mostly by the leading columns
+    rng = np.random.default_rng(0)
+    scales = np.arange(1, n_features + 1) ** -decay
+    X = rng.normal(size=(n_samples, n_features)) * scales
+    risk = X @ (rng.normal(scale=0.5, size=n_features) * scales)
+    event_time = rng.exponential(1000 * np.exp(-risk)).round()
+    censor_time = rng.exponential(1500, size=n_samples).round()
+    y = np.array(
+        list(zip(event_time <= censor_time, np.minimum(event_time, censor_time))),
+        dtype=[("Status", "?"), ("Survival_in_days", "<f8")],
+    )
+    return X, y
+
+
+def benchmark_subsets(n_samples: int, n_features: int):
+    X, y = get_synthetic_data(n_samples, n_features)
+    masks = get_subset_masks(n_features, min_size=2)
+
+    start = time.perf_counter()
+    ref = np.zeros((len(masks), n_features))
+    for i, mask in enumerate(masks):
+        ref[i, mask] = CoxPHSurvivalAnalysis(alpha=0.1).fit(X[:, mask], y).coef_
+    ref_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    coef = fit_cox_batch(X, y, masks, alpha=0.1)
+    batch_time = time.perf_counter() - start
+
+    print(f"{len(masks)} column subsets of {n_samples} x {n_features}")
+    print(f"sksurv: {ref_time:.3f}s")
+    print(f"Batched: {batch_time:.3f}s ({ref_time / batch_time:.1f}x)")
+    print(f"Max abs coefficient difference: {np.abs(ref - coef).max():.3e}")
+
+
+def benchmark_path(n_samples: int, pca_components: list[int]):
+    pca_components = sorted(pca_components)
+    X, y = get_synthetic_data(n_samples, max(pca_components), decay=0.5)
+
+    print(f"Nested fits on the leading columns of {n_samples} x {X.shape[1]}")
+    print("  rank     sksurv       cold       warm   max abs coef diff")
+    ref_total, cold_total, warm_total = 0, 0, 0
+    coef = np.zeros(0)
+    for k in pca_components:
+        start = time.perf_counter()
+        ref = CoxPHSurvivalAnalysis(alpha=0.1).fit(X[:, :k], y).coef_
+        ref_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        fit_cox(X[:, :k], y, alpha=0.1)
+        cold_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        init = np.zeros(k)
+        init[: len(coef)] = coef
+        coef = fit_cox(X[:, :k], y, alpha=0.1, init=init)
+        warm_time = time.perf_counter() - start
+
+        ref_total += ref_time
+        cold_total += cold_time
+        warm_total += warm_time
+        print(
+            f"  {k:>4} {ref_time:>9.3f}s {cold_time:>9.3f}s {warm_time:>9.3f}s"
+            f"   {np.abs(ref - coef).max():.3e}"
+        )
+    print(
+        f"  total {ref_total:>8.3f}s {cold_total:>9.3f}s {warm_total:>9.3f}s"
+        f" ({ref_total / warm_total:.1f}x)"
+    )
+
+
+def main(args):
+    benchmark_subsets(args.n_samples, args.n_features)
+    benchmark_path(args.n_samples, args.pca_components)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,393 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+# the quantized embedding format is shared with the embed scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
+
+from quantization import (
+    QUANTIZATIONS,
+    convert_h5,
+    dequantize,
+    get_quantization,
+    get_quantized_path,
+    quantize,
+    read_embedding,
+)
+
+# Columnar layout of an embedding H5 (case_id/file_id -> vector):
+#   embeddings.npy    (n_files, dim), rows sorted by case_id then file_id
+#   scales.npy        (n_files,), scale of each row of int8 embeddings
+#   file_ids.npy      (n_files,)
+#   case_ids.npy      (n_cases,), sorted
+#   case_offsets.npy  (n_cases + 1,), rows of case i are offsets[i]:offsets[i + 1]
+#   meta.json         shape/dtype/quantization and the source H5 it was converted from
+# Quantized H5s (see tools/quantization.py) keep their quantization in the
+# store and are dequantized to float32 on read
+STORE_VERSION = 1
+# rows dequantized and reduced at a time by case_mean, as float64
+BLOCK_BYTES = 256 << 20
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(
+        title="mode",
+        required=True,
+        dest="mode",
+        help="See mode-specific help for further options",
+    )
+
+    convert_parser = subparsers.add_parser("convert")
+    convert_parser.add_argument("--input-h5", required=True, nargs="+")
+
+    benchmark_parser = subparsers.add_parser("benchmark")
+    benchmark_parser.add_argument("--input-h5", required=True, nargs="+")
+
+    evaluate_parser = subparsers.add_parser("evaluate")
+    evaluate_parser.add_argument(
+        "--config",
+        default="baseline",
+        help="Experiment configuration whose embedding H5s are quantized.",
+    )
+    evaluate_parser.add_argument("--clinical-data", default="../data/clinical.csv")
+    evaluate_parser.add_argument(
+        "--quantization", nargs="+", default=QUANTIZATIONS, choices=QUANTIZATIONS
+    )
+    evaluate_parser.add_argument(
+        "--output-dir",
+        default="quantized-embeddings",
+        help="Quantized copies of the H5s and the comparison tables.",
+    )
+    evaluate_parser.add_argument(
+        "--pca-components", nargs="+", type=int, default=[4, 8, 16, 32, 64, 128, 256]
+    )
+    evaluate_parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    evaluate_parser.add_argument(
+        "--n-significance",
+        type=int,
+        default=1000,
+        help="Resamples of the paired tests against full precision.",
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def get_store_path(h5_path: str) -> str:
+    return os.path.splitext(h5_path)[0] + ".store"
+
+
+def get_source_stamp(h5_path: str) -> dict:
+    stat = os.stat(h5_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def read_stored(dataset: h5py.Dataset, quantization: str | None):
+    # values and scale in the quantization of the store, vectors of an H5
+    # appended to with another quantization are requantized
+    if get_quantization(dataset)[0] == quantization:
+        return dataset[()], dataset.attrs.get("scale")
+    return quantize(read_embedding(dataset), quantization)
+
+
+def convert_h5_to_store(h5_path: str, store_path: str | None = None) -> str:
+    if store_path is None:
+        store_path = get_store_path(h5_path)
+    os.makedirs(store_path, exist_ok=True)
+    with h5py.File(h5_path, "r") as h5:
+        case_ids = sorted(h5.keys())
+        n_files = 0
+        for case_id in case_ids:
+            n_files += len(h5[case_id])
+        first = h5[case_ids[0]]
+        first = first[next(iter(first))]
+        dim, dtype = first.shape[-1], first.dtype
+        quantization, _ = get_quantization(first)
+
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(store_path, "embeddings.npy"),
+            mode="w+",
+            dtype=dtype,
+            shape=(n_files, dim),
+        )
+        scales = None
+        if quantization == "int8":
+            scales = np.ones(n_files, dtype=np.float32)
+        file_ids = []
+        case_offsets = [0]
+        for case_id in tqdm(case_ids, desc=os.path.basename(h5_path)):
+            case_group = h5[case_id]
+            for file_id in sorted(case_group.keys()):
+                values, scale = read_stored(case_group[file_id], quantization)
+                if scales is not None:
+                    scales[len(file_ids)] = scale
+                embeddings[len(file_ids)] = values
+                file_ids.append(file_id)
+            case_offsets.append(len(file_ids))
+        embeddings.flush()
+        del embeddings
+
+    if scales is not None:
+        np.save(os.path.join(store_path, "scales.npy"), scales)
+
+    np.save(os.path.join(store_path, "case_ids.npy"), np.asarray(case_ids, dtype=str))
+    np.save(os.path.join(store_path, "file_ids.npy"), np.asarray(file_ids, dtype=str))
+    np.save(
+        os.path.join(store_path, "case_offsets.npy"),
+        np.asarray(case_offsets, dtype=np.int64),
+    )
+    # meta is written last so an interrupted conversion is treated as stale
+    with open(os.path.join(store_path, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": STORE_VERSION,
+                "n_files": n_files,
+                "dim": int(dim),
+                "dtype": str(dtype),
+                "quantization": quantization,
+                "source": os.path.abspath(h5_path),
+                "source_stamp": get_source_stamp(h5_path),
+            },
+            f,
+            indent=2,
+        )
+    return store_path
+
+
+class EmbeddingStore:
+    def __init__(self, store_path: str):
+        self.path = store_path
+        with open(os.path.join(store_path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.embeddings = np.load(
+            os.path.join(store_path, "embeddings.npy"), mmap_mode="r"
+        )
+        self.case_ids = np.load(os.path.join(store_path, "case_ids.npy"))
+        self.file_ids = np.load(os.path.join(store_path, "file_ids.npy"))
+        self.case_offsets = np.load(os.path.join(store_path, "case_offsets.npy"))
+        self.quantization = self.meta.get("quantization")
+        self.scales = None
+        if self.quantization == "int8":
+            self.scales = np.load(os.path.join(store_path, "scales.npy"))
+
+    @classmethod
+    def from_h5(cls, h5_path: str) -> "EmbeddingStore":
+        # reuse the converted store next to the H5, converting if it is
+        # missing or the H5 was modified after conversion
+        store_path = get_store_path(h5_path)
+        meta_path = os.path.join(store_path, "meta.json")
+        stale = True
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            stamp = get_source_stamp(h5_path)
+            stale = meta["version"] != STORE_VERSION or meta["source_stamp"] != stamp
+        if stale:
+            print(f"Converting {h5_path} to {store_path}")
+            convert_h5_to_store(h5_path, store_path)
+        return cls(store_path)
+
+    def case_idxs(self, case_ids: list[str]) -> np.ndarray:
+        idxs = np.searchsorted(self.case_ids, case_ids)
+        idxs = np.clip(idxs, 0, len(self.case_ids) - 1)
+        found = self.case_ids[idxs] == np.asarray(case_ids, dtype=str)
+        if not found.all():
+            missing = np.asarray(case_ids)[~found]
+            raise KeyError(f"{len(missing)} cases not in {self.path}: {missing[:5]}")
+        return idxs
+
+    def case_mean(self, case_ids: list[str] | None = None) -> np.ndarray:
+        # segment mean over contiguous rows of each case, reduced in blocks of
+        # whole cases whose rows are read and dequantized together
+        if case_ids is None:
+            idxs = np.arange(len(self.case_ids))
+        else:
+            idxs = self.case_idxs(case_ids)
+        starts = self.case_offsets[idxs]
+        counts = np.diff(self.case_offsets)[idxs]
+        ends = np.cumsum(counts)
+        dim = self.embeddings.shape[1]
+        block_rows = max(BLOCK_BYTES // (dim * 8), 1)
+        dtype = self.embeddings.dtype if self.quantization is None else np.float32
+        X = np.empty((len(idxs), dim), dtype=dtype)
+        lo = 0
+        while lo < len(idxs):
+            hi = np.searchsorted(ends, ends[lo] - counts[lo] + block_rows, "right")
+            hi = max(hi, lo + 1)
+            block_counts = counts[lo:hi]
+            seg_starts = np.cumsum(block_counts) - block_counts
+            rows = np.arange(block_counts.sum()) + np.repeat(
+                starts[lo:hi] - seg_starts, block_counts
+            )
+            if rows[-1] - rows[0] + 1 == len(rows):
+                rows = slice(rows[0], rows[-1] + 1)  # read as a single range
+            values = self.embeddings[rows]
+            if self.quantization is not None:
+                scales = None if self.scales is None else self.scales[rows]
+                values = dequantize(values, self.quantization, scales)
+            sums = np.add.reduceat(values, seg_starts, axis=0, dtype=np.float64)
+            X[lo:hi] = sums / block_counts[:, np.newaxis]
+            lo = hi
+        return X
+
+
+def extract_case_emb_from_h5(case_ids: list[str], h5: h5py.File):
+    X = []
+    for case_id in tqdm(case_ids):
+        case_group = h5[case_id]
+        embs = np.stack([read_embedding(v) for v in case_group.values()], axis=0)
+        emb = np.mean(embs, axis=0)
+        X.append(emb)
+    return np.stack(X, axis=0)
+
+
+def benchmark(h5_path: str):
+    with h5py.File(h5_path, "r") as h5:
+        case_ids = sorted(h5.keys())
+    store = EmbeddingStore.from_h5(h5_path)
+
+    start = time.perf_counter()
+    with h5py.File(h5_path, "r") as h5:
+        walk_X = extract_case_emb_from_h5(case_ids, h5)
+    walk_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store = EmbeddingStore(store.path)
+    store_X = store.case_mean(case_ids)
+    store_time = time.perf_counter() - start
+
+    print(f"{h5_path}: {len(case_ids)} cases, {store.meta['n_files']} files")
+    print(f"H5 group walk: {walk_time:.3f}s")
+    print(f"Columnar store: {store_time:.3f}s ({walk_time / store_time:.1f}x)")
+    print(f"Max abs difference: {np.abs(walk_X - store_X).max():.3e}")
+
+
+def get_storage(h5_path: str) -> dict:
+    # bytes of the H5 and of the store matrices read by case_mean, and the
+    # time to compute the case means from the store
+    store = EmbeddingStore.from_h5(h5_path)
+    read_bytes = os.path.getsize(os.path.join(store.path, "embeddings.npy"))
+    if store.scales is not None:
+        read_bytes += os.path.getsize(os.path.join(store.path, "scales.npy"))
+    start = time.perf_counter()
+    store.case_mean()
+    return {
+        "h5_mb": os.path.getsize(h5_path) / 2**20,
+        "read_mb": read_bytes / 2**20,
+        "case_mean_s": time.perf_counter() - start,
+    }
+
+
+def evaluate(
+    config: str,
+    clinical_data: str,
+    quantizations: list[str],
+    output_dir: str,
+    pca_components: list[int],
+    num_workers: int | None,
+    n_significance: int,
+):
+    # reruns the c-index grid of a configuration on quantized copies of its
+    # embeddings, with paired tests of each combo against full precision
+    import pandas as pd
+
+    from survival_experiments import (
+        CONFIGS,
+        EMBEDDED_MODALITIES,
+        assemble_features,
+        run_experiments,
+        significance_results,
+        summarize_results,
+    )
+
+    os.makedirs(output_dir, exist_ok=True)
+    h5_paths = {
+        "float32": {m: CONFIGS[config][f"{m}_file"] for m in EMBEDDED_MODALITIES}
+    }
+    for quantization in quantizations:
+        h5_paths[quantization] = dict()
+        for modality, h5_path in h5_paths["float32"].items():
+            path = get_quantized_path(h5_path, quantization, output_dir)
+            # copies are redone when the source H5 changes
+            if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(
+                h5_path
+            ):
+                convert_h5(h5_path, path, quantization)
+            h5_paths[quantization][modality] = path
+
+    storage = []
+    features = dict()
+    for name, paths in h5_paths.items():
+        for modality, h5_path in paths.items():
+            storage.append({"modality": modality, "quantization": name})
+            storage[-1].update(get_storage(h5_path))
+        features[name] = assemble_features(
+            clinical_data, *[paths[m] for m in EMBEDDED_MODALITIES]
+        )
+    storage = pd.DataFrame(storage)
+    full = storage[storage["quantization"] == "float32"].set_index("modality")
+    storage["h5_ratio"] = storage["modality"].map(full["h5_mb"]) / storage["h5_mb"]
+    storage["read_ratio"] = (
+        storage["modality"].map(full["read_mb"]) / storage["read_mb"]
+    )
+
+    results = run_experiments(
+        features, pca_components=pca_components, num_workers=num_workers
+    )
+    c_index = pd.concat(
+        {name: summarize_results(r) for name, r in results.items()}, axis=1
+    )
+    tables = [storage, c_index]
+    if n_significance > 0:
+        _, tests = significance_results(
+            results, features, n_resamples=n_significance, num_workers=num_workers
+        )
+        tests = tests[tests["config_a"] == "float32"].reset_index(drop=True)
+        tables.append(tests)
+
+    print(storage.round(3).to_string(index=False))
+    for quantization in quantizations:
+        difference = (c_index[quantization] - c_index["float32"]).abs()
+        line = f"{quantization}: max |c-index difference| {np.nanmax(difference.values):.4f}"
+        if n_significance > 0:
+            q_tests = tests[tests["config_b"] == quantization]
+            line += f", min paired p-value {q_tests['p_bootstrap'].min():.3f}"
+        print(line)
+    for name, table in zip(["storage", "c_index", "significance"], tables):
+        path = os.path.join(output_dir, f"{config}-{name}.csv")
+        table.to_csv(path, index=name == "c_index")
+        print(f"Saved {path}")
+
+
+def main(args):
+    if args.mode == "convert":
+        for h5_path in args.input_h5:
+            store_path = convert_h5_to_store(h5_path)
+            print(f"Saved {h5_path} to {store_path}")
+    elif args.mode == "benchmark":
+        for h5_path in args.input_h5:
+            benchmark(h5_path)
+    elif args.mode == "evaluate":
+        evaluate(
+            args.config,
+            args.clinical_data,
+            args.quantization,
+            args.output_dir,
+            args.pca_components,
+            args.num_workers,
+            args.n_significance,
+        )
+    else:
+        raise ValueError(f"Unknown mode: {args.mode}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
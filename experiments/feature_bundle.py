@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+
+from result_cache import hash_array
+
+# Aligned experiment features saved once per set of input files, in a
+# directory named by the content hashes of the inputs:
+#   case_ids.npy         (n_cases,), sorted
+#   y.npy                (n_cases,) structured Status/Survival_in_days
+#   split.npy            (n_cases,) test split of each case
+#   X-<modality>.npy     (n_cases, dim) demo/canc one-hot and case embeddings
+#   frame.pkl            aligned clinical table and the one-hot encoders
+#   meta.json            inputs, shapes and content hashes of the matrices
+# Matrices are memory-mapped on load. File digests are memoized by path, size
+# and mtime in digests.json, so unchanged inputs are not re-read
+BUNDLE_VERSION = 1
+
+
+def file_digest(path: str, digests: dict) -> str:
+    stat = os.stat(path)
+    path = os.path.abspath(path)
+    stamp = f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+    if stamp not in digests:
+        # stamps of earlier versions of the file are dropped
+        for old in [s for s in digests if s.rsplit(":", 2)[0] == path]:
+            del digests[old]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(64 << 20), b""):
+                h.update(block)
+        digests[stamp] = h.hexdigest()
+    return digests[stamp]
+
+
+def get_bundle_path(bundle_dir: str, inputs: dict[str, str], **params) -> str:
+    # inputs maps names to files, params are settings the features depend on
+    os.makedirs(bundle_dir, exist_ok=True)
+    digests_path = os.path.join(bundle_dir, "digests.json")
+    digests = dict()
+    if os.path.exists(digests_path):
+        with open(digests_path, "r") as f:
+            digests = json.load(f)
+    key = {
+        "version": BUNDLE_VERSION,
+        **{name: file_digest(path, digests) for name, path in inputs.items()},
+        **params,
+    }
+    fd, tmp_path = tempfile.mkstemp(dir=bundle_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(digests, f, indent=2)
+    os.replace(tmp_path, digests_path)
+    key = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    return os.path.join(bundle_dir, key)
+
+
+def save_bundle(features: dict, bundle_path: str, inputs: dict[str, str]):
+    # written to a temporary directory first and renamed into place, then
+    # bundles built from earlier versions of the same input files are removed
+    bundle_dir = os.path.dirname(bundle_path)
+    tmp_path = tempfile.mkdtemp(dir=bundle_dir, suffix=".tmp")
+    os.chmod(tmp_path, 0o755)
+    split = np.full(len(features["y"]), -1, dtype=np.int64)
+    for i, test_idxs in enumerate(features["test_splits"]):
+        split[test_idxs] = i
+    np.save(os.path.join(tmp_path, "case_ids.npy"), np.asarray(features["case_ids"]))
+    np.save(os.path.join(tmp_path, "y.npy"), features["y"])
+    np.save(os.path.join(tmp_path, "split.npy"), split)
+    for modality, X in features["X"].items():
+        np.save(os.path.join(tmp_path, f"X-{modality}.npy"), X)
+    with open(os.path.join(tmp_path, "frame.pkl"), "wb") as f:
+        pickle.dump(
+            {k: features[k] for k in ["df", "demo_ohe", "canc_ohe"]},
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    inputs = {name: os.path.abspath(path) for name, path in inputs.items()}
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": BUNDLE_VERSION,
+                "inputs": inputs,
+                "n_cases": len(features["y"]),
+                "n_splits": len(features["test_splits"]),
+                "shapes": {m: list(X.shape) for m, X in features["X"].items()},
+                "X_hashes": {m: hash_array(X) for m, X in features["X"].items()},
+            },
+            f,
+            indent=2,
+        )
+    try:
+        os.rename(tmp_path, bundle_path)
+    except OSError:
+        # another process published the same bundle first
+        shutil.rmtree(tmp_path)
+
+    for name in os.listdir(bundle_dir):
+        path = os.path.join(bundle_dir, name)
+        meta_path = os.path.join(path, "meta.json")
+        if path == bundle_path or not os.path.exists(meta_path):
+            continue
+        with open(meta_path, "r") as f:
+            if json.load(f)["inputs"] == inputs:
+                shutil.rmtree(path)
+
+
+def load_bundle(bundle_path: str) -> dict | None:
+    meta_path = os.path.join(bundle_path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    if meta["version"] != BUNDLE_VERSION:
+        return None
+
+    with open(os.path.join(bundle_path, "frame.pkl"), "rb") as f:
+        features = pickle.load(f)
+    split = np.load(os.path.join(bundle_path, "split.npy"))
+    features.update(
+        {
+            "case_ids": np.load(os.path.join(bundle_path, "case_ids.npy")).tolist(),
+            "y": np.load(os.path.join(bundle_path, "y.npy")),
+            "X": {
+                m: np.load(os.path.join(bundle_path, f"X-{m}.npy"), mmap_mode="r")
+                for m in meta["shapes"]
+            },
+            "test_splits": [
+                np.flatnonzero(split == i) for i in range(meta["n_splits"])
+            ],
+            "X_hashes": meta["X_hashes"],
+        }
+    )
+    return features
@@ -0,0 +1,176 @@
+import argparse
+import time
+
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import StandardScaler
+from sksurv.linear_model import CoxPHSurvivalAnalysis
+from sksurv.metrics import concordance_index_censored
+
+# PCA fits of every rank share their leading components, so the decomposition
+# is computed once at the largest requested rank and smaller ranks are prefix
+# slices of its scores. "auto" uses a randomized truncated SVD for wide
+# matrices (e.g. 4096-d text embeddings) and an exact SVD otherwise
+PCA_SOLVERS = ["auto", "full", "randomized"]
+RANDOMIZED_MIN_FEATURES = 2048
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input-h5",
+        nargs="+",
+        help="Embedding H5s to benchmark on, synthetic matrices of --dims if omitted.",
+    )
+    parser.add_argument("--dims", nargs="+", type=int, default=[256, 1536, 4096])
+    parser.add_argument("--n-samples", type=int, default=8000)
+    parser.add_argument(
+        "--pca-components", nargs="+", type=int, default=[4, 8, 16, 32, 64, 128, 256]
+    )
+    parser.add_argument("--pca-solver", default="auto", choices=PCA_SOLVERS)
+    args = parser.parse_args()
+    return args
+
+
+def get_pca_solver(n_features: int, pca_solver: str = "auto") -> str:
+    if pca_solver == "auto":
+        return "randomized" if n_features >= RANDOMIZED_MIN_FEATURES else "full"
+    return pca_solver
+
+
+def fit_pca_path(
+    X_train: np.ndarray,
+    max_components: int,
+    pca_solver: str = "auto",
+) -> PCA:
+    pca_solver = get_pca_solver(X_train.shape[1], pca_solver)
+    if pca_solver == "randomized":
+        # oversampling by the full rank keeps the trailing components of the
+        # path as accurate as the leading ones
+        pca = PCA(
+            n_components=max_components,
+            svd_solver="randomized",
+            n_oversamples=max_components,
+            iterated_power=7,
+            random_state=42,
+        )
+    elif X_train.shape[0] > X_train.shape[1]:
+        # exact, from the eigendecomposition of the feature covariance
+        pca = PCA(n_components=max_components, svd_solver="covariance_eigh")
+        X_train = X_train.astype(np.float64)
+    else:
+        pca = PCA(n_components=max_components, svd_solver="full")
+    return pca.fit(X_train)
+
+
+def transform_pca_path(
+    pca: PCA,
+    X: np.ndarray,
+    pca_components: list[int],
+) -> dict[int, np.ndarray]:
+    X_red = pca.transform(X)
+    return {k: X_red[:, :k] for k in pca_components}
+
+
+def get_case_matrix(h5_path: str) -> np.ndarray:
+    from embedding_store import EmbeddingStore
+
+    return EmbeddingStore.from_h5(h5_path).case_mean()
+
+
+def get_synthetic_matrix(n_samples: int, dim: int) -> np.ndarray:
+    # decaying spectrum like real embeddings, plus isotropic noise
+    rng = np.random.default_rng(0)
+    rank = min(n_samples, dim)
+    scales = 1 / np.sqrt(np.arange(1, rank + 1))
+    basis = np.linalg.qr(rng.normal(size=(dim, rank)))[0]
+    X = (rng.normal(size=(n_samples, rank)) * scales) @ basis.T
+    X += 0.01 * rng.normal(size=(n_samples, dim))
+    return X.astype(np.float32)
+
+
+def get_synthetic_survival(X: np.ndarray) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    risk = X[:, :8].sum(axis=1)
+    risk = (risk - risk.mean()) / risk.std()
+    event_time = rng.exponential(1000 * np.exp(-risk))
+    censor_time = rng.exponential(2000, size=len(X))
+    return np.array(
+        list(zip(event_time <= censor_time, np.minimum(event_time, censor_time))),
+        dtype=[("Status", "?"), ("Survival_in_days", "<f8")],
+    )
+
+
+def get_c_index(X_train, y_train, X_test, y_test) -> float:
+    cox = CoxPHSurvivalAnalysis(alpha=0.1).fit(X_train, y_train)
+    return concordance_index_censored(
+        event_indicator=y_test["Status"],
+        event_time=y_test["Survival_in_days"],
+        estimate=cox.predict(X_test),
+    )[0]
+
+
+def subspace_error(ref: np.ndarray, components: np.ndarray) -> float:
+    # components agree up to sign, and rotation within degenerate subspaces,
+    # so compare the spanned subspaces by their largest principal angle
+    cosines = np.linalg.svd(ref @ components.T, compute_uv=False)
+    return float(1 - cosines.min())
+
+
+def benchmark(name: str, X: np.ndarray, pca_components: list[int], pca_solver: str):
+    n_train = int(0.8 * len(X))
+    y = get_synthetic_survival(X)
+    scaler = StandardScaler()
+    X_train = scaler.fit_transform(X[:n_train])
+    X_test = scaler.transform(X[n_train:])
+    y_train, y_test = y[:n_train], y[n_train:]
+    pca_components = [k for k in pca_components if k <= min(X_train.shape)]
+    max_components = max(pca_components)
+
+    # one exact decomposition serves as the reference for every rank
+    exact = PCA(n_components=max_components, svd_solver="full").fit(X_train)
+
+    start = time.perf_counter()
+    per_rank = dict()
+    for k in pca_components:
+        pca = PCA(n_components=k, random_state=42)
+        per_rank[k] = (pca, pca.fit_transform(X_train), pca.transform(X_test))
+    per_rank_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pca = fit_pca_path(X_train, max_components, pca_solver)
+    path_train = transform_pca_path(pca, X_train, pca_components)
+    path_test = transform_pca_path(pca, X_test, pca_components)
+    path_time = time.perf_counter() - start
+
+    solver = get_pca_solver(X_train.shape[1], pca_solver)
+    print(f"{name}: {X_train.shape[0]} x {X_train.shape[1]}, {solver} path")
+    print(f"Per-rank PCA fits: {per_rank_time:.3f}s")
+    print(f"Nested PCA path: {path_time:.3f}s ({per_rank_time / path_time:.1f}x)")
+    print("Subspace error vs exact SVD and test c-index, per-rank / path:")
+    for k in pca_components:
+        ref = exact.components_[:k]
+        per_rank_error = subspace_error(ref, per_rank[k][0].components_)
+        path_error = subspace_error(ref, pca.components_[:k])
+        per_rank_c = get_c_index(per_rank[k][1], y_train, per_rank[k][2], y_test)
+        path_c = get_c_index(path_train[k], y_train, path_test[k], y_test)
+        print(
+            f"  {k:>4} components: {per_rank_error:.2e} / {path_error:.2e}, "
+            f"{per_rank_c:.4f} / {path_c:.4f}"
+        )
+
+
+def main(args):
+    if args.input_h5 is not None:
+        for h5_path in args.input_h5:
+            X = get_case_matrix(h5_path)
+            benchmark(h5_path, X, args.pca_components, args.pca_solver)
+    else:
+        for dim in args.dims:
+            X = get_synthetic_matrix(args.n_samples, dim)
+            benchmark(f"synthetic-{dim}", X, args.pca_components, args.pca_solver)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
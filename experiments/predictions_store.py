@@ -0,0 +1,247 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+# Columnar layout of experiment predictions, one directory per config under a
+# store root (e.g. ../results/predictions/summarized/):
+#   index.npy          (n_entries,) pca_components, split, combo and c_index
+#   y_test_pred.npy    (n_test_values,) float32, entries concatenated
+#   y_train_pred.npy   (n_train_values,) float32, entries concatenated
+#   test_offsets.npy   (n_entries + 1,), test values of entry i are
+#                      offsets[i]:offsets[i + 1], likewise train_offsets.npy
+#   meta.json          config, counts and the source it was converted from
+# Prediction arrays are memory-mapped, so fetching one combo reads only its
+# slice. Results without PCA (pca_components None) are stored as -1
+STORE_VERSION = 1
+NO_PCA = -1
+INDEX_DTYPE = [
+    ("pca_components", "<i8"),
+    ("split", "<i8"),
+    ("combo", "<U64"),
+    ("c_index", "<f8"),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(
+        title="mode",
+        required=True,
+        dest="mode",
+        help="See mode-specific help for further options",
+    )
+
+    convert_parser = subparsers.add_parser("convert")
+    convert_parser.add_argument("--input-npy", required=True, nargs="+")
+    convert_parser.add_argument("--store-dir", default="../results/predictions")
+
+    benchmark_parser = subparsers.add_parser("benchmark")
+    benchmark_parser.add_argument("--input-npy", required=True)
+    benchmark_parser.add_argument("--store-dir", default="../results/predictions")
+    benchmark_parser.add_argument("--pca-components", type=int, default=256)
+    benchmark_parser.add_argument("--combo", default="text")
+
+    args = parser.parse_args()
+    return args
+
+
+def get_npy_config(npy_path: str) -> str:
+    # predictions.npy -> baseline, predictions_<config>.npy -> <config>
+    name = os.path.splitext(os.path.basename(npy_path))[0]
+    if name == "predictions":
+        return "baseline"
+    if name.startswith("predictions_"):
+        return name.removeprefix("predictions_")
+    raise ValueError(f"Cannot infer config from {npy_path}")
+
+
+def save_predictions(
+    results: dict,
+    store_dir: str,
+    config: str,
+    source: str | None = None,
+) -> str:
+    # results[pca_components][split][combo] holding c_index, y_test_pred and
+    # y_train_pred, as returned by run_experiments for one config
+    # written to a temporary directory first and swapped into place, so an
+    # interrupted save leaves the previous store intact
+    config_path = os.path.join(store_dir, config)
+    os.makedirs(store_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=store_dir, prefix=f".{config}-", suffix=".tmp")
+    os.chmod(tmp_path, 0o755)
+
+    index = []
+    y_test_pred, y_train_pred = [], []
+    for pca, pca_results in results.items():
+        for split, split_results in enumerate(pca_results):
+            for combo, result in split_results.items():
+                pca_components = NO_PCA if pca is None else pca
+                index.append((pca_components, split, combo, result["c_index"]))
+                y_test_pred.append(np.asarray(result["y_test_pred"], np.float32))
+                y_train_pred.append(np.asarray(result["y_train_pred"], np.float32))
+
+    np.save(os.path.join(tmp_path, "index.npy"), np.array(index, INDEX_DTYPE))
+    for part, preds in [("test", y_test_pred), ("train", y_train_pred)]:
+        offsets = np.r_[0, np.cumsum([len(p) for p in preds])].astype(np.int64)
+        np.save(os.path.join(tmp_path, f"{part}_offsets.npy"), offsets)
+        np.save(os.path.join(tmp_path, f"y_{part}_pred.npy"), np.concat(preds))
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": STORE_VERSION,
+                "config": config,
+                "n_entries": len(index),
+                "dtype": "float32",
+                "source": None if source is None else os.path.abspath(source),
+            },
+            f,
+            indent=2,
+        )
+    # a directory cannot be replaced while it holds files, so the previous
+    # store is moved aside and only removed once the new one is in place
+    old_path = None
+    if os.path.exists(config_path):
+        old_path = tempfile.mkdtemp(dir=store_dir, prefix=f".{config}-", suffix=".old")
+        os.replace(config_path, os.path.join(old_path, config))
+    os.replace(tmp_path, config_path)
+    if old_path is not None:
+        shutil.rmtree(old_path)
+    return config_path
+
+
+def convert_npy_to_store(npy_path: str, store_dir: str) -> str:
+    results = np.load(npy_path, allow_pickle=True).item()
+    return save_predictions(results, store_dir, get_npy_config(npy_path), npy_path)
+
+
+class ConfigPredictions:
+    def __init__(self, config_path: str):
+        self.path = config_path
+        with open(os.path.join(config_path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != STORE_VERSION:
+            raise ValueError(f"{config_path} has store version {self.meta['version']}")
+        self.index = np.load(os.path.join(config_path, "index.npy"))
+        self.offsets, self.preds = dict(), dict()
+        for part in ["test", "train"]:
+            self.offsets[part] = np.load(
+                os.path.join(config_path, f"{part}_offsets.npy")
+            )
+            self.preds[part] = np.load(
+                os.path.join(config_path, f"y_{part}_pred.npy"), mmap_mode="r"
+            )
+        self.rows = {
+            (int(pca), int(split), str(combo)): i
+            for i, (pca, split, combo, _) in enumerate(self.index)
+        }
+
+    def row(self, pca_components: int | None, split: int, combo: str) -> int:
+        pca = NO_PCA if pca_components is None else pca_components
+        try:
+            return self.rows[(pca, split, combo)]
+        except KeyError:
+            raise KeyError(
+                f"No predictions for pca_components={pca_components}, "
+                f"split={split}, combo={combo} in {self.path}"
+            ) from None
+
+    def get(
+        self,
+        pca_components: int | None,
+        split: int,
+        combo: str,
+        part: str = "test",
+    ) -> np.ndarray:
+        i = self.row(pca_components, split, combo)
+        offsets = self.offsets[part]
+        return self.preds[part][offsets[i] : offsets[i + 1]]
+
+    def result(self, pca_components: int | None, split: int, combo: str) -> dict:
+        # one entry shaped like the results of run_experiments, with
+        # memory-mapped predictions
+        i = self.row(pca_components, split, combo)
+        return {
+            "c_index": float(self.index["c_index"][i]),
+            "y_test_pred": self.get(pca_components, split, combo, "test"),
+            "y_train_pred": self.get(pca_components, split, combo, "train"),
+        }
+
+
+class PredictionsStore:
+    def __init__(self, store_dir: str):
+        self.path = store_dir
+        self._configs = dict()
+
+    @property
+    def configs(self) -> list[str]:
+        return sorted(
+            c
+            for c in os.listdir(self.path)
+            # dot directories are saves in progress or interrupted
+            if not c.startswith(".")
+            and os.path.exists(os.path.join(self.path, c, "meta.json"))
+        )
+
+    def __getitem__(self, config: str) -> ConfigPredictions:
+        if config not in self._configs:
+            self._configs[config] = ConfigPredictions(os.path.join(self.path, config))
+        return self._configs[config]
+
+    def splits(self, config: str, pca_components: int | None, combo: str) -> list:
+        # results of one combo for every split, in split order
+        preds = self[config]
+        index = preds.index
+        pca = NO_PCA if pca_components is None else pca_components
+        mask = (index["pca_components"] == pca) & (index["combo"] == combo)
+        splits = np.sort(index["split"][mask])
+        return [preds.result(pca_components, int(s), combo) for s in splits]
+
+
+def benchmark(npy_path: str, store_dir: str, pca_components: int, combo: str):
+    config = get_npy_config(npy_path)
+    start = time.perf_counter()
+    preds = np.load(npy_path, allow_pickle=True).item()[pca_components]
+    ref = [preds[i][combo] for i in range(len(preds))]
+    npy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store = PredictionsStore(store_dir)
+    fast = store.splits(config, pca_components, combo)
+    preds = store[config]
+    max_diff = max(
+        np.abs(r["y_test_pred"] - f["y_test_pred"]).max() for r, f in zip(ref, fast)
+    )
+    store_time = time.perf_counter() - start
+
+    print(f"{npy_path}: {combo} at {pca_components} components, {len(ref)} splits")
+    print(f"Unpickle npy: {npy_time:.3f}s")
+    print(f"Columnar store: {store_time:.3f}s ({npy_time / store_time:.1f}x)")
+    print(f"Max abs difference: {max_diff:.3e}")
+    store_size = sum(
+        os.path.getsize(os.path.join(preds.path, f)) for f in os.listdir(preds.path)
+    )
+    print(
+        f"Size: {os.path.getsize(npy_path) / 2**20:.1f} MiB npy, "
+        f"{store_size / 2**20:.1f} MiB store"
+    )
+
+
+def main(args):
+    if args.mode == "convert":
+        for npy_path in args.input_npy:
+            config_path = convert_npy_to_store(npy_path, args.store_dir)
+            print(f"Saved {npy_path} to {config_path}")
+    elif args.mode == "benchmark":
+        benchmark(args.input_npy, args.store_dir, args.pca_components, args.combo)
+    else:
+        raise ValueError(f"Unknown mode: {args.mode}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
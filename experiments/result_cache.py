@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+# Memoized unimodal fits, one pickle per entry named by the hash of every
+# input of the fit. Reads refresh the entry's mtime, so eviction of the
+# oldest mtimes first is least recently used eviction
+CACHE_VERSION = 2
+
+
+def hash_array(X: np.ndarray) -> str:
+    X = np.ascontiguousarray(X)
+    h = hashlib.sha256()
+    h.update(str(X.dtype).encode())
+    h.update(str(X.shape).encode())
+    # hash in row blocks to avoid copying memory-mapped matrices whole
+    step = max(1, (64 << 20) // max(1, X[:1].nbytes))
+    for lo in range(0, len(X), step):
+        h.update(X[lo : lo + step].tobytes())
+    return h.hexdigest()
+
+
+def get_cache_key(**inputs) -> str:
+    key = {"version": CACHE_VERSION, **inputs}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, cache_dir: str, max_bytes: int | None = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        return value
+
+    def put(self, key: str, value):
+        # written to a temporary file first so readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+
+    def evict(self) -> int:
+        if self.max_bytes is None:
+            return 0
+        entries = []
+        for f in os.listdir(self.cache_dir):
+            if f.endswith(".pkl"):
+                stat = os.stat(os.path.join(self.cache_dir, f))
+                entries.append((stat.st_mtime_ns, stat.st_size, f))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        n_evicted = 0
+        for _, size, f in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, f))
+            total -= size
+            n_evicted += 1
+        return n_evicted
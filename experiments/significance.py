@@ -0,0 +1,155 @@
+import argparse
+import time
+
+import numpy as np
+from sksurv.metrics import concordance_index_censored
+
+from concordance import bootstrap_multiplicity
+
+# Paired tests between the c-indices of risk vectors scored on the same cases.
+# Each comparable pair (i, j), i an event before j, earns credit[i, j] = 1 if
+# concordant, 0.5 if tied and 0 otherwise, so under sample multiplicities w the
+# c-index is w^T credit w / w^T comparable w. Resampling many w is then one
+# matrix product per risk vector, exact in float32 as every partial sum is a
+# multiple of 0.5 below 2^24. The paired bootstrap resamples cases for both
+# vectors alike. The permutation test randomly flips the sign of each case's
+# term in the first-order (Hoeffding) expansion of the difference: with u[i]
+# the credit of the pairs containing case i (its row and column sums), the
+# difference of c-indices has influence (u_a[i] - u_b[i]) / n_comparable per
+# case, and under exchangeable vectors each case's term is symmetric about 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-samples", type=int, default=1600)
+    parser.add_argument("--n-estimates", type=int, default=31)
+    parser.add_argument("--n-resamples", type=int, default=10000)
+    args = parser.parse_args()
+    return args
+
+
+def comparable_matrix(event_indicator: np.ndarray, event_time: np.ndarray):
+    event_indicator = np.asarray(event_indicator, dtype=bool)
+    event_time = np.asarray(event_time, dtype=np.float64)
+    later = event_time[np.newaxis, :] > event_time[:, np.newaxis]
+    censored_tie = (event_time[np.newaxis, :] == event_time[:, np.newaxis]) & (
+        ~event_indicator[np.newaxis, :]
+    )
+    return event_indicator[:, np.newaxis] & (later | censored_tie)
+
+
+def credit_matrix(
+    comparable: np.ndarray, estimate: np.ndarray, tied_tol: float = 1e-8
+) -> np.ndarray:
+    diff = estimate[:, np.newaxis] - estimate[np.newaxis, :]
+    credit = np.where(diff > tied_tol, 1, np.where(diff >= -tied_tol, 0.5, 0))
+    return (credit * comparable).astype(np.float32)
+
+
+def random_signs(n: int, n_permutations: int, rng: np.random.Generator):
+    # per case swaps of each permutation, (n_permutations, n) of +-1
+    return rng.integers(0, 2, size=(n_permutations, n)) * 2.0 - 1
+
+
+def paired_resamples(
+    event_indicator: np.ndarray,
+    event_time: np.ndarray,
+    estimates: np.ndarray,
+    multiplicity: np.ndarray,
+    signs: np.ndarray,
+    tied_tol: float = 1e-8,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # for estimates (n_estimates, n): c-indices (n_estimates,), c-indices
+    # under each multiplicity (n_estimates, n_resamples) and permutation
+    # statistics (n_estimates, n_permutations), whose pairwise differences
+    # are the permuted differences of c-indices
+    comparable = comparable_matrix(event_indicator, event_time)
+    weights = np.asarray(multiplicity, dtype=np.float32)
+    n_comparable = comparable.sum()
+    resampled_comparable = np.einsum(
+        "bn,bn->b", weights @ comparable.astype(np.float32), weights, dtype=np.float64
+    )
+
+    c_index = np.empty(len(estimates))
+    boot = np.empty((len(estimates), len(weights)))
+    credits = np.empty((len(estimates), len(event_time)))
+    for i, estimate in enumerate(np.asarray(estimates, dtype=np.float64)):
+        credit = credit_matrix(comparable, estimate, tied_tol)
+        c_index[i] = credit.sum(dtype=np.float64)
+        boot[i] = np.einsum("bn,bn->b", weights @ credit, weights, dtype=np.float64)
+        credits[i] = credit.sum(axis=0, dtype=np.float64)
+        credits[i] += credit.sum(axis=1, dtype=np.float64)
+    # without comparable pairs the c-indices are nan
+    with np.errstate(invalid="ignore", divide="ignore"):
+        c_index /= n_comparable
+        boot /= resampled_comparable
+        perm = credits @ np.asarray(signs, dtype=np.float64).T / n_comparable
+    return c_index, boot, perm
+
+
+def p_values(
+    difference: np.ndarray,
+    boot_difference: np.ndarray,
+    perm_difference: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    # two-sided bootstrap and permutation p-values along the last axis, with
+    # the observed statistic counted among the resamples
+    n_boot = np.sum(~np.isnan(boot_difference), axis=-1)
+    below = np.sum(boot_difference <= 0, axis=-1)
+    above = np.sum(boot_difference >= 0, axis=-1)
+    p_boot = np.minimum(1, 2 * (1 + np.minimum(below, above)) / (n_boot + 1))
+    # a relative tolerance keeps identical vectors at p = 1
+    observed = np.abs(difference)[..., np.newaxis] * (1 - 1e-9)
+    extreme = np.sum(np.abs(perm_difference) >= observed, axis=-1)
+    p_perm = (1 + extreme) / (perm_difference.shape[-1] + 1)
+    return p_boot, p_perm
+
+
+def benchmark(n_samples: int, n_estimates: int, n_resamples: int):
+    rng = np.random.default_rng(0)
+    event_time = rng.exponential(1000, size=n_samples).round(-1)
+    event_indicator = rng.random(n_samples) < 0.35
+    risk = -np.log(event_time + 1)
+    estimates = (risk + rng.normal(scale=2, size=(n_estimates, n_samples))).round(1)
+    multiplicity = bootstrap_multiplicity(n_samples, n_resamples, rng)
+    signs = random_signs(n_samples, n_resamples, rng)
+
+    start = time.perf_counter()
+    c_index, boot, perm = paired_resamples(
+        event_indicator, event_time, estimates, multiplicity, signs
+    )
+    fast_time = time.perf_counter() - start
+
+    n_check = min(n_resamples, 10)
+    start = time.perf_counter()
+    ref = []
+    for weights in multiplicity[:n_check]:
+        idxs = np.repeat(np.arange(n_samples), weights.astype(int))
+        ref.append(
+            concordance_index_censored(
+                event_indicator[idxs], event_time[idxs], estimates[0][idxs]
+            )[0]
+        )
+    ref_time = (time.perf_counter() - start) / n_check * n_resamples * n_estimates
+    ref.append(concordance_index_censored(event_indicator, event_time, estimates[0])[0])
+    max_diff = np.abs(np.array(ref) - np.r_[boot[0, :n_check], c_index[0]]).max()
+
+    print(f"{n_estimates} risk vectors of {n_samples} samples")
+    print(f"{n_resamples} bootstrap resamples and permutations: {fast_time:.3f}s")
+    print(f"sksurv on resampled arrays: {ref_time:.1f}s (extrapolated)")
+    print(f"Max abs difference: {max_diff:.3e}")
+
+    difference = c_index[0] - c_index[1:]
+    p_boot, p_perm = p_values(difference, boot[0] - boot[1:], perm[0] - perm[1:])
+    print("First vector against the next three: difference, bootstrap / permutation p")
+    for i in range(min(3, n_estimates - 1)):
+        print(f"  {difference[i]:+.4f}, {p_boot[i]:.4f} / {p_perm[i]:.4f}")
+
+
+def main(args):
+    benchmark(args.n_samples, args.n_estimates, args.n_resamples)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,1061 @@
+import argparse
+import os
+import sys
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import chain, combinations
+
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import PCA
+from sklearn.model_selection import StratifiedKFold
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from sksurv.linear_model import CoxPHSurvivalAnalysis
+from threadpoolctl import threadpool_limits
+from tqdm import tqdm
+
+# stage profiling is shared with the data and embed scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tools"))
+
+from concordance import bootstrap_multiplicity, concordance_index
+from cox import fit_cox, fit_cox_batch, fit_cox_path
+from embedding_store import EmbeddingStore
+from feature_bundle import get_bundle_path, load_bundle, save_bundle
+from pca_path import PCA_SOLVERS, fit_pca_path
+from predictions_store import save_predictions
+from profiling import add_profile_argument, enable_profiling, profiled, stage
+from result_cache import ResultCache, get_cache_key, hash_array
+from significance import p_values, paired_resamples, random_signs
+
+MODALITIES = ["demo", "canc", "expr", "hist", "text"]
+EMBEDDED_MODALITIES = ["expr", "hist", "text"]
+PCA_COMPONENTS = [4, 8, 16, 32, 64, 128, 256]
+N_SPLITS = 5
+COX_ALPHA = 0.1
+# modalities and combos that do not depend on pca_components, reported once
+PCA_INDEPENDENT = {
+    "demo": "demo*",
+    "canc": "canc*",
+    "canc-demo": "canc-demo*",
+}
+
+CONFIGS = {
+    "baseline": {
+        "expr_file": "../embed/expr.h5",  # BulkRNABert
+        "hist_file": "../embed/hist.h5",  # UNI2
+        "text_file": "../embed/text.h5",  # BioMistral
+        "output_results": "../results/results.csv",
+        "output_split_cases": "../results/split_cases.csv",
+    },
+    "summarized": {
+        "expr_file": "../embed/expr.h5",  # BulkRNABert
+        "hist_file": "../embed/hist.h5",  # UNI2
+        "text_file": "../embed/summ.h5",  # BioMistral - Summarized
+        "output_results": "../results/results_summarized.csv",
+    },
+    "uce_summarized": {
+        "expr_file": "../embed/expr-uce.h5",  # UCE
+        "hist_file": "../embed/hist.h5",  # UNI2
+        "text_file": "../embed/summ.h5",  # BioMistral - Summarized
+        "output_results": "../results/results_uce_summarized.csv",
+    },
+    "mistral": {
+        "expr_file": "../embed/expr.h5",  # BulkRNABert
+        "hist_file": "../embed/hist.h5",  # UNI2
+        "text_file": "../embed/text-mistral.h5",  # Mistral
+        "output_results": "../results/results_mistral.csv",
+    },
+    "mistral_summarized": {
+        "expr_file": "../embed/expr.h5",  # BulkRNABert
+        "hist_file": "../embed/hist.h5",  # UNI2
+        "text_file": "../embed/summ-mistral.h5",  # Mistral - Summarized
+        "output_results": "../results/results_mistral_summarized.csv",
+    },
+    "summarized_corrected": {
+        "expr_file": "../embed/expr.h5",  # BulkRNABert
+        "hist_file": "../embed/hist.h5",  # UNI2
+        # BioMistral - Summarized, Subset of manually corrected summaries
+        "text_file": "../embed/summ-corrected.h5",
+        "output_results": "../results/results_summarized_corrected.csv",
+    },
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        default=list(CONFIGS),
+        choices=list(CONFIGS),
+        help="Experiment configurations to run, all of them by default.",
+    )
+    parser.add_argument("--clinical-data", default="../data/clinical.csv")
+    parser.add_argument(
+        "--predictions-dir",
+        default="../results/predictions",
+        help="Predictions store, written to one subdirectory per configuration.",
+    )
+    parser.add_argument("--pca-components", nargs="+", type=int, default=PCA_COMPONENTS)
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=1,
+        help="BLAS threads in each worker process.",
+    )
+    parser.add_argument(
+        "--pca-solver",
+        default="auto",
+        choices=PCA_SOLVERS,
+        help=(
+            "Solver of the PCA path fit once per modality and split, "
+            "auto is randomized for embeddings of 2048 or more dimensions."
+        ),
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default="unimodal-cache",
+        help="Cache of unimodal fits reused across runs and configurations.",
+    )
+    parser.add_argument(
+        "--cache-size-gb",
+        type=float,
+        default=10,
+        help="Least recently used fits are evicted beyond this size.",
+    )
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument(
+        "--bundle-dir",
+        default="feature-bundles",
+        help="Assembled features reused until an input file changes.",
+    )
+    parser.add_argument("--no-bundle", action="store_true")
+    parser.add_argument(
+        "--n-bootstrap",
+        type=int,
+        default=1000,
+        help="Bootstrap resamples for confidence intervals of results, 0 to skip.",
+    )
+    parser.add_argument(
+        "--n-significance",
+        type=int,
+        default=10000,
+        help=(
+            "Bootstrap resamples and permutations for paired tests between "
+            "combos and configurations, 0 to skip."
+        ),
+    )
+    parser.add_argument(
+        "--output-config-significance",
+        default="../results/results_configs_significance.csv",
+        help="Paired tests of each combo across configurations.",
+    )
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    return args
+
+
+def powerset(s):
+    return chain.from_iterable(combinations(s, r) for r in range(len(s) + 1))
+
+
+def get_combos(min_size=2):
+    return [sorted(x) for x in powerset(MODALITIES) if len(x) >= min_size]
+
+
+def load_features(
+    clinical_data, expr_file, hist_file, text_file, bundle_dir=None
+) -> dict:
+    # assembled features are saved to a bundle keyed by the contents of the
+    # input files and memory-mapped on later loads
+    if bundle_dir is None:
+        return assemble_features(clinical_data, expr_file, hist_file, text_file)
+    inputs = {
+        "clinical": clinical_data,
+        "expr": expr_file,
+        "hist": hist_file,
+        "text": text_file,
+    }
+    with stage("hash_inputs"):
+        bundle_path = get_bundle_path(bundle_dir, inputs, n_splits=N_SPLITS)
+    with stage("load_bundle"):
+        features = load_bundle(bundle_path)
+    if features is None:
+        features = assemble_features(clinical_data, expr_file, hist_file, text_file)
+        with stage("save_bundle"):
+            save_bundle(features, bundle_path, inputs)
+        with stage("load_bundle"):
+            features = load_bundle(bundle_path)
+    return features
+
+
+def assemble_features(clinical_data, expr_file, hist_file, text_file) -> dict:
+    with stage("read_clinical"):
+        df = pd.read_csv(clinical_data)
+    clin_case_ids = set(df["case_id"])
+
+    # columnar copies of the H5s are created on first use and reused until the H5 changes
+    with stage("open_embeddings"):
+        stores = {
+            "expr": EmbeddingStore.from_h5(expr_file),
+            "hist": EmbeddingStore.from_h5(hist_file),
+            "text": EmbeddingStore.from_h5(text_file),
+        }
+
+    case_ids = clin_case_ids
+    for store in stores.values():
+        case_ids = case_ids & set(store.case_ids)
+    case_ids = sorted(case_ids)
+
+    df = df[df["case_id"].isin(case_ids)]
+    df = df.sort_values("case_id").reset_index(drop=True)
+    assert df["case_id"].is_unique
+
+    df["age_binned"] = pd.cut(
+        df["age"],
+        bins=[0, 20, 40, 60, 80, 100],
+        labels=["(0, 20]", "(20, 40]", "(40, 60]", "(60, 80]", "(80, 100]"],
+    )
+
+    dead = df["vital_status"] == "Dead"
+    days_to_event = np.where(dead, df["days_to_death"], df["days_to_last_follow_up"])
+    assert not np.isnan(days_to_event).any()
+
+    y = np.array(
+        list(zip(dead, days_to_event)),
+        dtype=[("Status", "?"), ("Survival_in_days", "<f8")],
+    )
+
+    demo_ohe = OneHotEncoder(drop="if_binary", sparse_output=False, dtype=np.float32)
+    canc_ohe = OneHotEncoder(drop="if_binary", sparse_output=False, dtype=np.float32)
+    X = {
+        "demo": demo_ohe.fit_transform(df[["sex", "age_binned", "race", "ethnicity"]]),
+        "canc": canc_ohe.fit_transform(df[["project"]]),
+    }
+    for modality, store in stores.items():
+        with stage("case_mean", items=len(case_ids)):
+            X[modality] = store.case_mean(case_ids)
+
+    skf = StratifiedKFold(n_splits=N_SPLITS, shuffle=True, random_state=42)
+    splitter = (
+        df["vital_status"]
+        + "_"
+        + df["project"]
+        + "_"
+        + df["sex"]
+        + "_"
+        + df["age_binned"].astype(str)
+        + "_"
+        + df["vital_status"]
+        + "_"
+        + df["race"]
+        + "_"
+        + df["ethnicity"]
+    )
+
+    n = len(df)
+    test_splits = [split_idxs for _, split_idxs in skf.split(X=np.zeros(n), y=splitter)]
+
+    return {
+        "df": df,
+        "case_ids": case_ids,
+        "y": y,
+        "X": X,
+        "test_splits": test_splits,
+        "demo_ohe": demo_ohe,
+        "canc_ohe": canc_ohe,
+    }
+
+
+def save_split_cases(features, output_split_cases):
+    df = features["df"]
+    y = features["y"]
+    meta_df = df[["case_id"]].copy()
+    meta_df["split"] = -1
+    meta_df["split_order"] = -1
+    for i, test_idxs in enumerate(features["test_splits"]):
+        meta_df.loc[test_idxs, "split"] = i
+        meta_df.loc[test_idxs, "split_order"] = list(range(len(test_idxs)))
+    meta_df["dead"] = y["Status"]
+    meta_df["days_to_death_or_censor"] = y["Survival_in_days"]
+    meta_df.to_csv(output_split_cases, index=False)
+    return meta_df
+
+
+def get_train_idxs(n, test_idxs):
+    return np.setdiff1d(np.arange(n), test_idxs)
+
+
+def run_split(
+    *,  # enforce kwargs
+    X_train: np.ndarray,
+    y_train: np.ndarray,
+    X_test: np.ndarray,
+    y_test: np.ndarray,
+    pca_components: int | None,
+    standardize: bool,
+    name: str = "",
+    verbose: bool = False,
+) -> dict:
+    if verbose:
+        print(f"Running {name}")
+
+    # z-score input features
+    if standardize:
+        if verbose:
+            print("--standardized")
+        scaler = StandardScaler()
+        X_train_scaled = scaler.fit_transform(X_train)
+        X_test_scaled = scaler.transform(X_test)
+    else:
+        X_train_scaled = X_train
+        X_test_scaled = X_test
+
+    # dimensionality reduction
+    if pca_components is not None:
+        if verbose:
+            print("--reduced")
+        pca = PCA(n_components=pca_components, random_state=42)
+        X_train_red = pca.fit_transform(X_train_scaled)
+        X_test_red = pca.transform(X_test_scaled)
+    else:
+        X_train_red = X_train_scaled
+        X_test_red = X_test_scaled
+
+    return run_cox(
+        X_train=X_train_red,
+        y_train=y_train,
+        X_test=X_test_red,
+        y_test=y_test,
+    )
+
+
+def run_cox(
+    *,  # enforce kwargs
+    X_train: np.ndarray,
+    y_train: np.ndarray,
+    X_test: np.ndarray,
+    y_test: np.ndarray,
+) -> dict:
+    # fit survival model
+    cox = CoxPHSurvivalAnalysis(alpha=COX_ALPHA).fit(X_train, y_train)
+
+    # generate predictions
+    y_train_pred = cox.predict(X_train)
+    y_test_pred = cox.predict(X_test)
+
+    # evaluate predictions
+    c_index = concordance_index(
+        event_indicator=y_test["Status"],
+        event_time=y_test["Survival_in_days"],
+        estimate=y_test_pred,
+    )
+
+    return {
+        "c_index": c_index,
+        "y_test_pred": y_test_pred,
+        "y_train_pred": y_train_pred,
+    }
+
+
+def run_unimodal_split(
+    *,  # enforce kwargs
+    X: np.ndarray,
+    y: np.ndarray,
+    test_idxs: np.ndarray,
+    train_idxs: np.ndarray,
+    pca_components: int | None,
+    standardize: bool,
+    name: str = "",
+    verbose: bool = False,
+) -> dict:
+    # split matrices
+    X_train, X_test = X[train_idxs], X[test_idxs]
+    y_train, y_test = y[train_idxs], y[test_idxs]
+
+    return run_split(
+        X_train=X_train,
+        y_train=y_train,
+        X_test=X_test,
+        y_test=y_test,
+        pca_components=pca_components,
+        standardize=standardize,
+        name=name,
+        verbose=verbose,
+    )
+
+
+def run_unimodal_path(
+    *,  # enforce kwargs
+    X: np.ndarray,
+    y: np.ndarray,
+    test_idxs: np.ndarray,
+    train_idxs: np.ndarray,
+    pca_components: list[int] | None,
+    standardize: bool,
+    pca_solver: str = "auto",
+) -> dict:
+    # results of run_unimodal_split for every pca_components value from a
+    # single PCA fit at the largest rank, keyed by pca_components
+    return fit_unimodal_path(
+        X=X,
+        y=y,
+        test_idxs=test_idxs,
+        train_idxs=train_idxs,
+        pca_components=pca_components,
+        standardize=standardize,
+        pca_solver=pca_solver,
+    )[0]
+
+
+def fit_unimodal_path(
+    *,  # enforce kwargs
+    X: np.ndarray,
+    y: np.ndarray,
+    test_idxs: np.ndarray,
+    train_idxs: np.ndarray,
+    pca_components: list[int] | None,
+    standardize: bool,
+    pca_solver: str = "auto",
+) -> tuple[dict, dict]:
+    # run_unimodal_path along with the fitted scaler, PCA and Cox parameters
+    X_train, X_test = X[train_idxs], X[test_idxs]
+    y_train, y_test = y[train_idxs], y[test_idxs]
+    params = {"scaler": None, "pca": None, "cox_coef": dict()}
+
+    if standardize:
+        with stage("scaler"):
+            scaler = StandardScaler()
+            X_train = scaler.fit_transform(X_train)
+            X_test = scaler.transform(X_test)
+        params["scaler"] = {"mean": scaler.mean_, "scale": scaler.scale_}
+
+    if pca_components is None:
+        with stage("cox", items=1):
+            coefs = {None: fit_cox(X_train, y_train, alpha=COX_ALPHA)}
+    else:
+        # every rank is a prefix of the largest, so the Cox fits run on
+        # prefixes of its scores, each warm started from the previous rank
+        with stage("pca"):
+            pca = fit_pca_path(X_train, max(pca_components), pca_solver)
+            X_train = pca.transform(X_train)
+            X_test = pca.transform(X_test)
+        params["pca"] = {"mean": pca.mean_, "components": pca.components_}
+        with stage("cox", items=len(pca_components)):
+            coefs = fit_cox_path(X_train, y_train, pca_components, alpha=COX_ALPHA)
+
+    results = dict()
+    for k, coef in coefs.items():
+        y_train_pred = X_train[:, : len(coef)] @ coef
+        y_test_pred = X_test[:, : len(coef)] @ coef
+        with stage("c_index", items=1):
+            c_index = concordance_index(
+                event_indicator=y_test["Status"],
+                event_time=y_test["Survival_in_days"],
+                estimate=y_test_pred,
+            )
+        results[k] = {
+            "c_index": c_index,
+            "y_test_pred": y_test_pred,
+            "y_train_pred": y_train_pred,
+        }
+        params["cox_coef"][k] = coef
+    return results, params
+
+
+def run_fusion_split(
+    *,  # enforce kwargs
+    split_results: dict,
+    y: np.ndarray,
+    test_idxs: np.ndarray,
+    train_idxs: np.ndarray,
+) -> dict:
+    y_train, y_test = y[train_idxs], y[test_idxs]
+
+    mult_X_train = []
+    mult_X_test = []
+    for modality in MODALITIES:
+        x_train = split_results[modality]["y_train_pred"][:, np.newaxis]
+        x_test = split_results[modality]["y_test_pred"][:, np.newaxis]
+        if modality not in ["demo", "canc"]:
+            scaler = StandardScaler()
+            x_train = scaler.fit_transform(x_train)
+            x_test = scaler.transform(x_test)
+        mult_X_train.append(x_train)
+        mult_X_test.append(x_test)
+
+    mult_X_train = np.concat(mult_X_train, axis=1)
+    mult_X_test = np.concat(mult_X_test, axis=1)
+
+    # every combo is a column subset of the stacked predictions, so all of
+    # them are fit together over the same risk sets
+    combos = get_combos()
+    masks = np.array([[m in combo for m in MODALITIES] for combo in combos])
+    with stage("cox", items=len(combos)):
+        coef = fit_cox_batch(mult_X_train, y_train, masks, alpha=COX_ALPHA)
+    y_train_preds = coef @ mult_X_train.T
+    y_test_preds = coef @ mult_X_test.T
+    with stage("c_index", items=len(combos)):
+        c_indices = concordance_index(
+            event_indicator=y_test["Status"],
+            event_time=y_test["Survival_in_days"],
+            estimate=y_test_preds,
+        )
+
+    fusion_results = dict()
+    for i, combo in enumerate(combos):
+        fusion_results["-".join(combo)] = {
+            "c_index": c_indices[i],
+            "y_test_pred": y_test_preds[i],
+            "y_train_pred": y_train_preds[i],
+        }
+    return fusion_results
+
+
+def run_experiment(features: dict, pca_components: int) -> list[dict]:
+    # sequential reference for a single pca_components value, fitting PCA at
+    # exactly that rank as the original notebook did
+    X, y, test_splits = features["X"], features["y"], features["test_splits"]
+    n = len(y)
+    results = []
+    for test_idxs in tqdm(test_splits, desc="Cross Validation Splits"):
+        train_idxs = get_train_idxs(n, test_idxs)
+        split_results = dict()
+        for modality in MODALITIES:
+            embedded = modality in EMBEDDED_MODALITIES
+            split_results[modality] = run_unimodal_split(
+                X=X[modality],
+                y=y,
+                test_idxs=test_idxs,
+                train_idxs=train_idxs,
+                pca_components=pca_components if embedded else None,
+                standardize=embedded,
+            )
+        split_results.update(
+            run_fusion_split(
+                split_results=split_results,
+                y=y,
+                test_idxs=test_idxs,
+                train_idxs=train_idxs,
+            )
+        )
+        results.append(split_results)
+    return results
+
+
+_worker_state = dict()
+
+
+def _limit_threads(threads_per_worker):
+    # workers share the cores, so each runs BLAS on only a few threads
+    threadpool_limits(threads_per_worker)
+
+
+def _init_worker(shared, threads_per_worker, cache_dir):
+    _limit_threads(threads_per_worker)
+    for config, (X_paths, y, test_splits) in shared.items():
+        X = {m: np.load(path, mmap_mode="r") for m, path in X_paths.items()}
+        _worker_state[config] = (X, y, test_splits)
+    if cache_dir is not None:
+        # workers only read and add entries, eviction is left to the parent
+        _worker_state["cache"] = ResultCache(cache_dir)
+
+
+@profiled("unimodal")
+def _run_unimodal_task(config, modality, pca_components, split, pca_solver, key):
+    cache = _worker_state.get("cache")
+    if cache is not None:
+        with stage("cache_get"):
+            cached = cache.get(key)
+        if cached is not None:
+            return cached["results"], True
+
+    X, y, test_splits = _worker_state[config]
+    test_idxs = test_splits[split]
+    embedded = modality in EMBEDDED_MODALITIES
+    results, params = fit_unimodal_path(
+        X=X[modality],
+        y=y,
+        test_idxs=test_idxs,
+        train_idxs=get_train_idxs(len(y), test_idxs),
+        pca_components=pca_components if embedded else None,
+        standardize=embedded,
+        pca_solver=pca_solver,
+    )
+    if cache is not None:
+        with stage("cache_put"):
+            cache.put(key, {"results": results, "params": params})
+    return results, False
+
+
+def get_unimodal_key(X_hash, y_hash, test_idxs, modality, pca_components, pca_solver):
+    # content hashes of every input to a unimodal fit, so only the fits of
+    # changed modalities are recomputed across runs and configurations
+    embedded = modality in EMBEDDED_MODALITIES
+    return get_cache_key(
+        X=X_hash,
+        y=y_hash,
+        test_idxs=hash_array(test_idxs),
+        pca_components=pca_components if embedded else None,
+        pca_solver=pca_solver if embedded else None,
+        standardize=embedded,
+        alpha=COX_ALPHA,
+    )
+
+
+@profiled("fusion")
+def _run_fusion_task(config, split, split_results):
+    _, y, test_splits = _worker_state[config]
+    test_idxs = test_splits[split]
+    return run_fusion_split(
+        split_results=split_results,
+        y=y,
+        test_idxs=test_idxs,
+        train_idxs=get_train_idxs(len(y), test_idxs),
+    )
+
+
+def run_experiments(
+    features: dict[str, dict],
+    pca_components: list[int] = PCA_COMPONENTS,
+    num_workers: int | None = None,
+    threads_per_worker: int = 1,
+    pca_solver: str = "auto",
+    cache_dir: str | None = None,
+    cache_size_gb: float = 10,
+) -> dict[str, dict]:
+    # expands configs x modalities x splits into independent unimodal fits,
+    # each covering every pca_components value, and configs x pca_components x
+    # splits into fusion stages on a process pool, returning
+    # results[config][pca_components][split][modality or combo]
+    with tempfile.TemporaryDirectory() as tmp:
+        # workers memory-map the feature matrices instead of receiving copies,
+        # matrices of feature bundles are mapped from the bundle directly
+        shared = dict()
+        for config, config_features in features.items():
+            X_paths = dict()
+            for modality, X in config_features["X"].items():
+                if isinstance(X, np.memmap):
+                    X_paths[modality] = X.filename
+                    continue
+                X_paths[modality] = os.path.join(tmp, f"{config}-{modality}.npy")
+                np.save(X_paths[modality], X)
+            shared[config] = (
+                X_paths,
+                config_features["y"],
+                config_features["test_splits"],
+            )
+
+        unimodal_tasks = []
+        for config, config_features in features.items():
+            y_hash = hash_array(config_features["y"])
+            X_hashes = config_features.get("X_hashes")
+            if X_hashes is None:
+                X_hashes = {m: hash_array(X) for m, X in config_features["X"].items()}
+            for split, test_idxs in enumerate(config_features["test_splits"]):
+                for modality in MODALITIES:
+                    key = get_unimodal_key(
+                        X_hashes[modality],
+                        y_hash,
+                        test_idxs,
+                        modality,
+                        pca_components,
+                        pca_solver,
+                    )
+                    unimodal_tasks.append(
+                        (config, modality, pca_components, split, pca_solver, key)
+                    )
+
+        unimodal = defaultdict(dict)
+        n_cached = 0
+        results = {
+            config: {
+                pca: [dict() for _ in config_features["test_splits"]]
+                for pca in pca_components
+            }
+            for config, config_features in features.items()
+        }
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_worker,
+            initargs=(shared, threads_per_worker, cache_dir),
+        ) as executor:
+            futures = {
+                executor.submit(_run_unimodal_task, *t): t for t in unimodal_tasks
+            }
+            pbar = tqdm(total=len(futures), desc="Experiment tasks")
+            pending = set(futures)
+            while len(pending) > 0:
+                future = next(as_completed(pending))
+                pending.remove(future)
+                pbar.update()
+                task = futures[future]
+                result = future.result()
+                if task[0] == "fusion":
+                    _, config, pca, split = task
+                    results[config][pca][split].update(result)
+                    continue
+
+                config, modality, _, split, _, _ = task
+                result, cached = result
+                n_cached += cached
+                unimodal[config, split][modality] = result
+                if len(unimodal[config, split]) < len(MODALITIES):
+                    continue
+
+                # submit the fusion stages of a (config, split) once all of
+                # its unimodal predictions are available
+                for pca in pca_components:
+                    split_results = {
+                        m: r[pca if m in EMBEDDED_MODALITIES else None]
+                        for m, r in unimodal[config, split].items()
+                    }
+                    results[config][pca][split].update(split_results)
+                    fusion = executor.submit(
+                        _run_fusion_task, config, split, split_results
+                    )
+                    futures[fusion] = ("fusion", config, pca, split)
+                    pending.add(fusion)
+                    pbar.total += 1
+                pbar.refresh()
+            pbar.close()
+    if cache_dir is not None:
+        print(f"{n_cached} of {len(unimodal_tasks)} unimodal fits loaded from cache")
+        cache = ResultCache(cache_dir, max_bytes=int(cache_size_gb * 2**30))
+        n_evicted = cache.evict()
+        if n_evicted > 0:
+            print(f"Evicted {n_evicted} least recently used fits from {cache_dir}")
+    return results
+
+
+def summarize_results(results: dict) -> pd.DataFrame:
+    # mean c-index across splits per combo and pca_components
+    pca_components = list(results)
+    combos = ["-".join(x) for x in get_combos(min_size=1)]
+    df = defaultdict(dict)
+    for pca in pca_components:
+        for combo in combos:
+            c_idxs = []
+            for split_results in results[pca]:
+                c_idxs.append(split_results[combo]["c_index"])
+            c_idx = np.mean(c_idxs)
+            if combo in PCA_INDEPENDENT:
+                combo = PCA_INDEPENDENT[combo]
+                if pca != pca_components[0]:
+                    continue
+            df[combo][pca] = c_idx
+    df = pd.DataFrame.from_dict(df, orient="index")
+    df = df.loc[[PCA_INDEPENDENT.get(x, x) for x in sort_combos(combos)]]
+    df.columns.name = "pca components"
+    return df
+
+
+def sort_combos(combos: list[str]) -> list[str]:
+    return sorted(sorted(combos), key=lambda x: len(x))
+
+
+def get_ci_path(output_results: str) -> str:
+    return os.path.splitext(output_results)[0] + "_ci.csv"
+
+
+@profiled()
+def bootstrap_split(
+    y_test: np.ndarray,
+    y_test_preds: np.ndarray,
+    n_bootstrap: int,
+    seed: list[int],
+) -> np.ndarray:
+    # c-index of each risk vector on each resample, (n_preds, n_bootstrap)
+    rng = np.random.default_rng(seed)
+    multiplicity = bootstrap_multiplicity(len(y_test), n_bootstrap, rng)
+    return concordance_index(
+        event_indicator=y_test["Status"],
+        event_time=y_test["Survival_in_days"],
+        estimate=y_test_preds,
+        multiplicity=multiplicity,
+    )
+
+
+def bootstrap_results(
+    results: dict,
+    features: dict,
+    n_bootstrap: int = 1000,
+    seed: int = 42,
+    num_workers: int | None = None,
+    threads_per_worker: int = 1,
+) -> pd.DataFrame:
+    # percentile intervals of every cell of summarize_results. test cases are
+    # resampled within each split, with the same draws for every combo and
+    # pca_components, and each resample of a cell averages the c-index of
+    # its splits
+    y, test_splits = features["y"], features["test_splits"]
+    pca_components = list(results)
+    combos = ["-".join(x) for x in get_combos(min_size=1)]
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_limit_threads,
+        initargs=(threads_per_worker,),
+    ) as executor:
+        futures = dict()
+        for pca in pca_components:
+            for split, test_idxs in enumerate(test_splits):
+                y_test_preds = np.stack(
+                    [results[pca][split][combo]["y_test_pred"] for combo in combos]
+                )
+                futures[pca, split] = executor.submit(
+                    bootstrap_split,
+                    y[test_idxs],
+                    y_test_preds,
+                    n_bootstrap,
+                    [seed, split],
+                )
+
+        boot = dict()
+        for pca in tqdm(pca_components, desc="Bootstrap"):
+            split_boot = [futures[pca, s].result() for s in range(len(test_splits))]
+            boot[pca] = dict(zip(combos, np.mean(split_boot, axis=0)))
+
+    rows = []
+    for combo in sort_combos(combos):
+        for pca in pca_components:
+            if combo in PCA_INDEPENDENT and pca != pca_components[0]:
+                continue
+            lower, upper = np.nanpercentile(boot[pca][combo], [2.5, 97.5])
+            rows.append(
+                {
+                    "combo": PCA_INDEPENDENT.get(combo, combo),
+                    "pca_components": pca,
+                    "c_index": np.mean([r[combo]["c_index"] for r in results[pca]]),
+                    "ci_lower": lower,
+                    "ci_upper": upper,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def get_significance_path(output_results: str) -> str:
+    return os.path.splitext(output_results)[0] + "_significance.csv"
+
+
+@profiled()
+def significance_split(
+    y_test: np.ndarray,
+    y_test_preds: np.ndarray,
+    n_resamples: int,
+    seed: list[int],
+) -> tuple[np.ndarray, np.ndarray]:
+    # c-index of each risk vector on each bootstrap resample and its
+    # permutation statistics, (n_preds, n_resamples) each. the resamples
+    # start with the draws of bootstrap_split
+    rng = np.random.default_rng(seed)
+    multiplicity = bootstrap_multiplicity(len(y_test), n_resamples, rng)
+    signs = random_signs(len(y_test), n_resamples, rng)
+    _, boot, perm = paired_resamples(
+        event_indicator=y_test["Status"],
+        event_time=y_test["Survival_in_days"],
+        estimates=y_test_preds,
+        multiplicity=multiplicity,
+        signs=signs,
+    )
+    return boot.astype(np.float32), perm.astype(np.float32)
+
+
+def get_pair_stats(c_index_a, c_index_b, boot_a, boot_b, perm_a, perm_b) -> dict:
+    # tidy columns of paired tests of a - b, resamples along the last axis
+    difference = c_index_a - c_index_b
+    boot_difference = boot_a - boot_b
+    lower, upper = np.nanpercentile(boot_difference, [2.5, 97.5], axis=-1)
+    p_bootstrap, p_permutation = p_values(difference, boot_difference, perm_a - perm_b)
+    return {
+        "c_index_a": c_index_a,
+        "c_index_b": c_index_b,
+        "difference": difference,
+        "ci_lower": lower,
+        "ci_upper": upper,
+        "p_bootstrap": p_bootstrap,
+        "p_permutation": p_permutation,
+    }
+
+
+def significance_results(
+    results: dict[str, dict],
+    features: dict[str, dict],
+    n_resamples: int = 10000,
+    seed: int = 42,
+    num_workers: int | None = None,
+    threads_per_worker: int = 1,
+) -> tuple[dict[str, pd.DataFrame], pd.DataFrame]:
+    # paired bootstrap and permutation tests of the c-index difference of
+    # every pair of combos within each config, and of each combo across
+    # configs with the same cases and splits. as in bootstrap_results, cases
+    # are resampled within each split with the same draws for every combo,
+    # pca_components and config, and the statistics average the splits
+    configs = list(results)
+    combos = ["-".join(x) for x in get_combos(min_size=1)]
+    combos = sort_combos(combos)
+    pca_components = list(results[configs[0]])
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_limit_threads,
+        initargs=(threads_per_worker,),
+    ) as executor:
+        futures = dict()
+        for config in configs:
+            y, test_splits = features[config]["y"], features[config]["test_splits"]
+            for pca in pca_components:
+                for split, test_idxs in enumerate(test_splits):
+                    y_test_preds = np.stack(
+                        [
+                            results[config][pca][split][combo]["y_test_pred"]
+                            for combo in combos
+                        ]
+                    )
+                    futures[config, pca, split] = executor.submit(
+                        significance_split,
+                        y[test_idxs],
+                        y_test_preds,
+                        n_resamples,
+                        [seed, split],
+                    )
+
+        stats = defaultdict(dict)
+        for config, pca in tqdm(
+            [(c, p) for c in configs for p in pca_components], desc="Significance"
+        ):
+            n_splits = len(features[config]["test_splits"])
+            split_stats = [futures[config, pca, s].result() for s in range(n_splits)]
+            boot, perm = np.mean(split_stats, axis=0)
+            c_index = np.array(
+                [
+                    np.mean([r[combo]["c_index"] for r in results[config][pca]])
+                    for combo in combos
+                ]
+            )
+            stats[config][pca] = (c_index, boot, perm)
+
+    # pairs of combos within each config, once for pca independent pairs
+    a, b = np.triu_indices(len(combos), k=1)
+    pair_combos = [(combos[i], combos[j]) for i, j in zip(a, b)]
+    tables = dict()
+    for config in configs:
+        rows = []
+        for pca in pca_components:
+            c_index, boot, perm = stats[config][pca]
+            pair_stats = get_pair_stats(
+                c_index[a], c_index[b], boot[a], boot[b], perm[a], perm[b]
+            )
+            for k, (combo_a, combo_b) in enumerate(pair_combos):
+                pca_independent = (
+                    combo_a in PCA_INDEPENDENT and combo_b in PCA_INDEPENDENT
+                )
+                if pca_independent and pca != pca_components[0]:
+                    continue
+                rows.append(
+                    {
+                        "combo_a": PCA_INDEPENDENT.get(combo_a, combo_a),
+                        "combo_b": PCA_INDEPENDENT.get(combo_b, combo_b),
+                        "pca_components": pca,
+                        **{col: values[k] for col, values in pair_stats.items()},
+                    }
+                )
+        tables[config] = pd.DataFrame(rows)
+
+    # each combo across configs, which pair the same cases only if the
+    # outcomes and splits agree
+    def same_cases(config):
+        ref, other = features[configs[0]], features[config]
+        return np.array_equal(ref["y"], other["y"]) and all(
+            np.array_equal(x, z)
+            for x, z in zip(ref["test_splits"], other["test_splits"], strict=True)
+        )
+
+    paired_configs = [config for config in configs if same_cases(config)]
+    embedded = np.array([combo not in PCA_INDEPENDENT for combo in combos])
+    rows = []
+    for i, config_a in enumerate(paired_configs):
+        for config_b in paired_configs[i + 1 :]:
+            for pca in pca_components:
+                stats_a = [x[embedded] for x in stats[config_a][pca]]
+                stats_b = [x[embedded] for x in stats[config_b][pca]]
+                pair_stats = get_pair_stats(
+                    *[x for ab in zip(stats_a, stats_b) for x in ab]
+                )
+                for k, combo in enumerate(np.array(combos)[embedded]):
+                    rows.append(
+                        {
+                            "combo": combo,
+                            "config_a": config_a,
+                            "config_b": config_b,
+                            "pca_components": pca,
+                            **{col: values[k] for col, values in pair_stats.items()},
+                        }
+                    )
+    return tables, pd.DataFrame(rows)
+
+
+def main(args):
+    enable_profiling(args.profile)
+    features = dict()
+    for config in args.configs:
+        print(f"Loading features for {config}")
+        paths = CONFIGS[config]
+        with stage("load_features"):
+            features[config] = load_features(
+                clinical_data=args.clinical_data,
+                expr_file=paths["expr_file"],
+                hist_file=paths["hist_file"],
+                text_file=paths["text_file"],
+                bundle_dir=None if args.no_bundle else args.bundle_dir,
+            )
+        if "output_split_cases" in paths:
+            save_split_cases(features[config], paths["output_split_cases"])
+
+    with stage("run_experiments"):
+        results = run_experiments(
+            features,
+            pca_components=args.pca_components,
+            num_workers=args.num_workers,
+            threads_per_worker=args.threads_per_worker,
+            pca_solver=args.pca_solver,
+            cache_dir=None if args.no_cache else args.cache_dir,
+            cache_size_gb=args.cache_size_gb,
+        )
+
+    for config in args.configs:
+        paths = CONFIGS[config]
+        with stage("save_results"):
+            save_predictions(results[config], args.predictions_dir, config)
+            summarize_results(results[config]).to_csv(paths["output_results"])
+        if args.n_bootstrap > 0:
+            with stage("bootstrap"):
+                bootstrap_results(
+                    results[config],
+                    features[config],
+                    n_bootstrap=args.n_bootstrap,
+                    num_workers=args.num_workers,
+                    threads_per_worker=args.threads_per_worker,
+                ).to_csv(get_ci_path(paths["output_results"]), index=False)
+        print(f"Saved {config} results to {paths['output_results']}")
+
+    if args.n_significance > 0:
+        with stage("significance"):
+            tables, config_table = significance_results(
+                results,
+                features,
+                n_resamples=args.n_significance,
+                num_workers=args.num_workers,
+                threads_per_worker=args.threads_per_worker,
+            )
+        for config, table in tables.items():
+            output_results = CONFIGS[config]["output_results"]
+            table.to_csv(get_significance_path(output_results), index=False)
+        if len(config_table) > 0:
+            config_table.to_csv(args.output_config_significance, index=False)
+        print("Saved significance tests")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
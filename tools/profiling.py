@@ -0,0 +1,366 @@
+import argparse
+import atexit
+import functools
+import json
+import multiprocessing.util
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+
+# Stage-level profiling shared by the data, embed and experiment scripts.
+# Scripts wrap their stages in named timers,
+#   with stage("embed", items=len(batch)):
+#       ...
+# and stages opened inside another stage are recorded under its path
+# ("embed/tokenize"). Each stage accumulates calls, wall and process CPU time,
+# items, bytes read and written through system calls (/proc/self/io rchar and
+# wchar, process-wide, so stages running concurrently in threads share them,
+# and reads of memory-mapped files are not included) and the peak RSS of the
+# process when it exits. Profiling is off unless enable_profiling() is called,
+# e.g. from a --profile argument, and a disabled stage is a shared no-op
+# context. Each process writes a JSON trace to the trace directory when it
+# exits, worker processes forked or spawned after enabling write their own.
+# Rank stages across traces with
+#   python profiling.py report TRACE_DIR
+TRACE_VERSION = 1
+TRACE_DIR_ENV = "STAGE_PROFILE_DIR"
+STAGE_FIELDS = ["calls", "wall", "cpu", "items", "read_bytes", "write_bytes"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(
+        title="mode",
+        required=True,
+        dest="mode",
+        help="See mode-specific help for further options",
+    )
+
+    report_parser = subparsers.add_parser("report")
+    report_parser.add_argument(
+        "traces",
+        nargs="+",
+        help="Trace files or directories of trace files.",
+    )
+    report_parser.add_argument("--script", help="Only report stages of this script.")
+    report_parser.add_argument(
+        "--sort",
+        default="self",
+        choices=["self", "wall", "cpu", "calls", "peak_rss"],
+        help="Rank by time excluding nested stages (self) or including them (wall).",
+    )
+    report_parser.add_argument("--top", type=int, default=25)
+
+    args = parser.parse_args()
+    return args
+
+
+def add_profile_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--profile",
+        default=None,
+        metavar="TRACE_DIR",
+        help="Write a stage timing trace of this run to TRACE_DIR.",
+    )
+
+
+def script_name() -> str:
+    # interactive sessions and python -c are traced as "python"
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    return "python" if script in ["", "-", "-c"] else script
+
+
+def open_io() -> int | None:
+    # /proc/self/io of this process, None where unavailable
+    try:
+        return os.open(f"/proc/{os.getpid()}/io", os.O_RDONLY)
+    except OSError:
+        return None
+
+
+def read_io(fd: int | None) -> tuple[int, int] | None:
+    # rchar and wchar, the first two counters
+    if fd is None:
+        return None
+    fields = os.pread(fd, 4096, 0).split()
+    return int(fields[1]), int(fields[3])
+
+
+def peak_rss() -> int:
+    # bytes, ru_maxrss is in kilobytes on linux and bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return None
+
+    def add(self, items: int):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ["profiler", "name", "items", "path", "start"]
+
+    def __init__(self, profiler, name: str, items: int | None):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        stack = self.profiler.stack()
+        self.path = self.name if len(stack) == 0 else f"{stack[-1]}/{self.name}"
+        stack.append(self.path)
+        io = read_io(self.profiler.io_fd)
+        self.start = (time.perf_counter(), time.process_time(), io)
+        return self
+
+    def __exit__(self, *exc):
+        wall, cpu, io = self.start
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        end_io = read_io(self.profiler.io_fd)
+        if io is None or end_io is None:
+            read_bytes = write_bytes = 0
+        else:
+            read_bytes, write_bytes = end_io[0] - io[0], end_io[1] - io[1]
+        stack = self.profiler.stack()
+        stack.pop()
+        self.profiler.record(
+            self.path,
+            wall=wall,
+            cpu=cpu,
+            items=self.items or 0,
+            read_bytes=read_bytes,
+            write_bytes=write_bytes,
+        )
+        return None
+
+    def add(self, items: int):
+        self.items = (self.items or 0) + items
+
+
+class Profiler:
+    def __init__(self, trace_dir: str):
+        self.trace_dir = trace_dir
+        self.reset()
+
+    def reset(self):
+        if getattr(self, "io_fd", None) is not None:
+            os.close(self.io_fd)
+        self.io_fd = open_io()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = defaultdict(lambda: dict.fromkeys(STAGE_FIELDS, 0))
+        self.peak_rss = dict()
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.start = time.perf_counter()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        self.trace_path = os.path.join(
+            self.trace_dir, f"{script_name()}-{stamp}-{self.pid}.json"
+        )
+
+    def stack(self) -> list[str]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def record(self, path: str, **values):
+        rss = peak_rss()
+        with self.lock:
+            stage = self.stages[path]
+            stage["calls"] += 1
+            for field, value in values.items():
+                stage[field] += value
+            self.peak_rss[path] = max(self.peak_rss.get(path, 0), rss)
+
+    def trace(self) -> dict:
+        with self.lock:
+            stages = [
+                {"stage": path, **values, "peak_rss": self.peak_rss[path]}
+                for path, values in self.stages.items()
+            ]
+        return {
+            "version": TRACE_VERSION,
+            "script": script_name(),
+            "argv": sys.argv,
+            "pid": self.pid,
+            "started": self.started,
+            "wall": time.perf_counter() - self.start,
+            "peak_rss": peak_rss(),
+            "stages": stages,
+        }
+
+    def write(self):
+        if len(self.stages) == 0:
+            return
+        trace = self.trace()
+        os.makedirs(self.trace_dir, exist_ok=True)
+        tmp_path = f"{self.trace_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(trace, f, indent=1)
+        os.replace(tmp_path, self.trace_path)
+
+
+_profiler = None
+
+
+def enable_profiling(trace_dir: str | None) -> Profiler | None:
+    # no-op for trace_dir None, so scripts can pass their --profile argument
+    global _profiler
+    if trace_dir is None:
+        return None
+    if _profiler is None:
+        _profiler = Profiler(os.path.abspath(trace_dir))
+        # spawned workers import this module again and read the directory here
+        os.environ[TRACE_DIR_ENV] = _profiler.trace_dir
+        # traces are written once, when the process exits
+        atexit.register(_profiler.write)
+        multiprocessing.util.register_after_fork(_profiler, _write_at_worker_exit)
+    return _profiler
+
+
+def _write_at_worker_exit(profiler: Profiler):
+    # forked worker processes skip atexit handlers, but run the finalizers
+    # multiprocessing registers after the fork when they exit
+    multiprocessing.util.Finalize(None, profiler.write, exitpriority=0)
+
+
+def _after_fork():
+    # forked workers start their own trace instead of extending the parent's
+    if _profiler is not None:
+        _profiler.reset()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+if os.environ.get(TRACE_DIR_ENV):
+    enable_profiling(os.environ[TRACE_DIR_ENV])
+
+
+def stage(name: str, items: int | None = None):
+    # items processed by the stage, or added while it runs with .add(n)
+    if _profiler is None:
+        return _NULL_STAGE
+    return _Stage(_profiler, name, items)
+
+
+def profiled(name: str | None = None):
+    # decorator running each call of a function as a stage
+    def decorator(fn):
+        stage_name = fn.__name__ if name is None else name
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return fn(*args, **kwargs)
+            with _Stage(_profiler, stage_name, None):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def read_traces(paths: list[str]) -> list[dict]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(
+                os.path.join(path, f) for f in os.listdir(path) if f.endswith(".json")
+            )
+        else:
+            files.append(path)
+    traces = []
+    for file in files:
+        with open(file, "r") as f:
+            trace = json.load(f)
+        if trace.get("version") == TRACE_VERSION:
+            traces.append(trace)
+    return traces
+
+
+def self_times(stages: list[dict]) -> dict[str, float]:
+    # wall time of each stage excluding the stages nested directly inside it
+    self_time = {s["stage"]: s["wall"] for s in stages}
+    for s in stages:
+        parent, _, _ = s["stage"].rpartition("/")
+        if parent in self_time:
+            self_time[parent] -= s["wall"]
+    return self_time
+
+
+def summarize_traces(traces: list[dict], script: str | None = None) -> list[dict]:
+    # stages of the same script and path summed over traces, with each
+    # script's wall time summed over the processes it ran in
+    rows = dict()
+    script_wall = defaultdict(float)
+    for trace in traces:
+        name = trace["script"]
+        if script is not None and name != os.path.splitext(script)[0]:
+            continue
+        script_wall[name] += trace["wall"]
+        self_time = self_times(trace["stages"])
+        for s in trace["stages"]:
+            key = (name, s["stage"])
+            if key not in rows:
+                rows[key] = {
+                    "script": name,
+                    "stage": s["stage"],
+                    "traces": 0,
+                    "self": 0.0,
+                    "peak_rss": 0,
+                    **dict.fromkeys(STAGE_FIELDS, 0),
+                }
+            row = rows[key]
+            row["traces"] += 1
+            row["self"] += self_time[s["stage"]]
+            row["peak_rss"] = max(row["peak_rss"], s["peak_rss"])
+            for field in STAGE_FIELDS:
+                row[field] += s[field]
+    for row in rows.values():
+        row["share"] = row["self"] / max(script_wall[row["script"]], 1e-12)
+        row["items_per_sec"] = row["items"] / row["wall"] if row["wall"] > 0 else 0
+    return list(rows.values())
+
+
+def report(paths: list[str], script: str | None, sort: str, top: int):
+    traces = read_traces(paths)
+    rows = summarize_traces(traces, script)
+    rows = sorted(rows, key=lambda r: r[sort], reverse=True)[:top]
+    print(f"{len(traces)} traces, top {len(rows)} stages by {sort}")
+    header = (
+        f"{'self s':>10} {'share':>6} {'wall s':>10} {'cpu s':>10} {'calls':>8} "
+        f"{'items/s':>10} {'read MB':>9} {'write MB':>9} {'peak MB':>8}  stage"
+    )
+    print(header)
+    for r in rows:
+        items_per_sec = f"{r['items_per_sec']:.1f}" if r["items"] > 0 else "-"
+        print(
+            f"{r['self']:10.3f} {r['share']:6.1%} {r['wall']:10.3f} "
+            f"{r['cpu']:10.3f} {r['calls']:8d} {items_per_sec:>10} "
+            f"{r['read_bytes'] / 2**20:9.1f} {r['write_bytes'] / 2**20:9.1f} "
+            f"{r['peak_rss'] / 2**20:8.0f}  {r['script']}:{r['stage']}"
+        )
+
+
+def main(args):
+    if args.mode == "report":
+        report(args.traces, args.script, args.sort, args.top)
+    else:
+        raise ValueError(f"Unknown mode: {args.mode}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
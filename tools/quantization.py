@@ -0,0 +1,150 @@
+import argparse
+import os
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+# Embeddings in the case_id/file_id H5s written by the embed scripts can be
+# stored quantized, marked by attributes of each dataset:
+#   no attributes                    values as written, float32 by default
+#   quantization="float16"           float16 values
+#   quantization="int8", scale=s     int8 values q of the vector q * s, with
+#                                    s = max(|x|) / 127 of that vector
+# Readers dequantize to float32. Quantized copies of existing H5s are made with
+#   python quantization.py convert --input-h5 text.h5 --quantization int8
+QUANTIZATIONS = ["float16", "int8"]
+INT8_MAX = 127
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(
+        title="mode",
+        required=True,
+        dest="mode",
+        help="See mode-specific help for further options",
+    )
+
+    convert_parser = subparsers.add_parser("convert")
+    convert_parser.add_argument("--input-h5", required=True, nargs="+")
+    convert_parser.add_argument("--quantization", required=True, choices=QUANTIZATIONS)
+    convert_parser.add_argument(
+        "--output-dir",
+        default=None,
+        help="Defaults to the directory of each input H5.",
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def add_quantization_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--quantization",
+        default=None,
+        choices=QUANTIZATIONS,
+        help="Store embeddings as float16, or as int8 with a scale per vector.",
+    )
+
+
+def quantize(
+    embs: np.ndarray, quantization: str | None
+) -> tuple[np.ndarray, np.ndarray | None]:
+    # (..., dim) embeddings to stored values and the scale of each vector
+    embs = np.asarray(embs)
+    if quantization is None:
+        return embs, None
+    elif quantization == "float16":
+        return embs.astype(np.float16), None
+    elif quantization == "int8":
+        embs = embs.astype(np.float32)
+        scales = np.abs(embs).max(axis=-1) / INT8_MAX
+        scales = np.where(scales > 0, scales, 1).astype(np.float32)
+        values = np.rint(embs / scales[..., np.newaxis])
+        return values.clip(-INT8_MAX, INT8_MAX).astype(np.int8), scales
+    else:
+        raise ValueError(f"Unknown quantization: {quantization}")
+
+
+def dequantize(
+    values: np.ndarray, quantization: str | None, scales: np.ndarray | None = None
+) -> np.ndarray:
+    # stored values of one or more vectors back to float32
+    if quantization is None:
+        return values
+    elif quantization == "float16":
+        return values.astype(np.float32)
+    elif quantization == "int8":
+        scales = np.asarray(scales, dtype=np.float32)
+        return values.astype(np.float32) * scales[..., np.newaxis]
+    else:
+        raise ValueError(f"Unknown quantization: {quantization}")
+
+
+def create_embedding_dataset(
+    group: h5py.Group,
+    name: str,
+    values: np.ndarray,
+    quantization: str | None = None,
+    scale: float | None = None,
+) -> h5py.Dataset:
+    dataset = group.create_dataset(name, data=values)
+    if quantization is not None:
+        dataset.attrs["quantization"] = quantization
+    if scale is not None:
+        dataset.attrs["scale"] = scale
+    return dataset
+
+
+def get_quantization(dataset: h5py.Dataset) -> tuple[str | None, float | None]:
+    return dataset.attrs.get("quantization"), dataset.attrs.get("scale")
+
+
+def read_embedding(dataset: h5py.Dataset) -> np.ndarray:
+    return dequantize(dataset[()], *get_quantization(dataset))
+
+
+def get_quantized_path(h5_path: str, quantization: str, output_dir=None) -> str:
+    root, ext = os.path.splitext(h5_path)
+    if output_dir is not None:
+        root = os.path.join(output_dir, os.path.basename(root))
+    return f"{root}-{quantization}{ext}"
+
+
+def convert_h5(h5_path: str, output_h5: str, quantization: str):
+    # each case's vectors are quantized together
+    with h5py.File(h5_path, "r") as h5_in, h5py.File(output_h5, "w") as h5_out:
+        for case_id in tqdm(h5_in, desc=os.path.basename(h5_path)):
+            case_group = h5_in[case_id]
+            file_ids = list(case_group)
+            embs = np.stack([read_embedding(case_group[f]) for f in file_ids])
+            values, scales = quantize(embs, quantization)
+            out_group = h5_out.create_group(case_id)
+            for i, file_id in enumerate(file_ids):
+                create_embedding_dataset(
+                    out_group,
+                    file_id,
+                    values[i],
+                    quantization,
+                    None if scales is None else scales[i],
+                )
+
+
+def main(args):
+    if args.mode == "convert":
+        for h5_path in args.input_h5:
+            output_h5 = get_quantized_path(h5_path, args.quantization, args.output_dir)
+            convert_h5(h5_path, output_h5, args.quantization)
+            size, quantized_size = os.path.getsize(h5_path), os.path.getsize(output_h5)
+            print(
+                f"Saved {h5_path} to {output_h5}, {size / 2**20:.1f} MB -> "
+                f"{quantized_size / 2**20:.1f} MB ({size / quantized_size:.1f}x)"
+            )
+    else:
+        raise ValueError(f"Unknown mode: {args.mode}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)